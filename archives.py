@@ -0,0 +1,229 @@
+# Browsing images inside zip/cbz archives as virtual files
+
+import os
+import re
+import io
+import zipfile
+import contextlib
+import collections
+from threading import Lock
+
+from PIL import Image
+
+import typing
+
+import logging
+logger = logging.getLogger(__name__)
+
+ARCHIVEEXTS = ["zip", "cbz"]
+MEMBEREXTS = ["png", "jpg", "jpeg", "gif", "bmp", "webp", "tif", "jfif"]
+
+MAX_OPEN_ARCHIVES = 8
+MAX_LISTED_ARCHIVES = 1024  # Member lists kept, for archives no longer open
+
+_ARCHIVE_PATH_REGEX = re.compile(
+    r"^(.*?\.(?:{}))[\\/](.+)$".format("|".join(ARCHIVEEXTS)),
+    flags=re.IGNORECASE
+)
+_MEMBEREXTS = tuple("." + e for e in MEMBEREXTS)
+
+
+def naturalKey(name: str) -> list:
+    """Sort key that orders "page2" before "page10"."""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name.lower())]
+
+
+def isArchive(filepath: str) -> bool:
+    return os.path.splitext(filepath)[1].lower()[1:] in ARCHIVEEXTS
+
+
+class _OpenArchive(object):
+    """A cached ZipFile, and how many calls are using it."""
+
+    def __init__(self, zf: zipfile.ZipFile, mtime: float) -> None:
+        super().__init__()
+        self.zipfile: zipfile.ZipFile = zf
+        self.mtime: float = mtime
+        self.users: int = 0
+        self.evicted: bool = False
+
+
+class ArchiveCache(object):
+    """Keeps recently used archives open, so each central directory is read once.
+
+    A virtual path is an archive path joined with a member name, like
+    "comics/issue1.cbz/page01.jpg". Members are decompressed one at a time,
+    only when read.
+
+    ZipFile reads are safe from several threads. An archive dropped from the
+    cache while a call is using it is closed when that call finishes.
+    """
+
+    def __init__(self, max_open: int = MAX_OPEN_ARCHIVES, max_listed: int = MAX_LISTED_ARCHIVES) -> None:
+        super().__init__()
+        self.max_open: int = max_open
+        self.max_listed: int = max_listed
+        self._open: collections.OrderedDict[str, _OpenArchive] = collections.OrderedDict()
+        self._members: collections.OrderedDict[str, tuple[float, list[str]]] = collections.OrderedDict()
+        self._lock = Lock()  # Guards _open, _members and the users counts
+
+    def split(self, filepath: str) -> typing.Optional[tuple[str, str]]:
+        """(archive path, member name) if filepath is a virtual path, otherwise None."""
+        match = _ARCHIVE_PATH_REGEX.match(filepath)
+        if match is None:
+            return None
+        archive, member = match.groups()
+        if archive not in self._open and not os.path.isfile(archive):
+            return None
+        return archive, member.replace("\\", "/")
+
+    def archiveOf(self, filepath: str) -> typing.Optional[str]:
+        """The archive containing virtual path filepath, or None for a real file."""
+        parts = self.split(filepath)
+        return parts[0] if parts else None
+
+    @contextlib.contextmanager
+    def _zipfile(self, archive: str) -> typing.Iterator[zipfile.ZipFile]:
+        """The open ZipFile for archive, kept open until the with block ends."""
+        mtime = os.path.getmtime(archive)
+        with self._lock:
+            entry = self._open.get(archive)
+            if entry is not None and entry.mtime != mtime:
+                self._evict(archive)
+                entry = None
+            if entry is None:
+                entry = self._open[archive] = _OpenArchive(zipfile.ZipFile(archive, "r"), mtime)
+                while len(self._open) > self.max_open:
+                    self._evict(next(iter(self._open)))
+            else:
+                self._open.move_to_end(archive)
+            entry.users += 1
+        try:
+            yield entry.zipfile
+        finally:
+            with self._lock:
+                entry.users -= 1
+                if entry.evicted and entry.users == 0:
+                    entry.zipfile.close()
+
+    def _evict(self, archive: str) -> None:
+        """Drop archive from the open files. Call with self._lock held."""
+        entry = self._open.pop(archive, None)
+        if entry is None:
+            return
+        entry.evicted = True
+        if entry.users == 0:
+            entry.zipfile.close()
+
+    def members(self, archive: str) -> list[str]:
+        """Virtual paths of the images in archive, in natural order. Empty if it can't be read."""
+        try:
+            mtime = os.path.getmtime(archive)
+            with self._lock:
+                listed = self._members.get(archive)
+                if listed is not None and listed[0] == mtime:
+                    self._members.move_to_end(archive)
+                    names = listed[1]
+                else:
+                    names = None
+            if names is None:
+                with self._zipfile(archive) as zf:
+                    names = sorted(
+                        (
+                            info.filename for info in zf.infolist()
+                            if not info.is_dir() and info.filename.lower().endswith(_MEMBEREXTS)
+                        ),
+                        key=naturalKey
+                    )
+                with self._lock:
+                    self._members[archive] = (mtime, names)
+                    self._members.move_to_end(archive)
+                    while len(self._members) > self.max_listed:
+                        self._members.popitem(last=False)
+        except (OSError, zipfile.BadZipFile):
+            logger.warning(f"Can't list archive '{archive}'", exc_info=True)
+            return []
+        return [os.path.join(archive, name) for name in names]
+
+    def _parts(self, filepath: str) -> tuple[str, str]:
+        parts = self.split(filepath)
+        if parts is None:
+            raise FileNotFoundError(filepath)
+        return parts
+
+    def info(self, filepath: str) -> zipfile.ZipInfo:
+        """ZipInfo for a virtual path.
+
+        Raises:
+            FileNotFoundError: If filepath isn't a member of an archive
+        """
+        archive, member = self._parts(filepath)
+        try:
+            with self._zipfile(archive) as zf:
+                return zf.getinfo(member)
+        except (KeyError, zipfile.BadZipFile) as e:
+            raise FileNotFoundError(filepath) from e
+
+    def exists(self, filepath: str) -> bool:
+        try:
+            self.info(filepath)
+            return True
+        except (FileNotFoundError, OSError):
+            return False
+
+    def read(self, filepath: str) -> bytes:
+        """Decompress one member.
+
+        Raises:
+            FileNotFoundError: If filepath isn't a member of an archive
+        """
+        archive, member = self._parts(filepath)
+        try:
+            with self._zipfile(archive) as zf:
+                return zf.read(member)
+        except (KeyError, zipfile.BadZipFile) as e:
+            raise FileNotFoundError(filepath) from e
+
+    def open(self, filepath: str) -> typing.IO[bytes]:
+        """Open a member for reading, decompressing as it's read.
+
+        Raises:
+            FileNotFoundError: If filepath isn't a member of an archive
+        """
+        archive, member = self._parts(filepath)
+        try:
+            # The stream holds its own reference to the archive's file, so it outlives eviction
+            with self._zipfile(archive) as zf:
+                return zf.open(member)
+        except (KeyError, zipfile.BadZipFile) as e:
+            raise FileNotFoundError(filepath) from e
+
+    def stat(self, filepath: str) -> tuple[int, float]:
+        """(uncompressed size, archive mtime) of a member.
+
+        Raises:
+            FileNotFoundError: If filepath isn't a member of an archive
+        """
+        info = self.info(filepath)
+        return info.file_size, os.path.getmtime(self.archiveOf(filepath))  # type: ignore[arg-type]
+
+    def openImage(self, filepath: str) -> Image.Image:
+        """Open a member as a PIL image. Only that member is decompressed."""
+        return Image.open(io.BytesIO(self.read(filepath)))
+
+    def forget(self, archive: str) -> None:
+        """Close archive, e.g. before it's moved or deleted. If it's being read, it's
+        closed when that read finishes."""
+        with self._lock:
+            self._evict(archive)
+            self._members.pop(archive, None)
+
+    def close(self) -> None:
+        with self._lock:
+            for archive in list(self._open):
+                self._evict(archive)
+            self._members.clear()
+
+
+# Shared by the file list, the record store and the previews
+cache = ArchiveCache()
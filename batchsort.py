@@ -0,0 +1,375 @@
+# Headless, rule-based batch sorter
+
+import os
+import re
+import sys
+import json
+import fnmatch
+import argparse
+import collections
+import concurrent.futures
+from dataclasses import dataclass, field
+
+from PIL import Image
+
+import filesystem
+import oplog
+import sortcore
+from sortcore import FolderOption
+
+from typing import IO, Iterable, Iterator, Optional
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RULE_GLOB = "glob"
+RULE_REGEX = "regex"
+RULE_DIMENSION = "dimension"
+RULE_HASH = "hash-cluster"
+RULE_SUGGEST = "suggest"
+
+TOKEN_REGEX = r'[^a-z]+'
+MIN_TOKEN_LENGTH = 3
+
+# Still images PIL can open, so the dimension and hash rules can measure them. Not the
+# GUI's list: that also takes videos, archives and PDFs, and lacks tga and webp
+MATCHGLOBS = ["*." + e for e in ["png", "jpg", "jpeg", "bmp", "tif", "jfif", "tga", "webp", "gif"]]
+
+
+@dataclass
+class FileFacts:
+    """What the rules need to know about one file. Computed in a worker process."""
+    path: str
+    width: int = 0
+    height: int = 0
+    fingerprint: Optional[str] = None
+
+
+@dataclass
+class Rule:
+    """One line of a rule file. See `loadRules` for the format.
+
+    Attributes:
+        type (str): One of the RULE_ constants
+        dest (str): Destination folder: a query matched against the context folders
+                    (like the GUI entry), or a new folder name under newFolderRoot
+        options (dict): Type-specific settings
+    """
+    type: str
+    dest: str = ""
+    options: dict = field(default_factory=dict)
+
+
+def loadRules(rules_path: str) -> list[Rule]:
+    """Read a JSON rule file: a list of objects, tried in order, first match wins.
+
+        [
+            {"type": "glob", "pattern": "*.gif", "dest": "animated"},
+            {"type": "regex", "pattern": "^(\\\\w+)_\\\\d+", "dest": "\\\\1"},
+            {"type": "dimension", "max_width": 640, "max_height": 640, "dest": "small"},
+            {"type": "hash-cluster", "dest": "dupes/{cluster}"},
+            {"type": "suggest", "min_score": 0.5}
+        ]
+
+    glob and regex match the file name (case-insensitive), and regex dests
+    may refer to groups. dimension takes any of min_/max_ width/height.
+    hash-cluster matches files whose perceptual hash is shared with another
+    file in the batch; {cluster} in dest is replaced by that hash. suggest
+    picks the existing folder whose files' names share the most words with
+    this one, and ignores dest.
+    """
+    with open(rules_path, "r", encoding="utf-8") as fp:
+        raw_rules = json.load(fp)
+
+    rules = []
+    for raw in raw_rules:
+        raw = dict(raw)
+        rule_type = raw.pop("type")
+        if rule_type not in (RULE_GLOB, RULE_REGEX, RULE_DIMENSION, RULE_HASH, RULE_SUGGEST):
+            raise ValueError(f"Unknown rule type {rule_type!r}")
+        if rule_type != RULE_SUGGEST and not raw.get("dest"):
+            raise ValueError(f"Rule {rule_type!r} needs a dest")
+        rules.append(Rule(type=rule_type, dest=raw.pop("dest", ""), options=raw))
+    return rules
+
+
+def gatherFacts(filepath: str, want_size: bool, want_hash: bool) -> FileFacts:
+    """Probe one file. Module-level so it can run in a process pool."""
+    facts = FileFacts(path=filepath)
+    if want_size:
+        try:
+            with Image.open(filepath) as image:
+                facts.width, facts.height = image.size
+        except OSError:
+            pass
+    if want_hash:
+        facts.fingerprint = sortcore.fingerprintImage(filepath)
+    return facts
+
+
+def nameTokens(filepath: str) -> set[str]:
+    stem = os.path.splitext(os.path.basename(filepath))[0].lower()
+    return {token for token in re.split(TOKEN_REGEX, stem) if len(token) >= MIN_TOKEN_LENGTH}
+
+
+class Suggester(object):
+    """Learns which words in file names go with which folders, from what's already sorted."""
+
+    def __init__(self, context_folders: list[FolderOption]) -> None:
+        super().__init__()
+        self.token_folders: dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+        for folder in context_folders:
+            try:
+                with os.scandir(folder.path) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            for token in nameTokens(entry.name):
+                                self.token_folders[token][folder.path] += 1
+            except OSError:
+                continue
+
+    def suggest(self, filepath: str, min_score: float) -> Optional[str]:
+        """The best folder for filepath, or None if nothing scores at least min_score (0-1)."""
+        tokens = nameTokens(filepath)
+        if not tokens:
+            return None
+        scores: dict[str, float] = collections.defaultdict(float)
+        for token in tokens:
+            folders = self.token_folders.get(token)
+            if not folders:
+                continue
+            total = sum(folders.values())
+            for folder_path, count in folders.items():
+                scores[folder_path] += count / total
+        if not scores:
+            return None
+        folder_path, score = max(scores.items(), key=lambda item: item[1])
+        if score / len(tokens) < min_score:
+            return None
+        return folder_path
+
+
+class BatchSorter(object):
+    """Sorts every file under a root path according to a list of rules, without a display.
+
+    Attributes:
+        paths (sortcore.SortPaths): Layout of the root being sorted
+        context_folders (list<FolderOption>): Candidate destination folders
+        rules (list<Rule>): Rules, in priority order
+    """
+
+    def __init__(self, root_path: str, rules: list[Rule], image_ext_globs: list[str],
+                 parent_dirs=False, recursive=False, jobs: Optional[int] = None) -> None:
+        super().__init__()
+        self.rules: list[Rule] = rules
+        self.jobs: Optional[int] = jobs
+
+        self.folder_index = filesystem.FolderIndex()
+        self.paths = sortcore.generatePaths(
+            root_path, image_ext_globs, self.folder_index,
+            parent_dirs=parent_dirs, recursive=recursive
+        )
+        # Files are sorted out of unsorted, never into it
+        unsorted_path = os.path.normpath(self.paths.unsorted_path)
+        self.context_folders: list[FolderOption] = [
+            folder
+            for folder in sortcore.contextFolders(self.paths, self.folder_index)
+            if os.path.normpath(folder.path) != unsorted_path
+        ]
+
+        self.suggester: Optional[Suggester] = None
+        if any(rule.type == RULE_SUGGEST for rule in rules):
+            self.suggester = Suggester(self.context_folders)
+
+    def resolveDest(self, dest: str) -> str:
+        """Turn a rule's dest into a directory path, like typing it into the GUI."""
+        matches = sortcore.bestFolders(dest.lower(), self.context_folders)
+        if len(matches) == 1:
+            return sortcore.destinationFor(matches[0].path)
+        return os.path.join(self.paths.newFolderRoot, dest)
+
+    def gather(self, filepaths: list[str]) -> list[FileFacts]:
+        """Probe all files in parallel worker processes, only as deeply as the rules need."""
+        want_size = any(rule.type == RULE_DIMENSION for rule in self.rules)
+        want_hash = any(rule.type == RULE_HASH for rule in self.rules)
+        if not (want_size or want_hash):
+            return [FileFacts(path=path) for path in filepaths]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            return list(pool.map(
+                gatherFacts, filepaths,
+                [want_size] * len(filepaths), [want_hash] * len(filepaths),
+                chunksize=64
+            ))
+
+    def matchRule(self, rule: Rule, facts: FileFacts, clusters: collections.Counter) -> Optional[str]:
+        """The destination directory rule sends facts.path to, or None if it doesn't apply."""
+        filename = os.path.basename(facts.path)
+        opts = rule.options
+
+        if rule.type == RULE_GLOB:
+            if fnmatch.fnmatch(filename.lower(), opts["pattern"].lower()):
+                return self.resolveDest(rule.dest)
+
+        elif rule.type == RULE_REGEX:
+            match = re.search(opts["pattern"], filename, flags=re.IGNORECASE)
+            if match:
+                return self.resolveDest(match.expand(rule.dest))
+
+        elif rule.type == RULE_DIMENSION:
+            if not (facts.width and facts.height):
+                return None
+            if (facts.width >= opts.get("min_width", 0)
+                    and facts.height >= opts.get("min_height", 0)
+                    and facts.width <= opts.get("max_width", facts.width)
+                    and facts.height <= opts.get("max_height", facts.height)):
+                return self.resolveDest(rule.dest)
+
+        elif rule.type == RULE_HASH:
+            if facts.fingerprint and clusters[facts.fingerprint] > 1:
+                return self.resolveDest(rule.dest.replace("{cluster}", facts.fingerprint))
+
+        elif rule.type == RULE_SUGGEST:
+            if self.suggester:
+                return self.suggester.suggest(facts.path, opts.get("min_score", 0.5))
+
+        return None
+
+    def assign(self) -> list[tuple[str, str]]:
+        """Work out which folder every file goes to.
+
+        Returns:
+            list<(str, str)>: (source file, destination directory) pairs
+        """
+        filepaths = sorted(set(sortcore.globFiles(self.paths.imageglobs)))
+        logger.info(f"Evaluating {len(self.rules)} rules against {len(filepaths)} files")
+
+        all_facts = self.gather(filepaths)
+        clusters = collections.Counter(facts.fingerprint for facts in all_facts if facts.fingerprint)
+
+        moves = []
+        for facts in all_facts:
+            for rule in self.rules:
+                destination_dir = self.matchRule(rule, facts, clusters)
+                if destination_dir:
+                    if os.path.normpath(destination_dir) != os.path.dirname(facts.path):
+                        moves.append((facts.path, destination_dir))
+                    break
+        return moves
+
+    def plan(self, confident=False) -> Iterator[dict]:
+        """Plan every move, including conflict renames, against a snapshot of the tree.
+        Nothing on disk is changed.
+
+        Args:
+            confident (bool, optional): Move conflicting files aside instead of renaming incoming ones
+
+        Yields:
+            dict: Plan records, see filesystem.planMoves
+        """
+        return filesystem.planMoves(
+            (
+                (source, os.path.join(destination_dir, os.path.basename(source)))
+                for source, destination_dir in self.assign()
+            ),
+            filesystem.NameIndex(),
+            displace=confident
+        )
+
+    def run(self, journal_dir: str = oplog.DEFAULT_JOURNAL_DIR, plan_fp: Optional[IO[str]] = None,
+            dry_run=False, confident=False) -> int:
+        """Plan all moves, then carry them out as journaled batches.
+
+        Args:
+            journal_dir (str, optional): Folder for the write-ahead journals
+            plan_fp (IO, optional): Where to stream the plan, as JSON Lines
+            dry_run (bool, optional): Stop after planning
+            confident (bool, optional): See plan()
+
+        Returns:
+            int: Number of files that failed to move
+        """
+        records: Iterable[dict] = self.plan(confident=confident)
+        if plan_fp:
+            records = filesystem.writePlan(records, plan_fp)
+        records = list(records)
+        logger.info(f"Planned {len(records)} operations")
+        if dry_run:
+            return 0
+
+        failures = []
+
+        def onMoved(op, error) -> None:
+            if error:
+                failures.append(op)
+
+        journal = oplog.Journal(journal_dir)
+        journal.recover()
+        with oplog.OperationExecutor(journal) as executor:
+            executor.enqueueMany([oplog.operationFromPlan(record, callback=onMoved) for record in records])
+        journal.close()
+
+        for destination_dir, count in collections.Counter(
+            os.path.dirname(record["destination"]) for record in records
+        ).most_common():
+            logger.info(f"{count:>6} -> {destination_dir}")
+        if failures:
+            logger.error(f"{len(failures)} files could not be moved")
+        return len(failures)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Sort a folder by rules, without a display.")
+    ap.add_argument(
+        "-b", "--base",
+        help="Root folder. Should contain folders, one of which can be named unsorted.")
+    ap.add_argument(
+        "-r", "--rules",
+        help="JSON rule file.")
+    ap.add_argument(
+        "-e", "--extensions", nargs='+', default=MATCHGLOBS,
+        help="Globs of files to sort.")
+    ap.add_argument("--parent-dirs", action="store_true", help="Use parent directories as candidates.")
+    ap.add_argument("--recursive", action="store_true", help="Include subdirs as candidates.")
+    ap.add_argument("--confident", action="store_true", help="Move conflicting files aside instead of renaming.")
+    ap.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes (default: CPU count).")
+    ap.add_argument("--journal", default=oplog.DEFAULT_JOURNAL_DIR, help="Folder for the write-ahead journals.")
+    ap.add_argument("--plan", help="Write the move plan here as JSON Lines (- for stdout).")
+    ap.add_argument("-n", "--dry-run", action="store_true", help="Only plan; don't move anything.")
+    ap.add_argument("--execute", metavar="PLAN", help="Carry out a plan written by --plan, instead of sorting.")
+    args = ap.parse_args()
+
+    if args.execute:
+        journal = oplog.Journal(args.journal)
+        journal.recover()
+        with open(args.execute, "r", encoding="utf-8") as fp:
+            failures = oplog.executePlan(filesystem.readPlan(fp), journal, jobs=args.jobs or 8)
+        journal.close()
+        for record, error in failures:
+            logger.error(f"{record['source']} -x> {record['destination']}: {error}")
+        raise SystemExit(1 if failures else 0)
+
+    if not (args.base and args.rules):
+        ap.error("--base and --rules are required unless --execute is given")
+
+    sorter = BatchSorter(
+        os.path.realpath(args.base), loadRules(args.rules), args.extensions,
+        parent_dirs=args.parent_dirs, recursive=args.recursive, jobs=args.jobs
+    )
+
+    plan_fp: Optional[IO[str]] = None
+    if args.plan == "-":
+        plan_fp = sys.stdout
+    elif args.plan:
+        plan_fp = open(args.plan, "w", encoding="utf-8")
+    try:
+        failed = sorter.run(journal_dir=args.journal, plan_fp=plan_fp, dry_run=args.dry_run, confident=args.confident)
+    finally:
+        if plan_fp and plan_fp is not sys.stdout:
+            plan_fp.close()
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+# Headless benchmarks for the preview and sorting hot paths
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import zipfile
+import platform
+import argparse
+import statistics
+import tempfile
+
+import cv2
+import numpy
+from PIL import Image
+import PIL
+
+import filerecords
+import filesystem
+import preview
+import sortcore
+import sortengine
+
+from typing import Any, Callable, TypeVar
+
+import logging
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CORPUS_KINDS = ["jpg", "png", "gif", "mp4", "zip"]
+GLOBS = ["*." + kind for kind in CORPUS_KINDS]
+
+SCREEN_SIZE = (1920, 1080)
+CANVAS_SIZE = (1280, 720)
+
+FOLDER_WORDS = [
+    "art", "photos", "screenshots", "memes", "wallpapers", "family", "travel", "work",
+    "comics", "scans", "receipts", "pets", "food", "games", "music", "misc"
+]
+
+
+def makeCorpus(root: str, count: int, size: tuple[int, int], folders: int, seed: int = 0) -> dict[str, list[str]]:
+    """Write count files of each kind in CORPUS_KINDS to root/unsorted, and folders
+    empty destination folders beside it.
+
+    Images are noise over a gradient, so they compress like photos rather than
+    like flat colour. GIFs have 3 frames, videos 10, and zips hold 5 JPEGs.
+
+    Returns:
+        dict<str, list<str>>: Paths of the files, by kind
+    """
+    rng = numpy.random.default_rng(seed)
+    unsorted = os.path.join(root, "unsorted")
+    os.makedirs(unsorted, exist_ok=True)
+
+    width, height = size
+    gradient = numpy.linspace(0, 255, width, dtype=numpy.uint8)[numpy.newaxis, :, numpy.newaxis]
+
+    def makePixels(alpha: bool = False) -> numpy.ndarray:
+        noise = rng.integers(0, 64, (height, width, 4 if alpha else 3), dtype=numpy.uint8)
+        pixels = noise + numpy.repeat(gradient, noise.shape[2], axis=2) // 2
+        if alpha:
+            pixels[:, :, 3] = 128
+        return pixels
+
+    corpus: dict[str, list[str]] = {kind: [] for kind in CORPUS_KINDS}
+    for i in range(count):
+        path = os.path.join(unsorted, f"photo_{i:04d}.jpg")
+        Image.fromarray(makePixels()).save(path, quality=90)
+        corpus["jpg"].append(path)
+
+        path = os.path.join(unsorted, f"drawing_{i:04d}.png")
+        Image.fromarray(makePixels(alpha=bool(i % 2))).save(path)
+        corpus["png"].append(path)
+
+        path = os.path.join(unsorted, f"anim_{i:04d}.gif")
+        frames = [Image.fromarray(makePixels()).convert("P") for _frame in range(3)]
+        frames[0].save(path, save_all=True, append_images=frames[1:], duration=100)
+        corpus["gif"].append(path)
+
+        path = os.path.join(unsorted, f"clip_{i:04d}.mp4")
+        writer = cv2.VideoWriter(path, cv2.VideoWriter.fourcc(*"mp4v"), 10, size)
+        if writer.isOpened():
+            for _frame in range(10):
+                writer.write(makePixels())
+            corpus["mp4"].append(path)
+        else:
+            logger.warning("No mp4 encoder available; skipping videos")
+        writer.release()
+
+        path = os.path.join(unsorted, f"book_{i:04d}.zip")
+        with zipfile.ZipFile(path, "w") as zf:
+            for page in range(5):
+                page_path = os.path.join(unsorted, "page.jpg")
+                Image.fromarray(makePixels()).save(page_path, quality=90)
+                zf.write(page_path, f"page{page + 1}.jpg")
+                os.unlink(page_path)
+        corpus["zip"].append(path)
+
+    for i in range(folders):
+        name = " ".join(rng.choice(FOLDER_WORDS, size=2, replace=False))
+        os.makedirs(os.path.join(root, f"{name} {i}"), exist_ok=True)
+
+    return corpus
+
+
+def timed(fn: Callable[[], Any], repeat: int) -> dict[str, float]:
+    """Run fn repeat times.
+
+    Returns:
+        dict: Sample count and min, median, mean, p95 and max in milliseconds
+    """
+    samples: list[float] = []
+    for _i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "n": len(samples),
+        "min_ms": samples[0],
+        "median_ms": statistics.median(samples),
+        "mean_ms": statistics.fmean(samples),
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max_ms": samples[-1],
+    }
+
+
+def timedEach(fn: Callable[[T], Any], items: list[T], repeat: int) -> dict[str, float]:
+    """Like timed, with one sample per call of fn on each of items, repeat times over."""
+    queue = iter(items * repeat)
+    return timed(lambda: fn(next(queue)), len(items) * repeat)
+
+
+def benchPreviews(corpus: dict[str, list[str]], repeat: int) -> dict[str, Any]:
+    """makePhotoImage without the Tk step: decode to a screen-size master and scale that
+    to the canvas, cold. Then scale alone, which is what a window resize costs.
+    """
+    results: dict[str, Any] = {}
+    for kind in ["jpg", "png", "gif", "mp4"]:
+        if not corpus[kind]:
+            continue
+        results[f"preview.decode.{kind}"] = timedEach(
+            lambda path: preview.scaleToFit(preview.decodeMaster(path, SCREEN_SIZE), CANVAS_SIZE),
+            corpus[kind], repeat
+        )
+        masters = [preview.decodeMaster(path, SCREEN_SIZE) for path in corpus[kind]]
+        results[f"preview.rescale.{kind}"] = timedEach(
+            lambda master: preview.scaleToFit(master, (CANVAS_SIZE[0] - 100, CANVAS_SIZE[1] - 100)),
+            masters, repeat
+        )
+        results[f"preview.thumbnail.{kind}"] = timedEach(
+            lambda path: preview.makeThumbnail(path, 150), corpus[kind], repeat
+        )
+    return results
+
+
+def benchLabels(corpus: dict[str, list[str]], repeat: int) -> dict[str, Any]:
+    """getInfoLabelForFile, with a fresh record store (first visit) and a warm one."""
+    paths = [path for kind in ["jpg", "png", "gif", "mp4"] for path in corpus[kind]]
+    results: dict[str, Any] = {}
+
+    def _cold(path: str) -> str:
+        return preview.infoLabel(filerecords.FileRecordStore(), path)
+    results["label.cold"] = timedEach(_cold, paths, repeat)
+
+    records = filerecords.FileRecordStore()
+    results["label.warm"] = timedEach(lambda path: preview.infoLabel(records, path), paths, repeat)
+    return results
+
+
+def benchMatches(root: str, repeat: int) -> dict[str, Any]:
+    """getMatches over the corpus folders, for exact-prefix and fuzzy queries. Timed
+    without its cache, which would otherwise answer every repeat.
+    """
+    labels = tuple(name.lower() for name in os.listdir(root) if os.path.isdir(os.path.join(root, name)))
+    queries = [label[:n] for label in labels[:20] for n in (1, 3, 6)]
+    getMatches = sortcore.getMatches.__wrapped__
+    return {
+        "match.prefix": timedEach(lambda query: getMatches(query, labels), queries, repeat),
+        "match.fuzzy": timedEach(
+            lambda query: getMatches(query[1:] + "z", labels, fuzzy=True), queries, repeat
+        ),
+    }
+
+
+def benchSorting(root: str, repeat: int) -> dict[str, Any]:
+    """resortImageList's scan and sort, once per sort key, from a cold record store each time."""
+    dirs = [root, os.path.join(root, "unsorted")]
+    results: dict[str, Any] = {}
+
+    records = filerecords.FileRecordStore()
+    results["sort.scan"] = timed(lambda: records.scan(dirs, GLOBS), repeat)
+
+    for name in sortcore.makeSortKeys(records):
+        def _resort() -> None:
+            cold = filerecords.FileRecordStore()
+            sortcore.SortedFileList(cold.scan(dirs, GLOBS), sortcore.makeSortKeys(cold)[name])  # noqa: B023
+        results[f"sort.key.{name}"] = timed(_resort, repeat)
+    return results
+
+
+def benchEngine(root: str, repeat: int) -> dict[str, Any]:
+    """A SortEngine session, as the window drives it: opening the root (folders, scan
+    and sort), then moving every file to a new folder and undoing that.
+    """
+    engine = sortengine.SortEngine(GLOBS, journal_dir=os.path.join(root, "journal"))
+    try:
+        results: dict[str, Any] = {"engine.open": timed(lambda: engine.open(root), repeat)}
+
+        def _moveAndUndo() -> None:
+            engine.marked.update(engine.filepaths)
+            engine.moveToNewFolder("benchmark moved", engine.selectedPaths())
+            engine.operations.wait()
+            engine.undoLast()
+            engine.operations.wait()
+            engine.drainOperationResults()
+        results["engine.move_undo"] = timed(_moveAndUndo, repeat)
+        return results
+    finally:
+        engine.close()
+
+
+def benchFingerprints(corpus: dict[str, list[str]], repeat: int) -> dict[str, Any]:
+    paths = corpus["jpg"] + corpus["png"]
+    return {"fingerprint": timedEach(sortcore.fingerprintImage, paths, repeat)}
+
+
+def benchTrash(root: str, count: int, repeat: int) -> dict[str, Any]:
+    """Trash.delete of small files, then committing them all."""
+    scratch = os.path.join(root, "trash")
+    delete_samples: list[dict] = []
+    commit_samples: list[dict] = []
+    for _i in range(repeat):
+        os.makedirs(scratch, exist_ok=True)
+        paths = []
+        for n in range(count):
+            path = os.path.join(scratch, f"junk_{n}.bin")
+            with open(path, "wb") as fp:
+                fp.write(os.urandom(64 * 1024))
+            paths.append(path)
+
+        trash = filesystem.Trash(queue_size=count + 1)
+        trash._osTrash = os.unlink  # Don't fill the real OS trash with benchmark files
+        delete_samples.append(timedEach(trash.delete, paths, 1))
+        commit_samples.append(timed(trash.finish, 1))
+    return {
+        "trash.delete": min(delete_samples, key=lambda s: s["median_ms"]),
+        "trash.commit": min(commit_samples, key=lambda s: s["median_ms"]),
+    }
+
+
+def runAll(root: str, count: int, size: tuple[int, int], folders: int, repeat: int) -> dict[str, Any]:
+    start = time.perf_counter()
+    corpus = makeCorpus(root, count, size, folders)
+    setup_s = time.perf_counter() - start
+
+    results: dict[str, Any] = {}
+    results.update(benchPreviews(corpus, repeat))
+    results.update(benchLabels(corpus, repeat))
+    results.update(benchMatches(root, repeat))
+    results.update(benchSorting(root, repeat))
+    results.update(benchEngine(root, repeat))
+    results.update(benchFingerprints(corpus, repeat))
+    results.update(benchTrash(root, count, repeat))
+
+    return {
+        "meta": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "pillow": PIL.__version__,
+            "opencv": cv2.__version__,
+            "count": count,
+            "size": list(size),
+            "folders": folders,
+            "repeat": repeat,
+            "corpus_seconds": setup_s,
+        },
+        "results": results,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Time the preview and sorting hot paths, without a display.")
+    ap.add_argument("-n", "--count", type=int, default=20, help="Files of each kind in the corpus.")
+    ap.add_argument("--size", type=int, nargs=2, default=[1920, 1080], metavar=("W", "H"), help="Image and video size.")
+    ap.add_argument("--folders", type=int, default=200, help="Destination folders to match against.")
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="Times to repeat each measurement.")
+    ap.add_argument("--corpus", help="Build the corpus here and keep it, instead of a temporary folder.")
+    ap.add_argument("-o", "--out", help="Write JSON results here instead of stdout.")
+    args = ap.parse_args()
+
+    random.seed(0)
+    # Some steps fail by design, like fingerprinting a video, and would flood stderr
+    logging.disable(logging.ERROR)
+    root = args.corpus or tempfile.mkdtemp(prefix="sortbench")
+    try:
+        report = runAll(root, args.count, tuple(args.size), args.folders, args.repeat)  # type: ignore[arg-type]
+    finally:
+        if not args.corpus:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import tkinter as tk
+
+from PIL import ImageTk
+
+import os
+import queue
+
+import preview
+
+import typing
+
+import logging
+logger = logging.getLogger(__name__)
+
+CELL_PADDING = 6
+POLL_MS = 30
+
+SELECTED_OUTLINE = "#3399FF"
+MARKED_OUTLINE = "#FFAA00"
+
+
+class ContactSheet(tk.Canvas):
+
+    """Grid of thumbnails for the files around the current one.
+
+    Only the cells that fit in the window are drawn. Thumbnails come from a
+    shared PreviewService, which decodes missing ones in parallel, and are
+    drawn as they arrive.
+    """
+
+    def __init__(self, parent, previews: preview.PreviewService, *args, cell_size: int = 160, **kwargs) -> None:
+        """Args:
+            parent (FileSorter): Controller; must provide gotoImage and toggleGrid
+            previews (PreviewService): Shared source of thumbnails
+            cell_size (int, optional): Width and height of each grid cell, in pixels
+            *args: Passthrough
+            **kwargs: Passthrough
+        """
+        tk.Canvas.__init__(self, parent, *args, **kwargs)
+
+        self.controller = parent
+        self.previews = previews
+        self.cell_size: int = cell_size
+
+        self.filepaths: typing.Sequence[str] = []
+        self.current: int = 0  # Index of the current file; not "index", which is a Canvas method
+        self.marked: typing.AbstractSet[str] = frozenset()
+        self.first: int = 0  # Index of the file in the top-left cell
+
+        self.photos: dict[str, ImageTk.PhotoImage] = {}  # Keep visible PhotoImages alive
+        self.requested: set[str] = set()
+        self.results: queue.Queue = queue.Queue()
+        self.polling: bool = False
+
+        self.bind("<Configure>", lambda event: self.redraw())  # noqa: ARG005
+        self.bind("<Button-1>", self.onClick)
+        self.bind("<Double-Button-1>", lambda event: self.controller.toggleGrid())  # noqa: ARG005
+
+    @property
+    def thumbSize(self) -> int:
+        return self.cell_size - 2 * CELL_PADDING
+
+    @property
+    def columns(self) -> int:
+        return max(1, self.winfo_width() // self.cell_size)
+
+    @property
+    def rows(self) -> int:
+        return max(1, self.winfo_height() // self.cell_size)
+
+    def show(self, filepaths: typing.Sequence[str], index: int, marked: typing.AbstractSet[str] = frozenset()) -> None:
+        """Show the page of the grid that contains filepaths[index]."""
+        self.filepaths = filepaths
+        self.current = index
+        self.marked = marked
+
+        per_page = self.columns * self.rows
+        self.first = (index // per_page) * per_page
+        self.redraw()
+
+    def visiblePaths(self) -> list[str]:
+        per_page = self.columns * self.rows
+        return list(self.filepaths[self.first:self.first + per_page])
+
+    def redraw(self) -> None:
+        self.delete(tk.ALL)
+
+        visible = self.visiblePaths()
+        self.photos = {path: photo for path, photo in self.photos.items() if path in visible}
+
+        columns = self.columns
+        for offset, filepath in enumerate(visible):
+            x = (offset % columns) * self.cell_size
+            y = (offset // columns) * self.cell_size
+
+            outline = ""
+            if self.first + offset == self.current:
+                outline = SELECTED_OUTLINE
+            elif filepath in self.marked:
+                outline = MARKED_OUTLINE
+            if outline:
+                self.create_rectangle(
+                    x + 1, y + 1, x + self.cell_size - 2, y + self.cell_size - 2,
+                    outline=outline, width=3
+                )
+
+            photo = self.photos.get(filepath)
+            if photo is None:
+                thumb = self.previews.thumbnails.get((filepath, self.thumbSize))
+                if thumb is not None:
+                    photo = self.photos[filepath] = ImageTk.PhotoImage(thumb)
+                else:
+                    self.requestThumbnail(filepath)
+
+            center = (x + self.cell_size // 2, y + self.cell_size // 2)
+            if photo is not None:
+                self.create_image(*center, image=photo)
+            else:
+                self.create_text(*center, text=os.path.basename(filepath)[:20], width=self.thumbSize)
+
+    def requestThumbnail(self, filepath: str) -> None:
+        if filepath in self.requested:
+            return
+        self.requested.add(filepath)
+        size = self.thumbSize
+
+        def _do() -> None:
+            try:
+                self.previews.thumbnail(filepath, size)
+            finally:
+                # Even on failure, so the request is cleared and the cell can be asked for again
+                self.results.put(filepath)
+
+        self.previews.spool.enqueue(target=_do)
+        if not self.polling:
+            self.polling = True
+            self.after(POLL_MS, self.pollThumbnails)
+
+    def pollThumbnails(self) -> None:
+        """Redraw once any requested thumbnails have been decoded."""
+        arrived = False
+        while True:
+            try:
+                filepath = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.requested.discard(filepath)
+            arrived = True
+
+        if arrived and self.winfo_ismapped():
+            self.redraw()
+
+        if self.requested:
+            self.after(POLL_MS, self.pollThumbnails)
+        else:
+            self.polling = False
+
+    def markCacheDirty(self, filepath: str) -> None:
+        self.previews.forget(filepath)
+        self.photos.pop(filepath, None)
+
+    def onClick(self, event) -> None:
+        self.focus_set()
+        column = event.x // self.cell_size
+        row = event.y // self.cell_size
+        if column >= self.columns:
+            return
+        index = self.first + row * self.columns + column
+        if index < len(self.filepaths):
+            self.controller.gotoImage(index)
@@ -1,28 +1,27 @@
 import tkinter as tk
 
 from io import BytesIO
-from PIL import Image
-from PIL import ImageDraw
-from PIL import UnidentifiedImageError
 from PIL import ImageTk
-from PIL import ExifTags
-import cv2
 
 import os
 import subprocess  # noqa: S404
-from threading import Lock
 from tkinter import filedialog
-import collections
-import math
-import zipfile
-import threading
-import traceback
+import queue
 
 import typing
-import functools
 
 import filesystem
-import loom
+import filerecords
+import instrument
+import pdfpages
+import preview
+from filerecords import _IMAGEEXTS, _VIDEOEXTS
+# Moved to preview; kept importable from here
+from preview import (  # noqa: F401
+    SUPPORTED_EXTS, LRUCache, ThumbnailCache, PreviewService, TextPreview, bytes_to_string, imageBytes,
+    openImage, isFile, compactImage, readFirstFrame, frameToImage, scaleToFit, decodeMaster, infoLabel,
+    makeThumbnail, placeholderImage
+)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -30,55 +29,7 @@ logger = logging.getLogger(__name__)
 # from snip.stream import TriadLogger
 # logger = TriadLogger(__name__)
 
-IMAGEEXTS = ["png", "jpg", "gif", "bmp", "jpeg", "tif", "gifv", "jfif"]
-VIDEOEXTS = ["webm", "mp4", "mov", "webp"]
-SUPPORTED_EXTS = ['zip', 'pdf', *IMAGEEXTS, *VIDEOEXTS]
-
-_IMAGEEXTS = ["." + e for e in IMAGEEXTS]
-_VIDEOEXTS = ["." + e for e in VIDEOEXTS]
-
-
-def framesInImage(im):
-    try:
-        im = Image.open(im)
-    except OSError:
-        return 1
-    try:
-        while True:
-            frames = im.tell()
-            im.seek(frames + 1)
-    except EOFError:
-        return frames + 1
-
-
-def autoRotate(image):
-
-    orientationflags = [key for key in ExifTags.TAGS.keys() if ExifTags.TAGS[key] == 'Orientation']
-    try:
-        for orientation in orientationflags:
-            exif = dict(image._getexif().items())
-            if not exif.get(orientation):
-                continue
-
-            if exif[orientation] == 3:  # noqa: PLR2004
-                return image.rotate(180, expand=True)
-            elif exif[orientation] == 6:  # noqa: PLR2004
-                return image.rotate(270, expand=True)
-            elif exif[orientation] == 8:  # noqa: PLR2004
-                return image.rotate(90, expand=True)
-    except (KeyError, AttributeError):
-        pass
-
-    return image
-
-
-def bytes_to_string(value: int, units=('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB'), sep="", base=1024) -> str:
-    """ Returns a human readable string reprentation of bytes."""
-    # Adapted from a comment by "Mr. Me" on github.
-    if value < base:
-        return "{:0.2f}{}{}".format(value, sep, units[0])
-    else:
-        return bytes_to_string(value / base, units[1:], sep=sep)
+POLL_MS = 30
 
 
 def send_to_clipboard(clip_type, data) -> None:
@@ -92,7 +43,7 @@ def send_to_clipboard(clip_type, data) -> None:
 def copy_imdata_to_clipboard(filepath) -> None:
     import win32clipboard  # noqa: PLC0415
 
-    image = Image.open(filepath)
+    image = openImage(filepath)
 
     output = BytesIO()
     image.convert("RGB").save(output, "BMP")
@@ -110,52 +61,63 @@ def copy_text_to_clipboard(text) -> None:
     win32clipboard.CloseClipboard()
 
 
-def makeTextFromPdf(filepath: str) -> str:
-    text: str = ""
-    try:
-        import pikepdf  # noqa: PLC0415
-
-        with pikepdf.open(filepath) as pdf:
-            for key, value in pdf.docinfo.items():
-                try:
-                    text += f"\n{key}:\t{value}"
-                except NotImplementedError:
-                    text += f"\n{key}:\t{value!r}"
-
-    except ImportError:
-        text += "\nImportError: pikepdf not installed"
-    except Exception as e:
-        text += f"\npikepdf {type(e)}: {e}"
+class ContentCanvas(tk.Canvas):
 
-    return text
+    """Shows one file: an image, a PDF page, or a text preview.
 
+    This is only the view. What to show comes from a PreviewService, and
+    the canvas just turns it into PhotoImages and canvas items.
+    """
 
-class ContentCanvas(tk.Canvas):
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self, *args,
+        previews: typing.Optional[preview.PreviewService] = None,
+        records: typing.Optional[filerecords.FileRecordStore] = None,
+        thumbnails: typing.Optional[ThumbnailCache] = None,
+        **kwargs
+    ):
         """Args:
             parent (tk): Tk parent widget
+            previews (PreviewService, optional): Shared preview source. Made from records and thumbnails if not given.
+            records (FileRecordStore, optional): Shared per-file metadata
+            thumbnails (ThumbnailCache, optional): Shared image cache; rendered PDF pages go here
             *args: Passthrough
             **kwargs: Passthrough
         """
         tk.Canvas.__init__(self, *args, **kwargs)
 
-        self.photoImageCaches = collections.defaultdict(dict)
-        self.photoImageCache = self.photoImageCaches[(0, 0)]
-        self.textCache = {}
-
-        self.preloaderLock = Lock()
-        self.spool = loom.Spool(8, "ContentCanvas")
+        if previews is None:
+            previews = preview.PreviewService(
+                records=records, thumbnails=thumbnails,
+                screen_size=(self.winfo_screenwidth(), self.winfo_screenheight())
+            )
+            self.owns_previews: bool = True
+        else:
+            self.owns_previews = False
+        self.previews: preview.PreviewService = previews
 
         self.current_file = ""
+        self.pdf_page: int = 0
+
+        self.pages_rendered: queue.Queue = queue.Queue()
+        self.polling: bool = False
 
         self.resize_after = None
 
         # Initialize window
         self.initwindow()
 
+    @property
+    def records(self) -> filerecords.FileRecordStore:
+        return self.previews.records
+
+    @property
+    def thumbnails(self) -> ThumbnailCache:
+        return self.previews.thumbnails
+
     def destroy(self):
-        # self.spool.finish()
-        self.spool.cancel()
+        if self.owns_previews:
+            self.previews.close()
         super().destroy()
 
     def initwindow(self) -> None:
@@ -164,6 +126,7 @@ class ContentCanvas(tk.Canvas):
             0, 0, anchor="nw")
 
         self.text = self.create_text(10, 10, anchor="nw")
+        self.overlay = self.create_text(0, 10, anchor="ne", font="TkFixedFont", fill="magenta", state="hidden")
 
         self.bind("<Configure>", self.onResize)
 
@@ -215,15 +178,13 @@ class ContentCanvas(tk.Canvas):
         logger.info(f"{self.current_file} -> {downloads}")
         self.bell()
 
+    @property
+    def viewSize(self) -> tuple[int, int]:
+        return (self.winfo_width(), self.winfo_height())
+
     def onResize(self, configure_event):  # noqa: ARG002
-        # self.markAllDirty()
-        # We don't need to mark text dirty
-        # logger.debug("Clearing photoimage cache (window resized)")
-        # self.photoImageCache.clear()
         def _resizeafter_callback():
-            dimensions = (self.winfo_width(), self.winfo_height())
-            self.photoImageCache = self.photoImageCaches[dimensions]
-            # logger.debug(f"Switching to cache for size {dimensions}")
+            # The previews rescale from their masters at the new size
             self.setFile(self.current_file)
             # If this was done after a resize, cancel that biz.
             self.resize_after = None
@@ -233,16 +194,37 @@ class ContentCanvas(tk.Canvas):
                 self.after_cancel(self.resize_after)
             self.resize_after = self.after(100, _resizeafter_callback)
 
+    def setOverlay(self, text: typing.Optional[str]) -> None:
+        """Show text in the top right corner, over the image, or hide it if text is None."""
+        if text is None:
+            self.itemconfig(self.overlay, state="hidden")
+            return
+        self.coords(self.overlay, self.winfo_width() - 10, 10)
+        self.itemconfig(self.overlay, text=text, state="normal")
+        self.tag_raise(self.overlay)
+
     def markCacheDirty(self, entry: str):
-        # logger.debug(f"Removing dirtied cache item {entry}")
-        self.photoImageCache.pop(entry, None)
-        self.textCache.pop(entry, None)
+        self.previews.forget(entry)
 
     def clear(self):
         self.itemconfig(self.photoimage, image=None)
         self.itemconfig(self.photoimage, state="hidden")
         self.itemconfig(self.text, text=None, state="hidden")
 
+    def trackFile(self, filepath) -> bool:
+        """Make filepath the current file without rendering it.
+
+        Returns:
+            bool: Whether the file can be shown
+        """
+        normpath = os.path.normpath(filepath)
+
+        if normpath == ".":
+            return False
+
+        self.current_file = normpath
+        return isFile(filepath)
+
     def setFile(self, filepath) -> bool:
         """Update the display to match the current image index.
         """
@@ -252,25 +234,19 @@ class ContentCanvas(tk.Canvas):
         if normpath == ".":
             return False
 
+        if normpath != self.current_file:
+            self.pdf_page = 0
         self.current_file = normpath
 
-        # try:
-        #     self.curimg = self.makePhotoImage(filepath)
-        # except (OSError, SyntaxError, tk.TclError) as e:
-        #     print("[{}] Bad image: ".format(e) + filepath)
-        #     traceback.print_exc()
-        #     return False
-
         return self.configureForFile(filepath)
 
     def configureForFile(self, filepath) -> bool:
-        # logger.debug(f"Configuring canvas for new filepath '{filepath}'")
         text = "No selection."
 
         if not filepath:
             return False
 
-        if not os.path.isfile(filepath):
+        if not isFile(filepath):
             return False
 
         self.curimg: typing.Optional[ImageTk.PhotoImage] = None
@@ -280,238 +256,121 @@ class ContentCanvas(tk.Canvas):
             self.curimg = self.makePhotoImage(filepath)
             self.itemconfig(self.photoimage, image=self.curimg, state="normal")
             self.itemconfig(self.text, text=None, state="hidden")
+        elif fileext.lower() == ".pdf" and self.showPdfPage(filepath):
+            pass
         else:
-            text = self.makeTextData(filepath)
+            text = self.previews.text(filepath)
             self.itemconfig(self.text, text=text, state="normal")
             self.itemconfig(self.photoimage, image="", state="hidden")
             self.curimg = None
         return True
 
-    def preloadImage(self, filepaths) -> None:
-        if len(filepaths) > 20:
-            return
-        for filepath in filepaths:
-            if filepath not in self.photoImageCache.keys():
-                # print("Path", filepath, "missing from cache", self.photoImageCache.keys())
-                target_path: str = filepath
-
-                def _do():
-                    self.spool.enqueue(
-                        target=self.makePhotoImage,
-                        args=(
-                            target_path,
-                            self.winfo_width(),
-                            self.winfo_height(),
-                        )
-                    )
-                self.after_idle(_do)
-
-    def makeTextData(self, filepath) -> str:
-        text = self.textCache.get(filepath, "")
-        if not text:
-            text += f"\nPath:\t{filepath}"
-            text += f"\nSize:\t{bytes_to_string(os.path.getsize(filepath))}"
-
-            _filename, fileext = os.path.splitext(filepath)
-            if fileext.lower() == ".pdf":
-                text += makeTextFromPdf(filepath)
-
-            if fileext.lower() == ".zip":
-                with zipfile.ZipFile(filepath, 'r') as fp:
-                    text += "\n" + "\n".join(fp.namelist())
-
-            if os.name == "nt":
-                try:
-                    from win32_fileprops import property_sets  # noqa: PLC0415
-                    for name, properties in property_sets(filepath):
-                        text += f"\nWin32 {name}"
-                        for key, value in properties.items():
-                            if value:
-                                text += f"\n\t{key}:\t{value}"
-                except ImportError as e:
-                    text += f"\n{e}"
+    def showPdfPage(self, filepath: str) -> bool:
+        """Show the current page of a PDF if it's been rendered at this size. If it
+        hasn't, ask for it, and it's shown when it arrives.
 
-            try:
-                with open(filepath, "r", encoding='utf-8') as fp:
-                    text += f"\n{fp.read(5000)}"  # 5 kb
-            except Exception as e:
-                print(e)
+        Returns:
+            bool: Whether the page is showing
+        """
+        size = self.viewSize
+        if pdfpages.availableRenderer() is None or min(size) <= 1:
+            return False
+        filepath = os.path.normpath(filepath)
 
-        self.textCache[filepath] = text
-        return text
+        pilimg = self.previews.page(filepath, self.pdf_page, size)
+        if pilimg is None:
+            self.requestPdfPage(filepath, self.pdf_page, size)
+            return False
 
-    @staticmethod
-    def placeholderImage() -> Image.Image:
-        pilimg = Image.new('RGB', (10, 10), color=(0, 0, 0))
-        ImageDraw.Draw(pilimg).text((2, 0), "?", fill=(255, 255, 255))
-        return pilimg
+        self.curimg = ImageTk.PhotoImage(pilimg)
+        self.itemconfig(self.photoimage, image=self.curimg, state="normal")
+        self.itemconfig(self.text, text=None, state="hidden")
+        return True
 
-    def getInfoLabel(self) -> str:
-        if self.current_file == "":
-            return "No file"
+    def requestPdfPage(self, filepath: str, page_number: int, size: tuple[int, int]) -> None:
+        """Have the previews render a PDF page, and check for it until it arrives."""
+        self.previews.requestPage(filepath, page_number, size, done=self.pages_rendered.put)
+        if not self.polling:
+            self.polling = True
+            self.after(POLL_MS, self.pollPdfPages)
 
-        prettyname = self.current_file
-        if not os.path.isfile(self.current_file):
-            prettyname += " (Not Found)"
-            return prettyname
+    def pollPdfPages(self) -> None:
+        """Show the current PDF page once it's been rendered."""
+        while True:
+            try:
+                key = self.pages_rendered.get_nowait()
+            except queue.Empty:
+                break
+            filepath, page_number, size = key
+            if (
+                filepath == self.current_file and page_number == self.pdf_page
+                and size == self.viewSize and self.previews.page(*key) is not None
+            ):
+                self.configureForFile(filepath)
+
+        # Callbacks run before a page stops pending, so nothing is missed in between
+        if self.previews.pages_pending or not self.pages_rendered.empty():
+            self.after(POLL_MS, self.pollPdfPages)
+        else:
+            self.polling = False
 
-        return self.getInfoLabelForFile(self.current_file)
+    def turnPage(self, delta: int) -> bool:
+        """Show another page of the current PDF.
 
-    @staticmethod
-    @functools.lru_cache()
-    def getInfoLabelForFile(filepath) -> str:
-        __, fileext = os.path.splitext(filepath)
-        prettyname: str = filepath  # Fallback 2
+        Returns:
+            bool: Whether the current file has pages to turn
+        """
+        if not self.current_file.lower().endswith(".pdf"):
+            return False
         try:
-            filename: str = os.path.split(filepath)[1]
-            filesize: str = bytes_to_string(os.path.getsize(filepath))
-
-            prettyname = f"{filename}\n{filesize}"  # Fallback 1
-
-            (_filename, fileext) = os.path.splitext(filename)
-
-            # Get initial image
-            if fileext.lower() in _IMAGEEXTS:
-                frames = 1  # framesInImage(filepath)
-                w, h = Image.open(filepath).size
-                if frames > 1:
-                    prettyname = f"{filename} [{frames}f]\n{filesize} [{w}x{h}px]"
-                else:
-                    prettyname = f"{filename}\n{filesize} [{w}x{h}px]"
-
-            elif fileext.lower() in _VIDEOEXTS:
-                capture = cv2.VideoCapture(filepath)
-                capture.grab()
-                _flag, frame = capture.retrieve()
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pilimg = Image.fromarray(frame)
+            pages = self.previews.pages(self.current_file)
+        except (OSError, ImportError):
+            return False
+        self.pdf_page = (self.pdf_page + delta) % pages if pages else 0
+        self.configureForFile(self.current_file)
+        return True
 
-                w, h = pilimg.size
-                frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    def preloadImage(self, filepaths) -> None:
+        if len(filepaths) > 20:
+            return
+        size = self.viewSize
+        if min(size) <= 1:
+            return
+        self.previews.preload(filepaths, size)
 
-                prettyname = f"{filename} [{frames}f]\n{filesize} [{w}x{h}px]"
+    def makeTextData(self, filepath) -> str:
+        """See PreviewService.text."""
+        return self.previews.text(filepath)
 
-            else:
-                raise OSError(f"Exception reading image '{filepath}'")
+    def getInfoLabel(self) -> str:
+        if self.current_file == "":
+            return "No file"
 
-        except (OSError, cv2.error, UnidentifiedImageError):
-            logger.error("OS error while getting file info", exc_info=True)
+        return self.getInfoLabelForFile(self.current_file)
 
-        return prettyname
+    def getInfoLabelForFile(self, filepath) -> str:
+        """See infoLabel. The current file's label includes the page being shown."""
+        return self.previews.label(filepath, page=self.pdf_page if filepath == self.current_file else 0)
 
-    def makePhotoImage(self, filename, always_resize=True, stepsize=4) -> typing.Optional[ImageTk.PhotoImage]:
-        """Make a resized photoimage given a filepath
+    def makePhotoImage(self, filename) -> typing.Optional[ImageTk.PhotoImage]:
+        """Make a photoimage of filename, scaled to the canvas. See PreviewService.image.
 
         Args:
             filename (str): Path to an image file
-            maxwidth (TYPE): Maximum width of canvas
-            maxheight (TYPE): Maximum height of canvas
 
         Returns:
-            ImageTk.PhotoImage
+            ImageTk.PhotoImage, or None if the window hasn't been laid out yet
         """
-        # pilimg = Image.open(filename)
-
-        maxwidth = self.winfo_width()
-        maxheight = self.winfo_height()
+        size = self.viewSize
         # Let window load
-        if maxwidth <= 1 or maxheight <= 1:
-            self.after(200, self.makePhotoImage, filename, always_resize, stepsize)
-            # logger.debug("Window not initialized, waiting")
+        if min(size) <= 1:
+            self.after(200, self.makePhotoImage, filename)
             return None
 
-        # Attempt cache fetch
-        pilimg = self.photoImageCache.get(filename)
-
-        if pilimg:
-            # logger.debug(f"photoimage cache hit for filename '{filename}'")
-            return ImageTk.PhotoImage(pilimg)
-
-        (_filename, fileext) = os.path.splitext(filename)
-
-        # Get initial image
-        try:
-            if fileext.lower() in _IMAGEEXTS:
-                pilimg = Image.open(filename)
-                pilimg = autoRotate(pilimg)
-
-            elif fileext.lower() in _VIDEOEXTS:
-                capture = cv2.VideoCapture(filename)
-                capture.grab()
-                _flag, frame = capture.retrieve()
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pilimg = Image.fromarray(frame)
-            else:
-                raise OSError("Exception reading image")
-        except (cv2.error, OSError):
-            pilimg = self.placeholderImage()
-
-        # For full support
-        pilimg = pilimg.convert('RGBA')
-
-        # Resize image to canvas
-        ratio = 1.0
-        image_is_too_big: bool = (pilimg.width > maxwidth) or (pilimg.height > maxheight)
-
-        if image_is_too_big:
-            ratio = min(maxwidth / pilimg.width, maxheight / pilimg.height)
-            method: Image.Resampling = Image.Resampling.BICUBIC
-        else:
-            ratio = min(maxwidth / pilimg.width, maxheight / pilimg.height)
-            ratio = math.floor(ratio * 4) / 4
-            method = Image.Resampling.NEAREST
-            # else:
-            #     print("Warning: stepratio =", stepratio, "with ratio", ratio, "and stepsize", stepsize)
-        if ratio != 1.0 and ratio > 0:
-            # logger.debug(f"Resizing {filename} to {ratio}x using method {method}")
+        pilimg = self.previews.image(filename, size)
+        with instrument.span("photoimage"):
             try:
-                # print(f"Resize: mw{maxwidth}, mh{maxheight}, w{pilimg.width}, h{pilimg.height}, ratio {ratio}, method {method}, stepsize {stepsize}\n{filename}")
-                pilimg = pilimg.resize(
-                    (int(pilimg.width * ratio), int(pilimg.height * ratio)), method)
-            except (OSError, ValueError):
-                logger.error(f"OS error resizing file {filename}", exc_info=True)
-                # raise
-                # loc = None
-                # for loc in locals():
-                #     print(loc, ":", locals().get(loc))
-                try:
-                    return ImageTk.PhotoImage(pilimg)
-                except SyntaxError:
-                    logger.error("Corrupt image", exc_info=True)
-                    pilimg = self.placeholderImage()
-                except (MemoryError, tk.TclError):
-                    logger.error("Corrupt image, I think?", exc_info=True)
-                    pilimg = self.placeholderImage()
-                except Exception:
-                    logger.error("Unhandled exception", exc_info=True)
-                    raise
-        else:
-            logger.debug(f"NOT {filename} to {ratio}x using method {method} (bad ratio)")
-
-        # Add overlay to video files
-        try:
-            if fileext.lower() in _VIDEOEXTS:
-                ImageDraw.Draw(pilimg).rectangle([(0, 0), (30, 14)], fill=(0, 0, 0))  # type: ignore[arg-type]
-                ImageDraw.Draw(pilimg).text((2, 2), fileext.lower(), fill=(255, 255, 255))
-
-            if (fileext.lower() in _IMAGEEXTS and framesInImage(filename) > 1):
-                ImageDraw.Draw(pilimg).rectangle([(0, 0), (30, 14)], fill=(0, 0, 0))  # type: ignore[arg-type]
-                ImageDraw.Draw(pilimg).text((2, 2), str(framesInImage(filename)), fill=(255, 255, 255))
-        except ValueError:
-            traceback.print_exc()
-            # pilimg = pilimg
-
-        self.photoImageCache[filename] = pilimg
-        # logger.debug("Adding new photoimage to cache %s", filename)
-
-        threading.Thread(target=self.pruneImageCache, name="pruneImageCache").start()
-        return ImageTk.PhotoImage(pilimg)
-
-    def pruneImageCache(self, max_memory_entries=100):
-        for cache in self.photoImageCaches.values():
-            if len(cache) < max_memory_entries:
-                continue
-            while len(cache) > max_memory_entries // 2:
-                dirty_item = next(iter(cache.keys()))
-                logger.info(f"Cache too big, removing entry {dirty_item}")
-                cache.pop(dirty_item)
+                return ImageTk.PhotoImage(pilimg)
+            except (MemoryError, tk.TclError):
+                logger.error("Corrupt image, I think?", exc_info=True)
+                return ImageTk.PhotoImage(placeholderImage())
@@ -0,0 +1,321 @@
+# Per-file metadata, gathered once and shared by sorting, labels and previews
+
+import os
+import struct
+import fnmatch
+import collections
+from threading import Lock
+
+from PIL import Image
+from PIL import UnidentifiedImageError
+import cv2
+
+import archives
+import sortcore
+
+import typing
+
+import logging
+logger = logging.getLogger(__name__)
+
+IMAGEEXTS = ["png", "jpg", "gif", "bmp", "jpeg", "tif", "gifv", "jfif"]
+VIDEOEXTS = ["webm", "mp4", "mov", "webp"]
+
+_IMAGEEXTS = ["." + e for e in IMAGEEXTS]
+_VIDEOEXTS = ["." + e for e in VIDEOEXTS]
+
+MAX_RECORDS = 200000
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+GIF_SIGNATURES = (b"GIF87a", b"GIF89a")
+
+
+class FileRecord(object):
+    """What we know about one file. Fields are None until something needs them.
+
+    Attributes:
+        path (str): Path to the file
+        size (int): Size in bytes
+        mtime (float): Last modified time
+        width (int): Pixel width, 0 if the file isn't an image or video
+        height (int): Pixel height, 0 if the file isn't an image or video
+        frames (int): Number of frames, 1 for still images
+        fingerprint (str): Perceptual hash, see sortcore.fingerprintImage
+    """
+    __slots__ = ("path", "size", "mtime", "width", "height", "frames", "fingerprint")
+
+    def __init__(self, path: str, size: typing.Optional[int] = None, mtime: typing.Optional[float] = None) -> None:
+        self.path: str = path
+        self.size: typing.Optional[int] = size
+        self.mtime: typing.Optional[float] = mtime
+        self.width: typing.Optional[int] = None
+        self.height: typing.Optional[int] = None
+        self.frames: typing.Optional[int] = None
+        self.fingerprint: typing.Optional[str] = None
+
+    def __repr__(self) -> str:
+        return "FileRecord({})".format(", ".join(f"{key}={getattr(self, key)!r}" for key in self.__slots__))
+
+
+def statFile(filepath: str) -> tuple[int, float]:
+    """(size, mtime) of a file, or of an image inside an archive.
+
+    Raises:
+        FileNotFoundError: If filepath doesn't exist
+    """
+    try:
+        stat = os.stat(filepath)
+    except (FileNotFoundError, NotADirectoryError) as e:
+        if archives.cache.archiveOf(filepath) is None:
+            raise FileNotFoundError(filepath) from e
+        return archives.cache.stat(filepath)
+    return stat.st_size, stat.st_mtime
+
+
+def _skipGifSubBlocks(fp) -> None:
+    while True:
+        length = fp.read(1)
+        if not length or length[0] == 0:
+            return
+        fp.seek(length[0], os.SEEK_CUR)
+
+
+def _probePng(fp) -> tuple[int, int, int]:
+    """Size from IHDR, and frame count from acTL if the PNG is animated. Stops at the first IDAT."""
+    fp.seek(len(PNG_SIGNATURE))
+    width = height = 0
+    frames = 1
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:  # noqa: PLR2004
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IHDR":
+            width, height = struct.unpack(">II", fp.read(8))
+            length -= 8
+        elif chunk_type == b"acTL":
+            (frames,) = struct.unpack(">I", fp.read(4))
+            length -= 4
+        elif chunk_type == b"IDAT":
+            break
+        fp.seek(length + 4, os.SEEK_CUR)  # Rest of chunk, then CRC
+    return width, height, frames
+
+
+def _probeGif(fp) -> tuple[int, int, int]:
+    """Size from the logical screen descriptor, and frames by walking the block structure.
+    Image data is skipped, never decoded.
+    """
+    fp.seek(6)
+    width, height, flags = struct.unpack("<HHB", fp.read(5))
+    fp.seek(2, os.SEEK_CUR)
+    if flags & 0x80:
+        fp.seek(3 << ((flags & 0x07) + 1), os.SEEK_CUR)  # Global color table
+
+    frames = 0
+    while True:
+        introducer = fp.read(1)
+        if not introducer or introducer == b";":
+            break
+        if introducer == b"!":
+            fp.seek(1, os.SEEK_CUR)  # Extension label
+            _skipGifSubBlocks(fp)
+        elif introducer == b",":
+            frames += 1
+            descriptor = fp.read(9)
+            if len(descriptor) < 9:  # noqa: PLR2004
+                break
+            if descriptor[8] & 0x80:
+                fp.seek(3 << ((descriptor[8] & 0x07) + 1), os.SEEK_CUR)  # Local color table
+            fp.seek(1, os.SEEK_CUR)  # LZW minimum code size
+            _skipGifSubBlocks(fp)
+        else:
+            break  # Corrupt; count what we have
+    return width, height, max(frames, 1)
+
+
+def _openBinary(filepath: str) -> typing.IO[bytes]:
+    """Open a real file or an archive member for reading bytes."""
+    if archives.cache.archiveOf(filepath):
+        return archives.cache.open(filepath)
+    return open(filepath, "rb")  # noqa: SIM115
+
+
+def probeImage(filepath: str) -> tuple[int, int, int]:
+    """Read an image's width, height and frame count from its headers.
+    PNG and GIF are parsed directly; other formats use PIL's lazy open,
+    which also stops at the header. The file is always closed.
+
+    Returns:
+        (int, int, int): width, height, frames
+
+    Raises:
+        OSError: If the file can't be read or isn't an image
+    """
+    with _openBinary(filepath) as fp:
+        signature = fp.read(8)
+        try:
+            if signature == PNG_SIGNATURE:
+                return _probePng(fp)
+            if signature[:6] in GIF_SIGNATURES:
+                return _probeGif(fp)
+        except struct.error as e:
+            raise OSError(f"Truncated header in '{filepath}'") from e
+        fp.seek(0)
+        with Image.open(fp) as image:
+            return (*image.size, getattr(image, "n_frames", 1))
+
+
+def probeFile(record: FileRecord) -> None:
+    """Fill in record's dimensions and frame count from the file's headers."""
+    (_filename, fileext) = os.path.splitext(record.path)
+    fileext = fileext.lower()
+    width = height = 0
+    frames = 1
+    try:
+        if fileext in _IMAGEEXTS:
+            width, height, frames = probeImage(record.path)
+        elif fileext in _VIDEOEXTS:
+            capture = cv2.VideoCapture(record.path)
+            try:
+                width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+                height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            finally:
+                capture.release()
+    except (OSError, cv2.error, UnidentifiedImageError):
+        logger.warning(f"Can't read dimensions of '{record.path}'", exc_info=True)
+    record.width, record.height, record.frames = width, height, frames
+
+
+class FileRecordStore(object):
+    """Thread-safe, size-bounded map of path to FileRecord, least recently used out first.
+
+    Stat info comes free with directory scans. Dimensions, frame counts and
+    hashes are read on first use and kept, so each file is opened at most
+    once for metadata however many sort keys, labels and overlays ask.
+    Use `fresh` where a changed file must not show stale data.
+    """
+
+    def __init__(self, max_entries: int = MAX_RECORDS) -> None:
+        super().__init__()
+        self.max_entries: int = max_entries
+        self._records: collections.OrderedDict[str, FileRecord] = collections.OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def get(self, filepath: str) -> FileRecord:
+        """The record for filepath, stat'ing the file if it's new.
+
+        Raises:
+            FileNotFoundError: If filepath isn't known and doesn't exist
+        """
+        with self._lock:
+            record = self._records.get(filepath)
+            if record is not None:
+                self._records.move_to_end(filepath)
+                return record
+        size, mtime = statFile(filepath)
+        return self._put(FileRecord(filepath, size=size, mtime=mtime), replace=False)
+
+    def fresh(self, filepath: str) -> FileRecord:
+        """Like get, but replaces the record if the file changed since it was made. Costs one stat.
+
+        Raises:
+            FileNotFoundError: If filepath doesn't exist
+        """
+        size, mtime = statFile(filepath)
+        with self._lock:
+            record = self._records.get(filepath)
+            if record is not None and record.mtime == mtime and record.size == size:
+                self._records.move_to_end(filepath)
+                return record
+        return self._put(FileRecord(filepath, size=size, mtime=mtime), replace=True)
+
+    def _put(self, record: FileRecord, replace: bool) -> FileRecord:
+        with self._lock:
+            if not replace:
+                existing = self._records.get(record.path)
+                if existing is not None:
+                    return existing
+            self._records[record.path] = record
+            self._records.move_to_end(record.path)
+            while len(self._records) > self.max_entries:
+                self._records.popitem(last=False)
+        return record
+
+    def discard(self, filepath: str) -> None:
+        """Forget filepath, e.g. because it changed or moved."""
+        with self._lock:
+            self._records.pop(filepath, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._records.clear()
+
+    def scan(self, dirpaths: typing.Iterable[str], patterns: typing.Iterable[str]) -> list[str]:
+        """List the files in dirpaths whose names match any of patterns, like glob.
+        Every match gets a record, filled in from the directory listing.
+
+        Args:
+            dirpaths (Iterable<str>): Directories to list; missing ones are skipped
+            patterns (Iterable<str>): Filename globs, like "*.png"
+
+        Returns:
+            list<str>: Matching file paths
+        """
+        patterns = list(patterns)
+        found: list[str] = []
+        for dirpath in dirpaths:
+            try:
+                with os.scandir(dirpath) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                # glob's wildcards don't match a leading dot
+                if entry.name.startswith(".") or not any(fnmatch.fnmatch(entry.name, pattern) for pattern in patterns):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                filepath = os.path.join(dirpath, entry.name)
+                with self._lock:
+                    old = self._records.get(filepath)
+                if old is None or old.mtime != stat.st_mtime or old.size != stat.st_size:
+                    self._put(FileRecord(filepath, size=stat.st_size, mtime=stat.st_mtime), replace=True)
+                found.append(filepath)
+        return found
+
+    def size(self, filepath: str) -> int:
+        return self.get(filepath).size  # type: ignore[return-value]
+
+    def mtime(self, filepath: str) -> float:
+        return self.get(filepath).mtime  # type: ignore[return-value]
+
+    def dimensions(self, filepath: str) -> tuple[int, int]:
+        record = self.get(filepath)
+        if record.width is None:
+            probeFile(record)
+        return (record.width, record.height)  # type: ignore[return-value]
+
+    def frames(self, filepath: str) -> int:
+        record = self.get(filepath)
+        if record.frames is None:
+            probeFile(record)
+        return record.frames  # type: ignore[return-value]
+
+    def pixels(self, filepath: str) -> int:
+        width, height = self.dimensions(filepath)
+        return width * height
+
+    def fingerprint(self, filepath: str) -> str:
+        record = self.get(filepath)
+        if record.fingerprint is None:
+            record.fingerprint = sortcore.fingerprintImage(filepath)
+        return record.fingerprint
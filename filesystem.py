@@ -1,8 +1,14 @@
 # File handling
 
+import bisect
+import ctypes
+import errno
+import json
 import os
 import re
 import shutil
+import stat
+import sys
 
 from binascii import crc32
 from os import path
@@ -11,8 +17,10 @@ from collections import namedtuple
 from tempfile import _RandomNameSequence  # type: ignore[attr-defined]
 from loom import Spool
 
+import instrument
+
 from distutils.dir_util import copy_tree
-from typing import Callable
+from typing import Any, Callable, IO, Iterable, Iterator, Optional
 
 import logging
 logger = logging.getLogger(__name__)
@@ -48,6 +56,7 @@ class Trash(object):
     Attributes:
         queue_size (TYPE): Maximum length of the trash queue before committing disk operations
         trash_queue (list): List of files to be deleted
+        trashed_paths (set): Paths in trash_queue, for constant-time membership checks
         verbose (bool): Print verbose output
     """
     
@@ -60,6 +69,7 @@ class Trash(object):
         self.queue_size: int = queue_size
 
         self.trash_queue: list[TrashEntry] = []
+        self.trashed_paths: set[str] = set()
         try:
             import send2trash  # noqa: PLC0415
             self._osTrash: Callable[[str], None] = send2trash.send2trash
@@ -82,12 +92,20 @@ class Trash(object):
         while len(self.trash_queue) > self.queue_size:
             self.commitDelete(self.trash_queue[0])
 
+    def __contains__(self, path):
+        return os.path.normpath(path) in self.trashed_paths
+
     def isfile(self, path):
-        if os.path.normpath(path) in [t[0] for t in self.trash_queue]:
+        if path in self:
             return False
         else:
             return os.path.isfile(path)
 
+    def _trashNow(self, path):
+        """Send path to the OS trash. Runs on the trash spool."""
+        self._osTrash(path)
+
+    @instrument.timed("trash commit")
     def commitDelete(self, trashitem):
         crc = trashitem.crc
         path = trashitem.path
@@ -95,7 +113,7 @@ class Trash(object):
         if os.path.isdir(path):
             crc = "DIRECTORY"
 
-            self._spool.enqueue(self._osTrash, args=(path,))
+            self._spool.enqueue(self._trashNow, args=(path,))
             
             if self.verbose:
                 logger.info("{} --> {} --> {}".format("[SNIPTRASH]", trashitem, "[OS TRASH]"))
@@ -105,7 +123,7 @@ class Trash(object):
                 logger.warning("File changed. Not deleting file '%s'" % path)
                 return
 
-            self._spool.enqueue(self._osTrash, args=(path,))
+            self._spool.enqueue(self._trashNow, args=(path,))
             
             if self.verbose:
                 logger.info("{} --> {} --> {}".format("[SNIPTRASH]", trashitem, "[OS TRASH]"))
@@ -115,12 +133,13 @@ class Trash(object):
         
         if trashitem in self.trash_queue:
             self.trash_queue.remove(trashitem)
+            self.trashed_paths.discard(trashitem.path)
         else:
             logger.warning(f"deleted file '{path}' not in trash!")
 
     def delete(self, path, rename=False):
         path = os.path.normpath(path)
-        if path in {item.path for item in self.trash_queue}:
+        if path in self.trashed_paths:
             logger.warning(f"attempted to delete already trashed file '{path}'")
             return False
         elif os.path.isdir(path):
@@ -147,6 +166,7 @@ class Trash(object):
                 crc=CRC32file(path)
             )
         self.trash_queue.append(entry)
+        self.trashed_paths.add(entry.path)
         if self.verbose:
             logger.info("{} --> {}".format(entry, "[SNIPTRASH]"))
         self.enforceQueueSize()
@@ -154,7 +174,7 @@ class Trash(object):
 
     def deleteDir(self, path):
         path = os.path.normpath(path)
-        if path in {item.path for item in self.trash_queue}:
+        if path in self.trashed_paths:
             logger.warning(f"attempted to delete already trashed directory '{path}'")
             return False
 
@@ -163,6 +183,7 @@ class Trash(object):
             crc="DIRECTORY"
         )
         self.trash_queue.append(entry)
+        self.trashed_paths.add(entry.path)
         if self.verbose:
             logger.info("{} --> {}".format(entry, "[SNIPTRASH]"))
         self.enforceQueueSize()
@@ -171,6 +192,7 @@ class Trash(object):
     def undo(self):
         if self.trash_queue:
             entry = self.trash_queue.pop()
+            self.trashed_paths.discard(entry.path)
             if self.verbose:
                 logger.info("{} <-- {}".format(entry, "[SNIPTRASH]"))
             if entry.orig_path:
@@ -192,6 +214,196 @@ class Trash(object):
         self._spool.finish()
 
 
+class FolderIndex(object):
+    """Cached index of a directory tree, built from os.scandir walks.
+
+    Each directory is scanned at most once until it is invalidated, so
+    switching between shallow and deep views of the same tree is free.
+
+    Attributes:
+        children (dict): Map of directory path to sorted list of subdirectory names
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.children: dict[str, list[str]] = {}
+
+    @staticmethod
+    def _key(dirpath: str) -> str:
+        return os.path.normpath(dirpath)
+
+    def listdirs(self, dirpath: str) -> list[str]:
+        """Names of the (non-hidden) subdirectories of dirpath, scanning if needed."""
+        key = self._key(dirpath)
+        names = self.children.get(key)
+        if names is None:
+            names = []
+            try:
+                with os.scandir(key) as it:
+                    for entry in it:
+                        if entry.name.startswith("."):
+                            continue
+                        try:
+                            if entry.is_dir():
+                                names.append(entry.name)
+                        except OSError:
+                            continue
+            except OSError:
+                pass
+            names.sort()
+            self.children[key] = names
+        return names
+
+    def walk(self, root: str, depth: int) -> list[str]:
+        """All directories exactly `depth` levels below root, like glob("root/*/*/").
+
+        Returned paths have a trailing separator, matching glob's output.
+        """
+        found = [root]
+        for _ in range(depth):
+            found = [
+                path.join(parent, name)
+                for parent in found
+                for name in self.listdirs(parent)
+            ]
+        return [path.join(p, "") for p in found]
+
+    def add(self, dirpath: str) -> bool:
+        """Record a new directory (and any new ancestors) without rescanning.
+        The directory doesn't have to exist on disk yet.
+
+        Returns:
+            bool: True if the index changed
+        """
+        key = self._key(dirpath)
+        parent, name = path.split(key)
+        if not name or parent == key:
+            return False
+        names = self.children.get(parent)
+        if names is None:
+            # Parent's contents are unknown, so it will be scanned when needed.
+            return self.add(parent)
+        if name in names:
+            return False
+        bisect.insort(names, name)
+        return True
+
+    def invalidate(self, dirpath=None) -> None:
+        """Forget cached scans of dirpath, or everything if no path is given."""
+        if dirpath is None:
+            self.children.clear()
+        else:
+            self.children.pop(self._key(dirpath), None)
+
+
+SUFFIX_REGEX = re.compile(r"^(.*) \((\d+)\)$")
+
+
+class NameIndex(object):
+    """In-memory snapshot of the names in each directory, for planning moves without touching disk.
+
+    Directories are scanned once, on first use. Names are stored normcased,
+    so lookups follow the platform's case sensitivity. Alongside the names,
+    each directory keeps the highest " (n)" suffix in use for every base
+    name, so a free numbered name is found in one lookup however many
+    variants already exist.
+
+    Attributes:
+        names (dict): Map of directory path to the set of names in it
+        suffixes (dict): Map of directory path to {(stem, ext): highest n}
+        missing (set): Directories that didn't exist when scanned
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.names: dict[str, set[str]] = {}
+        self.suffixes: dict[str, dict[tuple[str, str], int]] = {}
+        self.missing: set[str] = set()
+
+    @staticmethod
+    def _key(dirpath: str) -> str:
+        return path.normcase(path.normpath(dirpath))
+
+    @staticmethod
+    def _suffixKey(name: str) -> Optional[tuple[tuple[str, str], int]]:
+        stem, ext = path.splitext(name)
+        match = SUFFIX_REGEX.match(stem)
+        if match is None:
+            return None
+        return (match.group(1), ext), int(match.group(2))
+
+    def _scan(self, key: str) -> set[str]:
+        names: set[str] = set()
+        suffixes: dict[tuple[str, str], int] = {}
+        try:
+            with os.scandir(key) as it:
+                names.update(path.normcase(entry.name) for entry in it)
+        except FileNotFoundError:
+            self.missing.add(key)
+        except OSError:
+            pass
+        for name in names:
+            found = self._suffixKey(name)
+            if found and found[1] > suffixes.get(found[0], 0):
+                suffixes[found[0]] = found[1]
+        self.names[key] = names
+        self.suffixes[key] = suffixes
+        return names
+
+    def listnames(self, dirpath: str) -> set[str]:
+        """Normcased names of all entries in dirpath, scanning if needed."""
+        key = self._key(dirpath)
+        names = self.names.get(key)
+        if names is None:
+            names = self._scan(key)
+        return names
+
+    def isdir(self, dirpath: str) -> bool:
+        """Whether dirpath exists in the snapshot."""
+        self.listnames(dirpath)
+        return self._key(dirpath) not in self.missing
+
+    def exists(self, filepath: str) -> bool:
+        dirpath, name = path.split(filepath)
+        return path.normcase(name) in self.listnames(dirpath)
+
+    def add(self, filepath: str) -> None:
+        dirpath, name = path.split(filepath)
+        name = path.normcase(name)
+        self.listnames(dirpath).add(name)
+        key = self._key(dirpath)
+        self.missing.discard(key)
+        found = self._suffixKey(name)
+        if found and found[1] > self.suffixes[key].get(found[0], 0):
+            self.suffixes[key][found[0]] = found[1]
+
+    def discard(self, filepath: str) -> None:
+        # Suffix high-water marks are kept; reusing a freed number isn't worth a rescan.
+        dirpath, name = path.split(filepath)
+        self.listnames(dirpath).discard(path.normcase(name))
+
+    def invalidate(self, dirpath=None) -> None:
+        """Forget cached scans of dirpath, or everything if no path is given."""
+        if dirpath is None:
+            self.names.clear()
+            self.suffixes.clear()
+            self.missing.clear()
+        else:
+            key = self._key(dirpath)
+            self.names.pop(key, None)
+            self.suffixes.pop(key, None)
+            self.missing.discard(key)
+
+    def freeName(self, filepath: str) -> str:
+        """filepath if nothing is there, otherwise "stem (n).ext" with n one past the highest in use."""
+        if not self.exists(filepath):
+            return filepath
+        dirpath, name = path.split(filepath)
+        stem, ext = path.splitext(name)
+        n = self.suffixes[self._key(dirpath)].get((path.normcase(stem), path.normcase(ext)), 0) + 1
+        return path.join(dirpath, f"{stem} ({n}){ext}")
+
+
 def easySlug(string, repl="-", directory=False):
     if directory:
         return re.sub(r"^\.|\.+$", "", easySlug(string, repl=repl, directory=False))
@@ -232,7 +444,7 @@ def renameFileOnly(source, destination, clobber=False, quiet=False, preserve_ext
         new_name = new_name_base + new_ext + old_ext
 
     real_destination = path.join(old_dir, new_name)
-    return opFileToFile(shutil.move, source, real_destination, clobber, quiet)
+    return moveFileToFile(source, real_destination, clobber, quiet)
 
 
 def opFileToDir(op, source, destination, clobber, quiet):
@@ -268,6 +480,107 @@ def opDirWithMerge(op, source, destination, clobber, quiet):
     return _doFileOp(op, source, destination, quiet)
 
 
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+
+def _loadRenameat2():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        # Old glibc, musl, etc.
+        return None
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    renameat2.restype = ctypes.c_int
+    return renameat2
+
+
+_renameat2 = _loadRenameat2()
+
+
+def renameNoReplace(source: str, destination: str) -> str:
+    """Atomically renames `source` to `destination`, never overwriting an existing path.
+    Both paths must be on the same filesystem.
+
+    Uses renameat2(RENAME_NOREPLACE) where available. Windows renames never
+    replace, so os.rename is already correct there. Otherwise files are
+    hard-linked then unlinked, and directories fall back to a checked rename.
+
+    Returns:
+        str: Destination path
+
+    Raises:
+        FileExistsError: If destination exists
+    """
+    if os.name == "nt":
+        os.rename(source, destination)
+        return destination
+
+    if _renameat2 is not None:
+        if _renameat2(AT_FDCWD, os.fsencode(source), AT_FDCWD, os.fsencode(destination), RENAME_NOREPLACE) == 0:
+            return destination
+        err = ctypes.get_errno()
+        if err not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP):
+            raise OSError(err, os.strerror(err), source, None, destination)
+        # Filesystem doesn't support the flag; fall through
+
+    if not path.isdir(source):
+        try:
+            os.link(source, destination)
+        except FileExistsError:
+            raise
+        except OSError:
+            pass  # No hard links here; fall through
+        else:
+            os.unlink(source)
+            return destination
+
+    if path.lexists(destination):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), destination)
+    os.rename(source, destination)
+    return destination
+
+
+def _sameDevice(source_stat: os.stat_result, destination_dir: str) -> bool:
+    """Whether destination_dir is on the same device as the stat'd source.
+
+    Raises:
+        FileNotFoundError: If destination_dir doesn't exist
+    """
+    return os.stat(destination_dir or os.curdir).st_dev == source_stat.st_dev
+
+
+def _fileStat(source: str) -> os.stat_result:
+    """stat() a source file, raising like _safetyChecks if it isn't one."""
+    source_stat = os.stat(source)
+    if not stat.S_ISREG(source_stat.st_mode):
+        raise FileNotFoundError(source)
+    return source_stat
+
+
+def _mergeByRename(source: str, destination: str) -> list[str]:
+    """Merges directory source into destination using renames only.
+    Existing files in destination are replaced. Same filesystem only.
+
+    Returns:
+        list: Destination paths of moved files
+    """
+    moved: list[str] = []
+    with os.scandir(source) as it:
+        entries = list(it)
+    for entry in entries:
+        target = path.join(destination, entry.name)
+        if entry.is_dir(follow_symlinks=False) and path.isdir(target):
+            moved += _mergeByRename(entry.path, target)
+        else:
+            os.replace(entry.path, target)
+            moved.append(target)
+    os.rmdir(source)
+    return moved
+
+
 def _pathsExistCheck(source_file, destination_dir):
     """Raises an error if source_file is bigger than destination_dir's free space
     
@@ -313,6 +626,25 @@ def _doFileOp(op, source: str, destination: str, quiet):
         raise
 
 
+def _tryRename(rename, source: str, destination: str, quiet) -> Optional[Any]:
+    """Runs a rename op like _doFileOp, but returns None if the rename turns out to
+    cross filesystems (EXDEV), so the caller can copy instead. Matching st_dev is
+    only a hint: bind mounts and container volumes of one filesystem share it,
+    but can't be renamed across.
+    """
+    try:
+        result = rename(source, destination)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            return None
+        if not quiet:
+            logger.error("{} -x> {}".format(source, destination), exc_info=True)
+        raise
+    if not quiet:
+        logger.info("{} --> {}".format(source, destination))
+    return result
+
+
 def copyFileToDir(source: str, destination: str, clobber=False, quiet=False):
     """Copies file `source` to folder `destination`.
 
@@ -374,14 +706,23 @@ def copyDirWithMerge(source: str, destination: str, clobber=False, quiet=False):
 
 
 def _copyTreeAndRemove(source: str, destination: str):
-    """Summary
+    """Copies a tree, checks every copied file landed intact, then removes the source.
 
     Args:
-        source (TYPE): Description
-        destination (TYPE): Description
+        source (str): Source directory
+        destination (str): Destination directory
+
+    Raises:
+        OSError: If a copied file doesn't match its source. The source is left in place.
     """
     result = copy_tree(source, destination)
-    os.unlink(source)
+    for source_dir, _dirs, files in os.walk(source):
+        for filename in files:
+            source_file = path.join(source_dir, filename)
+            copied_file = path.join(destination, path.relpath(source_file, source))
+            if path.getsize(source_file) != path.getsize(copied_file):
+                raise OSError(f"Copy verification failed: '{source_file}' -> '{copied_file}'")
+    shutil.rmtree(source)
     return result
 
 
@@ -397,6 +738,12 @@ def moveFileToDir(source: str, destination: str, clobber=False, quiet=False):
     Returns:
         str: Destination path
     """
+    source_stat = _fileStat(source)
+    if _sameDevice(source_stat, destination):
+        new_file_path = path.join(destination, path.basename(source))
+        result = _tryRename(os.replace if clobber else renameNoReplace, source, new_file_path, quiet)
+        if result is not None:
+            return result
     return opFileToDir(shutil.move, source, destination, clobber, quiet)
 
 
@@ -412,6 +759,12 @@ def moveFileToFile(source: str, destination: str, clobber=False, quiet=False):
     Returns:
         str: Destination path
     """
+    assert source != destination, "Paths are the same! " + source
+    source_stat = _fileStat(source)
+    if _sameDevice(source_stat, path.dirname(destination)):
+        result = _tryRename(os.replace if clobber else renameNoReplace, source, destination, quiet)
+        if result is not None:
+            return result
     return opFileToFile(shutil.move, source, destination, clobber, quiet)
 
 
@@ -427,6 +780,11 @@ def moveDirToParent(source: str, destination: str, clobber=False, quiet=False):
     Returns:
         str: Destination path
     """
+    if _sameDevice(os.stat(source), destination):
+        new_dir_path = path.join(destination, path.basename(path.normpath(source)))
+        result = _tryRename(renameNoReplace, source, new_dir_path, quiet)
+        if result is not None:
+            return result
     return opDirToParent(shutil.move, source, destination, clobber, quiet)
 
 
@@ -442,5 +800,108 @@ def moveDirWithMerge(source: str, destination: str, clobber=False, quiet=False):
     Returns:
         list: Destination paths
     """
+    if path.isdir(source) and _sameDevice(os.stat(source), path.dirname(path.normpath(destination))):
+        result = _tryRename(
+            _mergeByRename if clobber and path.isdir(destination) else renameNoReplace, source, destination, quiet
+        )
+        if result is not None:
+            return result
     return opDirWithMerge(_copyTreeAndRemove, source, destination, clobber, quiet)
 
+
+PLAN_MOVE = "move"
+PLAN_RENAME = "rename"
+
+CONFLICT_SUFFIXED = "suffixed"
+CONFLICT_DISPLACED = "displaced"
+
+
+def planMoves(moves: Iterable[tuple[str, str]], names: Optional[NameIndex] = None, displace=False) -> Iterator[dict]:
+    """Decide exactly what moving each (source, destination) file pair will do, without touching disk.
+
+    Conflicts are resolved like the sorter's rename: the incoming file gets
+    a " (n)" suffix, or if `displace` is set, the file already there is
+    renamed to "name_displaced" first. Each decision is applied to `names`,
+    so later moves see the tree as earlier ones leave it.
+
+    Args:
+        moves (Iterable<(str, str)>): Source and requested destination file paths
+        names (NameIndex, optional): Snapshot of the tree to plan against
+        displace (bool, optional): Move conflicting files aside instead of renaming the new one
+
+    Yields:
+        dict: Plan records with op, source, destination, makedirs and conflict keys
+    """
+    if names is None:
+        names = NameIndex()
+
+    for source, destination in moves:
+        if path.normcase(path.normpath(source)) == path.normcase(path.normpath(destination)):
+            continue
+        makedirs = not names.isdir(path.dirname(destination))
+        conflict = None
+        if names.exists(destination):
+            if displace:
+                stem, ext = path.splitext(destination)
+                displaced = names.freeName(stem + "_displaced" + ext)
+                yield {
+                    "op": PLAN_RENAME, "source": destination, "destination": displaced,
+                    "makedirs": False, "conflict": None
+                }
+                names.discard(destination)
+                names.add(displaced)
+                conflict = CONFLICT_DISPLACED
+            else:
+                destination = names.freeName(destination)
+                conflict = CONFLICT_SUFFIXED
+        yield {
+            "op": PLAN_MOVE if path.dirname(source) != path.dirname(destination) else PLAN_RENAME,
+            "source": source, "destination": destination,
+            "makedirs": makedirs, "conflict": conflict
+        }
+        names.discard(source)
+        names.add(destination)
+
+
+def writePlan(records: Iterable[dict], fp: IO[str]) -> Iterator[dict]:
+    """Stream plan records to fp as JSON Lines, passing each one through."""
+    for record in records:
+        fp.write(json.dumps(record) + "\n")
+        yield record
+    fp.flush()
+
+
+def readPlan(fp: IO[str]) -> Iterator[dict]:
+    for line in fp:
+        if line.strip():
+            yield json.loads(line)
+
+
+def planChains(records: list[dict]) -> list[list[dict]]:
+    """Split a plan into chains that can run in parallel.
+
+    Records that share a destination directory, or where one's source or
+    destination is another's, stay in the same chain, in plan order.
+    """
+    parents: dict = {}
+
+    def find(key):
+        parents.setdefault(key, key)
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    def keys(record):
+        norm = lambda p: path.normcase(path.normpath(p))  # noqa: E731
+        return [("dir", norm(path.dirname(record["destination"]))), norm(record["source"]), norm(record["destination"])]
+
+    for record in records:
+        first, *rest = keys(record)
+        for key in rest:
+            parents[find(key)] = find(first)
+
+    chains: dict = {}
+    for record in records:
+        chains.setdefault(find(keys(record)[0]), []).append(record)
+    return list(chains.values())
@@ -0,0 +1,152 @@
+# Timing spans for the hot paths, summarised as percentiles
+
+import os
+import time
+import threading
+import contextlib
+import functools
+import collections
+
+import typing
+
+import logging
+logger = logging.getLogger(__name__)
+
+ENV_VAR = "SORT_INSTRUMENT"
+ENV_OFF = {"", "0", "false", "no", "off"}
+HISTORY = 1000  # Most recent samples kept per span
+DUMP_INTERVAL = 60.0  # Seconds
+PERCENTILES = (50, 90, 99)
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class _Span(object):
+    __slots__ = ("recorder", "name", "start")
+
+    def __init__(self, recorder: "Recorder", name: str) -> None:
+        self.recorder = recorder
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type_, value, traceback) -> None:
+        self.recorder.record(self.name, time.perf_counter() - self.start)
+
+
+class Recorder(object):
+    """Collects how long named spans of work take.
+
+    While disabled, `span` hands out a shared do-nothing context manager,
+    so instrumented code pays one attribute check and nothing else.
+
+    Usage:
+        with instrument.span("decode"):
+            ...
+    """
+
+    def __init__(self, history: int = HISTORY, enabled: bool = False) -> None:
+        super().__init__()
+        self.history: int = history
+        self.enabled: bool = enabled
+        self._samples: dict[str, collections.deque[float]] = {}
+        self._counts: collections.Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+        self._dump_timer: typing.Optional[threading.Timer] = None
+
+    def span(self, name: str) -> typing.ContextManager:
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = collections.deque(maxlen=self.history)
+            samples.append(seconds)
+            self._counts[name] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Percentiles and maximum of each span's recent samples, in milliseconds,
+        and how many times it has run in total.
+        """
+        with self._lock:
+            snapshot = {name: sorted(samples) for name, samples in self._samples.items()}
+            counts = dict(self._counts)
+        result: dict[str, dict[str, float]] = {}
+        for name, samples in snapshot.items():
+            stats: dict[str, float] = {"count": counts[name]}
+            for p in PERCENTILES:
+                stats[f"p{p}"] = samples[min(len(samples) - 1, len(samples) * p // 100)] * 1000
+            stats["max"] = samples[-1] * 1000
+            result[name] = stats
+        return result
+
+    def format(self) -> str:
+        """summary as an aligned table, slowest p90 first."""
+        summary = self.summary()
+        if not summary:
+            return "No timings yet"
+        width = max(map(len, summary))
+        header = "{:<{w}} {:>7} ".format("span", "count", w=width) + " ".join(
+            f"{'p' + str(p):>7}" for p in PERCENTILES
+        ) + f" {'max':>7}"
+        lines = [header]
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]["p90"]):
+            lines.append(
+                "{:<{w}} {:>7} ".format(name, int(stats["count"]), w=width)
+                + " ".join(f"{stats[f'p{p}']:7.1f}" for p in PERCENTILES)
+                + f" {stats['max']:7.1f}"
+            )
+        return "\n".join(lines)
+
+    def startDumping(self, interval: float = DUMP_INTERVAL) -> None:
+        """Log the summary every interval seconds, on a daemon thread, while enabled."""
+        def _dump() -> None:
+            if self.enabled:
+                logger.info("Timings (ms):\n" + self.format())
+            self.startDumping(interval)
+
+        self.stopDumping()
+        self._dump_timer = threading.Timer(interval, _dump)
+        self._dump_timer.daemon = True
+        self._dump_timer.start()
+
+    @property
+    def dumping(self) -> bool:
+        return self._dump_timer is not None
+
+    def stopDumping(self) -> None:
+        if self._dump_timer is not None:
+            self._dump_timer.cancel()
+            self._dump_timer = None
+
+
+recorder = Recorder(enabled=os.environ.get(ENV_VAR, "").strip().lower() not in ENV_OFF)
+
+
+def span(name: str) -> typing.ContextManager:
+    """A timing span on the shared recorder. See Recorder."""
+    return recorder.span(name)
+
+
+def timed(name: str) -> typing.Callable:
+    """Decorator that times every call of a function as a span."""
+    def decorator(fn: typing.Callable) -> typing.Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not recorder.enabled:
+                return fn(*args, **kwargs)
+            with _Span(recorder, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
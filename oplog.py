@@ -0,0 +1,573 @@
+# Journaled file operations
+
+import os
+import sys
+import json
+import itertools
+import uuid
+import threading
+import collections
+import concurrent.futures
+from dataclasses import dataclass, field
+
+import filesystem
+import instrument
+
+from typing import Callable, Iterable, Optional
+
+import logging
+logger = logging.getLogger(__name__)
+
+OP_MOVE = "move"
+OP_RENAME = "rename"
+OP_TRASH = "trash"
+
+STATE_PENDING = "pending"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+STATE_CANCELLED = "cancelled"
+
+JOURNAL_COMPACT_LINES = 1000
+JOURNAL_EXT = ".jsonl"
+LOCK_EXT = ".lock"
+DEFAULT_JOURNAL_DIR = os.path.join(filesystem.userProfile(), ".sorter_journal")
+
+
+@dataclass
+class Operation:
+    """A single file operation.
+
+    Attributes:
+        kind (str): One of OP_MOVE, OP_RENAME, OP_TRASH
+        source (str): Path of the file being operated on
+        destination (str): Full destination path (unused for OP_TRASH)
+        makedirs (bool): Create the destination's folder if it doesn't exist
+        callback (callable): Called as callback(op, exception_or_None) after the operation runs
+        id (int): Assigned by the executor
+        state (str): One of the STATE_ constants, maintained by the executor
+        batch (int): Journal batch the operation was recorded in, once it has been
+    """
+    kind: str
+    source: str
+    destination: Optional[str] = None
+    makedirs: bool = False
+    callback: Optional[Callable[["Operation", Optional[BaseException]], None]] = field(default=None, repr=False, compare=False)
+    id: int = 0
+    state: str = field(default=STATE_PENDING, compare=False)
+    batch: Optional[int] = field(default=None, compare=False)
+
+    def asRecord(self) -> dict:
+        return {"id": self.id, "kind": self.kind, "source": self.source, "destination": self.destination, "makedirs": self.makedirs}
+
+    def run(self) -> None:
+        if self.kind in (OP_MOVE, OP_RENAME):
+            if self.destination is None:
+                raise ValueError(f"{self.kind} of '{self.source}' has no destination")
+            if self.makedirs:
+                os.makedirs(os.path.dirname(self.destination), exist_ok=True)
+            filesystem.moveFileToFile(self.source, self.destination)
+        else:
+            raise ValueError(f"Operation kind {self.kind!r} can't run directly")
+
+
+def _tryLock(fp) -> bool:
+    """Take an exclusive lock on an open file without waiting.
+
+    Returns:
+        bool: Whether the lock was taken. It's held until fp is closed.
+    """
+    try:
+        if sys.platform == "win32":
+            import msvcrt  # noqa: PLC0415
+            fp.seek(0)
+            msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl  # noqa: PLC0415
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def operationFromPlan(record: dict, callback=None) -> Operation:
+    """Turn a filesystem.planMoves record into an Operation."""
+    kind = OP_RENAME if record["op"] == filesystem.PLAN_RENAME else OP_MOVE
+    return Operation(
+        kind=kind, source=record["source"], destination=record["destination"],
+        makedirs=record.get("makedirs", False), callback=callback
+    )
+
+
+class Journal(object):
+    """Append-only write-ahead log of file operations, stored as JSON lines.
+
+    A batch is written (and fsynced) before any of its operations run, and
+    marked finished afterwards. Batches without an end marker were interrupted
+    and are resolved by `recover`.
+
+    Each Journal writes its own file in a shared folder, and holds an
+    exclusive lock on it for as long as it's open, so several windows (or a
+    window and batchsort) never read, replay or truncate each other's
+    records. A journal file whose lock nobody holds was left by a process
+    that died, and is what `recover` replays.
+    """
+
+    def __init__(self, directory: str) -> None:
+        super().__init__()
+        self.directory: str = directory
+        self._lock = threading.Lock()
+        self._open_batches: set[int] = set()
+        self._lines_written: int = 0
+        self._batch_ids = itertools.count(1)
+
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            self.owner: str = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            try:
+                self._lockfp = open(self._lockPath(self.owner), "x", encoding="utf-8")  # noqa: SIM115
+            except FileExistsError:
+                continue
+            if _tryLock(self._lockfp):
+                break
+            self._lockfp.close()
+
+        self.path: str = self._journalPath(self.owner)
+        self._fp = open(self.path, "a", encoding="utf-8")  # noqa: SIM115
+
+    def _journalPath(self, owner: str) -> str:
+        return os.path.join(self.directory, owner + JOURNAL_EXT)
+
+    def _lockPath(self, owner: str) -> str:
+        return os.path.join(self.directory, owner + LOCK_EXT)
+
+    @staticmethod
+    def _readRecords(path: str) -> list[dict]:
+        records = []
+        try:
+            with open(path, "r", encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Torn write from a crash; everything after it is suspect too
+                        logger.warning(f"Truncated journal line in '{path}'")
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _write(self, record: dict, sync: bool) -> None:
+        record["owner"] = self.owner
+        self._fp.write(json.dumps(record) + "\n")
+        self._fp.flush()
+        if sync:
+            os.fsync(self._fp.fileno())
+        self._lines_written += 1
+
+    def begin(self, ops: list[Operation]) -> int:
+        """Durably record intent to run ops. Returns a batch id for `end`."""
+        records = []
+        for op in ops:
+            record = op.asRecord()
+            # Tells recovery whether a destination it finds was put there by this batch
+            record["existed"] = bool(op.destination) and os.path.lexists(op.destination)  # type: ignore[arg-type]
+            records.append(record)
+        with self._lock:
+            batch = next(self._batch_ids)
+            self._write({"batch": batch, "begin": records}, sync=True)
+            self._open_batches.add(batch)
+            return batch
+
+    def skip(self, batch: int, op_id: int) -> None:
+        """Mark one operation of a recorded batch as cancelled before it ran."""
+        with self._lock:
+            self._write({"batch": batch, "skip": op_id}, sync=True)
+
+    def end(self, batch: int) -> None:
+        """Mark a batch as finished."""
+        with self._lock:
+            self._write({"batch": batch, "end": True}, sync=False)
+            self._open_batches.discard(batch)
+            if not self._open_batches and self._lines_written > JOURNAL_COMPACT_LINES:
+                self._truncate()
+
+    def _truncate(self) -> None:
+        self._fp.seek(0)
+        self._fp.truncate()
+        self._lines_written = 0
+
+    @classmethod
+    def pending(cls, path: str) -> list[dict]:
+        """Operation records from batches in the journal file at path that
+        were started but never finished."""
+        begun: dict[tuple, list[dict]] = {}
+        skipped: set[tuple] = set()
+        for record in cls._readRecords(path):
+            key = (record.get("owner"), record["batch"])
+            if "begin" in record:
+                begun[key] = record["begin"]
+            elif "skip" in record:
+                skipped.add((*key, record["skip"]))
+            elif record.get("end"):
+                begun.pop(key, None)
+        return [
+            op
+            for key, ops in begun.items()
+            for op in ops
+            if (*key, op["id"]) not in skipped
+        ]
+
+    def recover(self, trash: Optional[Callable[[str], None]] = None) -> None:
+        """Resolve operations that dead processes left unfinished, then delete
+        their journals. Journals of processes that are still running are left
+        alone.
+
+        Moves whose source still exists and whose destination doesn't are
+        replayed. Moves that already landed are left alone. If both paths
+        exist and the destination wasn't there when the batch began, the move
+        was a copy across devices that stopped partway, so the partial copy is
+        deleted and the move replayed. If the destination was already there,
+        or neither path exists, it's only logged.
+        Interrupted trash operations are replayed with `trash`, if given.
+
+        Args:
+            trash (callable, optional): Function that sends a path to the OS trash
+        """
+        for filename in sorted(os.listdir(self.directory)):
+            owner, ext = os.path.splitext(filename)
+            if ext != JOURNAL_EXT or owner == self.owner:
+                continue
+            path, lockpath = self._journalPath(owner), self._lockPath(owner)
+            try:
+                lockfp = open(lockpath, "a+", encoding="utf-8")  # noqa: SIM115
+            except OSError:
+                logger.warning(f"Can't open lock for journal '{path}'", exc_info=True)
+                continue
+            try:
+                if not _tryLock(lockfp):
+                    continue  # Its process is still running
+                for record in self.pending(path):
+                    try:
+                        self._recoverOperation(record, trash)
+                    except Exception:
+                        logger.error(f"Failed to recover journaled operation {record}", exc_info=True)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass  # Another recover got here first
+            finally:
+                lockfp.close()
+            try:
+                os.unlink(lockpath)
+            except OSError:
+                pass  # Already gone, or taken by another recover, which removes it
+
+    @staticmethod
+    def _recoverOperation(record: dict, trash: Optional[Callable[[str], None]]) -> None:
+        source, destination = record["source"], record["destination"]
+        if record["kind"] == OP_TRASH:
+            if trash and os.path.exists(source):
+                logger.info(f"Replaying interrupted trash of '{source}'")
+                trash(source)
+            return
+
+        source_exists, destination_exists = os.path.isfile(source), os.path.isfile(destination)
+        if source_exists and destination_exists and not record.get("existed", True):
+            logger.info(f"Rolling back partial copy '{destination}' of interrupted {record['kind']}")
+            os.unlink(destination)
+            destination_exists = False
+
+        if source_exists and not destination_exists:
+            logger.info(f"Replaying interrupted {record['kind']} '{source}' -> '{destination}'")
+            if record.get("makedirs"):
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+            filesystem.moveFileToFile(source, destination)
+        elif destination_exists and not source_exists:
+            logger.debug(f"Interrupted {record['kind']} '{source}' -> '{destination}' already completed")
+        else:
+            logger.warning(f"Can't resolve interrupted {record['kind']} '{source}' -> '{destination}', leaving as-is")
+
+    def close(self) -> None:
+        """Close the journal. Its files are deleted unless batches are still
+        open, in which case they're left for a later `recover`."""
+        with self._lock:
+            self._fp.close()
+            clean = not self._open_batches
+            if clean:
+                os.unlink(self.path)
+            self._lockfp.close()
+            if clean:
+                try:
+                    os.unlink(self._lockPath(self.owner))
+                except OSError:
+                    pass  # Taken by a recover, which removes it
+
+
+class OperationExecutor(object):
+    """Runs file operations on a worker thread, in journaled batches.
+
+    Operations enqueued while the worker is busy are grouped into a single
+    batch, so a burst of moves costs one journal sync instead of one each.
+    Every operation gets an id, which can be used to cancel it (if it hasn't
+    started) or wait for just that operation.
+
+    Attributes:
+        journal (Journal): Write-ahead log, or None to run unjournaled
+        batch_size (int): Maximum number of operations per batch
+    """
+
+    def __init__(self, journal: Optional[Journal] = None, batch_size: int = 64) -> None:
+        super().__init__()
+        self.journal: Optional[Journal] = journal
+        self.batch_size: int = batch_size
+
+        self._ids = itertools.count(1)
+        self._queue: collections.deque[Operation] = collections.deque()
+        self._unfinished: dict[int, Operation] = {}  # Queued or in a running batch
+        self._followups: dict[int, list[Callable[[Operation, Optional[BaseException]], None]]] = {}
+        self._cond = threading.Condition()
+        self._busy: bool = False
+        self._stopping: bool = False
+
+        self._thread = threading.Thread(target=self._worker, name="OperationExecutor", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.finish()
+
+    def enqueue(self, op: Operation, urgent=False) -> int:
+        """Queue op to run in the background. Returns its operation id.
+
+        Args:
+            op (Operation): Operation to run
+            urgent (bool, optional): Run before everything already queued
+        """
+        with self._cond:
+            op.id = next(self._ids)
+            op.state = STATE_PENDING
+            self._unfinished[op.id] = op
+            if urgent:
+                self._queue.appendleft(op)
+            else:
+                self._queue.append(op)
+            self._cond.notify_all()
+        return op.id
+
+    def enqueueMany(self, ops: list[Operation], urgent=False) -> list[int]:
+        """Queue several operations together, so they land in the same batch
+        (up to batch_size). Returns their operation ids.
+
+        Args:
+            ops (list<Operation>): Operations to run, in order
+            urgent (bool, optional): Run before everything already queued
+        """
+        with self._cond:
+            for op in ops:
+                op.id = next(self._ids)
+                op.state = STATE_PENDING
+                self._unfinished[op.id] = op
+            if urgent:
+                self._queue.extendleft(reversed(ops))
+            else:
+                self._queue.extend(ops)
+            self._cond.notify_all()
+        return [op.id for op in ops]
+
+    def run(self, op: Operation) -> int:
+        """Run op now, on the calling thread, journaled as its own batch.
+        Returns its operation id.
+
+        Raises:
+            Exception: Whatever the operation raised, if it has no callback
+        """
+        with self._cond:
+            op.id = next(self._ids)
+            op.state = STATE_PENDING
+            self._unfinished[op.id] = op
+        self._runBatch([op], reraise=True)
+        return op.id
+
+    def runMany(self, ops: list[Operation]) -> list[int]:
+        """Run ops now, in order, on the calling thread, journaled as one batch.
+        Returns their operation ids. Failures go to each operation's callback,
+        or are only logged.
+        """
+        with self._cond:
+            for op in ops:
+                op.id = next(self._ids)
+                op.state = STATE_PENDING
+                self._unfinished[op.id] = op
+        self._runBatch(ops)
+        return [op.id for op in ops]
+
+    def cancel(self, op_id: int) -> bool:
+        """Cancel an operation that hasn't started yet. Its callback is never called,
+        but whenFinished follow-ups are.
+
+        Returns:
+            bool: True if the operation was cancelled, False if it already started or finished
+        """
+        with self._cond:
+            op = self._unfinished.get(op_id)
+            if op is None or op.state != STATE_PENDING:
+                return False
+            op.state = STATE_CANCELLED
+            del self._unfinished[op_id]
+            followups = self._followups.pop(op_id, [])
+            if op.batch is None:
+                try:
+                    self._queue.remove(op)
+                except ValueError:
+                    pass  # Taken by the worker; _runBatch journals the skip
+            elif self.journal:
+                self.journal.skip(op.batch, op.id)
+            self._cond.notify_all()
+        for fn in followups:
+            fn(op, None)
+        return True
+
+    def whenFinished(self, op: Operation, fn: Callable[[Operation, Optional[BaseException]], None]) -> None:
+        """Call fn(op, None) once op has run, failed or been cancelled, without
+        waiting for it. Called right away if it already has, otherwise on the
+        worker, before op's own callback. fn can check op.state.
+        """
+        with self._cond:
+            if op.id in self._unfinished:
+                self._followups.setdefault(op.id, []).append(fn)
+                return
+        fn(op, None)
+
+    def waitFor(self, op_id: int) -> None:
+        """Block until a single operation has finished (or was cancelled)."""
+        with self._cond:
+            while op_id in self._unfinished:
+                self._cond.wait()
+
+    def _runBatch(self, ops: list[Operation], reraise=False) -> None:
+        batch = self.journal.begin(ops) if self.journal else None
+        with self._cond:
+            for op in ops:
+                op.batch = batch
+                if op.state == STATE_CANCELLED and batch is not None:
+                    # Cancelled between leaving the queue and being journaled
+                    self.journal.skip(batch, op.id)  # type: ignore[union-attr]
+        try:
+            for op in ops:
+                with self._cond:
+                    if op.state == STATE_CANCELLED:
+                        continue
+                    op.state = STATE_RUNNING
+                try:
+                    with instrument.span("move"):
+                        op.run()
+                except Exception as e:
+                    logger.error(f"Operation failed: {op}", exc_info=True)
+                    self._finished(op, STATE_FAILED)
+                    if op.callback is not None:
+                        op.callback(op, e)
+                    elif reraise:
+                        raise
+                else:
+                    self._finished(op, STATE_DONE)
+                    if op.callback is not None:
+                        op.callback(op, None)
+        finally:
+            if batch is not None:
+                self.journal.end(batch)  # type: ignore[union-attr]
+
+    def _finished(self, op: Operation, state: str) -> None:
+        with self._cond:
+            op.state = state
+            self._unfinished.pop(op.id, None)
+            followups = self._followups.pop(op.id, [])
+            self._cond.notify_all()
+        for fn in followups:
+            try:
+                fn(op, None)
+            except Exception:
+                logger.error(f"Error in follow-up of {op}", exc_info=True)
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if not self._queue and self._stopping:
+                    return
+                ops = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._busy = True
+            try:
+                self._runBatch(ops)
+            except Exception:
+                logger.error("Unhandled error in operation batch", exc_info=True)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def wait(self) -> None:
+        """Block until every queued operation has run."""
+        with self._cond:
+            while self._queue or self._busy:
+                self._cond.wait()
+
+    def finish(self) -> None:
+        """Run everything still queued, then stop the worker."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+def executePlan(records: Iterable[dict], journal: Optional[Journal] = None, jobs=8) -> list[tuple[dict, Exception]]:
+    """Carry out a plan from filesystem.planMoves, running independent chains of it
+    in parallel, each journaled as one batch. Files are never overwritten; a
+    destination that appeared since planning is an error.
+
+    Args:
+        records (Iterable<dict>): Plan records, in order
+        journal (Journal, optional): Write-ahead log, or None to run unjournaled
+        jobs (int, optional): Number of chains to run at once
+
+    Returns:
+        list<(dict, Exception)>: Records that failed, with their errors
+    """
+    failures: list[tuple[dict, Exception]] = []
+
+    def onDone(record: dict) -> Callable[[Operation, Optional[BaseException]], None]:
+        def callback(_op: Operation, error: Optional[BaseException]) -> None:
+            if error is not None:
+                failures.append((record, error))  # type: ignore[arg-type]
+        return callback
+
+    def runChain(executor: OperationExecutor, chain: list[dict]) -> None:
+        executor.runMany([operationFromPlan(record, callback=onDone(record)) for record in chain])
+
+    with OperationExecutor(journal) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="executePlan") as pool:
+        for future in [pool.submit(runChain, executor, chain) for chain in filesystem.planChains(list(records))]:
+            future.result()
+    return failures
+
+
+class JournaledTrash(filesystem.Trash):
+    """Trash whose OS trash commits are recorded in a Journal."""
+
+    def __init__(self, journal: Journal, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.journal: Journal = journal
+
+    def recover(self) -> None:
+        """Resolve operations interrupted by a previous crash."""
+        self.journal.recover(trash=self._osTrash)
+
+    def _trashNow(self, path: str) -> None:
+        batch = self.journal.begin([Operation(kind=OP_TRASH, source=path)])
+        try:
+            super()._trashNow(path)
+        finally:
+            self.journal.end(batch)
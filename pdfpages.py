@@ -0,0 +1,301 @@
+# Rendering PDF pages to images with whichever renderer is installed
+
+import os
+import io
+import re
+import shutil
+import subprocess  # noqa: S404
+import contextlib
+import collections
+import functools
+import importlib.util
+from threading import Lock
+
+from PIL import Image
+
+import typing
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAX_OPEN_DOCUMENTS = 4
+POPPLER_TIMEOUT = 30  # Seconds
+
+
+class _Document(object):
+    """A PDF opened by one of the renderers, which subclass this."""
+
+    # Held around every call into the renderer's library, if it isn't thread-safe
+    library_lock: typing.Optional[Lock] = None
+    pages: int
+
+    @staticmethod
+    def available() -> bool:
+        """Whether the renderer is installed."""
+        raise NotImplementedError
+
+    def __init__(self, filepath: str) -> None:  # noqa: ARG002
+        super().__init__()
+
+    def render(self, page_number: int, size: tuple[int, int]) -> Image.Image:
+        """Rasterize a page to fit in a size[0] x size[1] box."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class _PdfiumDocument(_Document):
+    """pypdfium2, the fastest renderer."""
+
+    # PDFium isn't safe to call from two threads at once, even for different documents
+    library_lock: typing.Optional[Lock] = Lock()
+
+    @staticmethod
+    def available() -> bool:
+        return importlib.util.find_spec("pypdfium2") is not None
+
+    def __init__(self, filepath: str) -> None:
+        super().__init__(filepath)
+        import pypdfium2  # noqa: PLC0415
+        self._pdf = pypdfium2.PdfDocument(filepath)
+        self.pages: int = len(self._pdf)
+
+    def render(self, page_number: int, size: tuple[int, int]) -> Image.Image:
+        page = self._pdf[page_number]
+        try:
+            width, height = page.get_size()
+            scale = min(size[0] / width, size[1] / height)
+            return page.render(scale=scale).to_pil()
+        finally:
+            page.close()
+
+    def close(self) -> None:
+        self._pdf.close()
+
+
+class _FitzDocument(_Document):
+    """PyMuPDF."""
+
+    # Like PDFium, MuPDF's bindings share state between documents
+    library_lock: typing.Optional[Lock] = Lock()
+
+    @staticmethod
+    def available() -> bool:
+        return importlib.util.find_spec("fitz") is not None
+
+    def __init__(self, filepath: str) -> None:
+        super().__init__(filepath)
+        import fitz  # noqa: PLC0415
+        self._fitz = fitz
+        self._doc = fitz.open(filepath)
+        self.pages: int = self._doc.page_count
+
+    def render(self, page_number: int, size: tuple[int, int]) -> Image.Image:
+        page = self._doc[page_number]
+        scale = min(size[0] / page.rect.width, size[1] / page.rect.height)
+        pixmap = page.get_pixmap(matrix=self._fitz.Matrix(scale, scale), alpha=False)
+        return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+    def close(self) -> None:
+        self._doc.close()
+
+
+class _PopplerDocument(_Document):
+    """poppler's pdfinfo and pdftoppm commands. Slowest, as each page starts a process,
+    but often already installed.
+    """
+
+    # Every call is its own process
+    library_lock: typing.Optional[Lock] = None
+
+    @staticmethod
+    def available() -> bool:
+        return bool(shutil.which("pdftoppm") and shutil.which("pdfinfo"))
+
+    def __init__(self, filepath: str) -> None:
+        super().__init__(filepath)
+        self.filepath: str = filepath
+        info = subprocess.run(  # noqa: S603
+            ["pdfinfo", filepath],  # noqa: S607
+            capture_output=True, check=True, timeout=POPPLER_TIMEOUT, text=True, errors="replace"
+        ).stdout
+        match = re.search(r"^Pages:\s+(\d+)", info, flags=re.MULTILINE)
+        if match is None:
+            raise OSError(f"pdfinfo found no pages in '{filepath}'")
+        self.pages: int = int(match.group(1))
+
+    def render(self, page_number: int, size: tuple[int, int]) -> Image.Image:
+        page = str(page_number + 1)
+        ppm = subprocess.run(  # noqa: S603
+            ["pdftoppm", "-f", page, "-l", page, "-singlefile", "-scale-to", str(max(size)), self.filepath],  # noqa: S607
+            capture_output=True, check=True, timeout=POPPLER_TIMEOUT
+        ).stdout
+        image = Image.open(io.BytesIO(ppm))
+        image.thumbnail(size)
+        return image
+
+
+RENDERERS: list[type[_Document]] = [_PdfiumDocument, _FitzDocument, _PopplerDocument]
+
+
+@functools.lru_cache()
+def availableRenderer() -> typing.Optional[type[_Document]]:
+    """The first renderer in RENDERERS that's installed, or None."""
+    return next((renderer for renderer in RENDERERS if renderer.available()), None)
+
+
+class _OpenDocument(object):
+    """A cached document, with the lock that serializes its use."""
+
+    def __init__(self, renderer: type[_Document], filepath: str, mtime: float) -> None:
+        super().__init__()
+        self.renderer: type[_Document] = renderer
+        self.filepath: str = filepath
+        self.mtime: float = mtime
+        self.lock = Lock()
+        self.document: typing.Optional[_Document] = None  # Opened by the first user
+        self.pages: typing.Optional[int] = None  # Known once opened, readable without the lock
+        self.users: int = 0  # Guarded by the cache's lock
+        self.evicted: bool = False
+
+    def libraryLock(self) -> typing.ContextManager:
+        return self.renderer.library_lock or contextlib.nullcontext()
+
+    def open(self) -> _Document:
+        """The document, opened if it isn't yet. Call with self.lock held."""
+        if self.document is None:
+            try:
+                with self.libraryLock():
+                    self.document = self.renderer(self.filepath)
+                self.pages = self.document.pages
+            except Exception as e:
+                raise OSError(f"Can't open '{self.filepath}' with {self.renderer.__name__}") from e
+        return self.document
+
+    def close(self) -> None:
+        with self.lock:
+            if self.document is not None:
+                with self.libraryLock():
+                    self.document.close()
+                self.document = None
+
+
+class PdfCache(object):
+    """Keeps recently viewed PDFs open, so paging through one doesn't re-parse it.
+
+    Documents are opened on first render, not when they're listed, and
+    reopened if the file changes.
+
+    Each document has its own lock, so a slow render only holds up other
+    renders of the same file. A document dropped from the cache while it's
+    rendering is closed by that render when it finishes.
+    """
+
+    def __init__(self, max_open: int = MAX_OPEN_DOCUMENTS) -> None:
+        super().__init__()
+        self.max_open: int = max_open
+        self._lock = Lock()  # Guards _open and the users counts, never held while rendering
+        self._open: collections.OrderedDict[str, _OpenDocument] = collections.OrderedDict()
+        self._unused: list[_OpenDocument] = []  # Evicted with no users, waiting to be closed
+
+    def _acquire(self, filepath: str) -> _OpenDocument:
+        mtime = os.path.getmtime(filepath)
+        with self._lock:
+            entry = self._open.get(filepath)
+            if entry is not None and entry.mtime != mtime:
+                self._evict(filepath)
+                entry = None
+            if entry is None:
+                renderer = availableRenderer()
+                if renderer is None:
+                    raise ImportError("No PDF renderer installed (pypdfium2, PyMuPDF or poppler)")
+                entry = self._open[filepath] = _OpenDocument(renderer, filepath, mtime)
+                while len(self._open) > self.max_open:
+                    self._evict(next(iter(self._open)))
+            else:
+                self._open.move_to_end(filepath)
+            entry.users += 1
+            return entry
+
+    def _release(self, entry: _OpenDocument) -> None:
+        with self._lock:
+            entry.users -= 1
+            last = entry.evicted and entry.users == 0
+        if last:
+            entry.close()
+
+    def _evict(self, filepath: str) -> None:
+        """Drop filepath from the cache, without waiting for it. Call with self._lock held."""
+        entry = self._open.pop(filepath, None)
+        if entry is None:
+            return
+        entry.evicted = True
+        if entry.users == 0:
+            self._unused.append(entry)
+
+    def _closeUnused(self) -> None:
+        with self._lock:
+            unused, self._unused = self._unused, []
+        for entry in unused:
+            entry.close()
+
+    @contextlib.contextmanager
+    def _using(self, filepath: str):
+        entry = self._acquire(filepath)
+        try:
+            with entry.lock:
+                yield entry
+        finally:
+            self._release(entry)
+
+    def pages(self, filepath: str) -> int:
+        """Number of pages in the PDF.
+
+        Raises:
+            ImportError: If no renderer is installed
+            OSError: If the file can't be read
+        """
+        entry = self._acquire(filepath)
+        try:
+            if entry.pages is None:
+                with entry.lock:
+                    entry.open()
+            return entry.pages  # type: ignore[return-value]
+        finally:
+            self._release(entry)
+
+    def render(self, filepath: str, page_number: int, size: tuple[int, int]) -> Image.Image:
+        """Rasterize one page to fit in a size[0] x size[1] box. Page numbers start at 0
+        and wrap around.
+
+        Raises:
+            ImportError: If no renderer is installed
+            OSError: If the file can't be read
+        """
+        # Renders run on workers, so documents dropped from the UI thread are closed here
+        self._closeUnused()
+        with self._using(filepath) as entry:
+            document = entry.open()
+            if document.pages == 0:
+                raise OSError(f"'{filepath}' has no pages")
+            try:
+                with entry.libraryLock():
+                    return document.render(page_number % document.pages, size)
+            except Exception as e:
+                raise OSError(f"Can't render page {page_number} of '{filepath}'") from e
+
+    def forget(self, filepath: str) -> None:
+        """Drop filepath, e.g. before it's moved or deleted. Doesn't wait for
+        renders of it; the document is closed once they finish."""
+        with self._lock:
+            self._evict(filepath)
+
+    def close(self) -> None:
+        with self._lock:
+            for filepath in list(self._open):
+                self._evict(filepath)
+        self._closeUnused()
+
+
+cache = PdfCache()
@@ -0,0 +1,719 @@
+# Decoding, scaling and describing files for preview, without a display
+
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ExifTags
+import cv2
+
+import os
+from threading import Lock
+import codecs
+import collections
+import io
+import math
+import struct
+import zipfile
+import traceback
+
+import typing
+
+import archives
+import filerecords
+import instrument
+import pdfpages
+from filerecords import IMAGEEXTS, VIDEOEXTS, _IMAGEEXTS, _VIDEOEXTS
+import loom
+
+import logging
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTS = ['zip', 'cbz', 'pdf', *IMAGEEXTS, *VIDEOEXTS]
+
+TEXT_PREVIEW_LINES = 200
+TEXT_PREVIEW_CHARS = 20000
+TEXT_FILE_CHARS = 5000
+TEXT_SNIFF_BYTES = 4096
+TEXT_CACHE_SIZE = 256
+
+THUMBNAIL_CACHE_BYTES = 512 * 1024 * 1024
+MASTER_CACHE_BYTES = 384 * 1024 * 1024
+SCREEN_SIZE = (1920, 1080)  # Until a view says otherwise
+SCALED_CACHE_SIZE = 100
+PREVIEW_WORKERS = 8
+
+
+def framesInImage(im):
+    try:
+        return filerecords.probeImage(im)[2]
+    except OSError:
+        return 1
+
+
+def autoRotate(image):
+
+    orientationflags = [key for key in ExifTags.TAGS.keys() if ExifTags.TAGS[key] == 'Orientation']
+    try:
+        for orientation in orientationflags:
+            exif = dict(image._getexif().items())
+            if not exif.get(orientation):
+                continue
+
+            if exif[orientation] == 3:  # noqa: PLR2004
+                return image.rotate(180, expand=True)
+            elif exif[orientation] == 6:  # noqa: PLR2004
+                return image.rotate(270, expand=True)
+            elif exif[orientation] == 8:  # noqa: PLR2004
+                return image.rotate(90, expand=True)
+    except (KeyError, AttributeError):
+        pass
+
+    return image
+
+
+def bytes_to_string(value: int, units=('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB'), sep="", base=1024) -> str:
+    """ Returns a human readable string reprentation of bytes."""
+    # Adapted from a comment by "Mr. Me" on github.
+    if value < base:
+        return "{:0.2f}{}{}".format(value, sep, units[0])
+    else:
+        return bytes_to_string(value / base, units[1:], sep=sep)
+
+
+class TextPreview(object):
+    """Builds preview text line by line, up to hard line and character limits.
+    Once full, further lines are dropped.
+    """
+
+    def __init__(self, max_lines: int = TEXT_PREVIEW_LINES, max_chars: int = TEXT_PREVIEW_CHARS) -> None:
+        super().__init__()
+        self.max_lines: int = max_lines
+        self.max_chars: int = max_chars
+        self._buffer = io.StringIO()
+        self._lines: int = 0
+
+    @property
+    def full(self) -> bool:
+        return self._lines >= self.max_lines or self._buffer.tell() >= self.max_chars
+
+    def add(self, line: str) -> bool:
+        """Append a line. Returns False if the preview is full and the line was dropped."""
+        if self.full:
+            return False
+        self._buffer.write("\n")
+        self._buffer.write(line[:self.max_chars - self._buffer.tell()])
+        self._lines += 1
+        return True
+
+    def addAll(self, lines: typing.Iterable[str], total: typing.Optional[int] = None) -> None:
+        """Append lines until full. Stops consuming lines once full, so lines can be lazy.
+
+        Args:
+            lines (Iterable<str>): Lines to add
+            total (int, optional): How many lines there are, to report how many were left out
+        """
+        added = 0
+        for line in lines:
+            if not self.add(line):
+                break
+            added += 1
+        if total is not None and total > added:
+            self._buffer.write(f"\n... {total - added} more")
+
+    def getvalue(self) -> str:
+        return self._buffer.getvalue()
+
+
+def sniffText(filepath: str, sniff_bytes: int = TEXT_SNIFF_BYTES) -> bool:
+    """Whether the start of a file looks like UTF-8 text, i.e. has no NULs and decodes."""
+    with open(filepath, "rb") as fp:
+        head = fp.read(sniff_bytes)
+    if b"\0" in head:
+        return False
+    try:
+        # Final=False tolerates a multibyte character cut off at the end
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def zipMemberNames(filepath: str, limit: int) -> tuple[list[str], int]:
+    """The first `limit` member names of a zip, and how many members it has.
+    Reads only that much of the central directory, rather than all of it like ZipFile.
+    """
+    with open(filepath, "rb") as fp:
+        fp.seek(0, os.SEEK_END)
+        file_size = fp.tell()
+        tail_size = min(file_size, 22 + 0xFFFF)  # End record plus the longest comment
+        fp.seek(file_size - tail_size)
+        tail = fp.read(tail_size)
+        eocd = tail.rfind(b"PK\x05\x06")
+        if eocd < 0:
+            raise zipfile.BadZipFile("End of central directory not found")
+        (total, _cd_size, cd_offset) = struct.unpack("<HII", tail[eocd + 10:eocd + 20])
+        if total == 0xFFFF or cd_offset == 0xFFFFFFFF:  # noqa: PLR2004
+            # Zip64; let zipfile deal with it
+            with zipfile.ZipFile(fp) as zf:
+                names = zf.namelist()
+            return names[:limit], len(names)
+
+        fp.seek(cd_offset)
+        names = []
+        for _ in range(min(limit, total)):
+            header = fp.read(46)
+            if len(header) < 46 or header[:4] != b"PK\x01\x02":  # noqa: PLR2004
+                break
+            (flags,) = struct.unpack("<H", header[8:10])
+            name_len, extra_len, comment_len = struct.unpack("<HHH", header[28:34])
+            name = fp.read(name_len)
+            names.append(name.decode("utf-8" if flags & 0x800 else "cp437", errors="replace"))
+            fp.seek(extra_len + comment_len, os.SEEK_CUR)
+    return names, total
+
+
+def addTextFromPdf(preview: TextPreview, filepath: str) -> None:
+    try:
+        import pikepdf  # noqa: PLC0415
+
+        with pikepdf.open(filepath) as pdf:
+            for key, value in pdf.docinfo.items():
+                try:
+                    preview.add(f"{key}:\t{value}")
+                except NotImplementedError:
+                    preview.add(f"{key}:\t{value!r}")
+
+    except ImportError:
+        preview.add("ImportError: pikepdf not installed")
+    except Exception as e:
+        preview.add(f"pikepdf {type(e)}: {e}")
+
+
+def makeTextFromPdf(filepath: str) -> str:
+    preview = TextPreview()
+    addTextFromPdf(preview, filepath)
+    return preview.getvalue()
+
+
+def addTextFromFile(preview: TextPreview, filepath: str, max_chars: int = TEXT_FILE_CHARS) -> None:
+    """Add up to max_chars of a file's text, skipping binary files without decoding them."""
+    if not sniffText(filepath):
+        return
+    with open(filepath, "r", encoding="utf-8", errors="replace") as fp:
+        preview.addAll(fp.read(max_chars).splitlines())
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache with a fixed number of entries."""
+
+    def __init__(self, max_entries: int = 1000) -> None:
+        super().__init__()
+        self.max_entries: int = max_entries
+        self._cache: collections.OrderedDict = collections.OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                return default
+            self._cache.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._cache.pop(key, default)
+
+
+def imageBytes(image: Image.Image) -> int:
+    """Approximate memory used by a decoded image. PIL stores single-band images in a
+    byte per pixel and everything else, RGB included, in four.
+    """
+    return image.width * image.height * (1 if image.mode in ("1", "L", "P") else 4)
+
+
+class ThumbnailCache(LRUCache):
+    """Thread-safe LRU cache of PIL images, shared between views. Bounded by
+    total pixel memory as well as entry count, as rendered pages are much
+    bigger than grid thumbnails.
+
+    Keys are tuples starting with the filepath, typically (filepath, size)
+    or (filepath, page, size).
+    """
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = THUMBNAIL_CACHE_BYTES) -> None:
+        super().__init__(max_entries)
+        self.max_bytes: int = max_bytes
+        self.nbytes: int = 0
+
+    def put(self, key, value: Image.Image) -> None:
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self.nbytes -= imageBytes(old)
+            self._cache[key] = value
+            self.nbytes += imageBytes(value)
+            while len(self._cache) > 1 and (len(self._cache) > self.max_entries or self.nbytes > self.max_bytes):
+                _key, old = self._cache.popitem(last=False)
+                self.nbytes -= imageBytes(old)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is None:
+                return default
+            self.nbytes -= imageBytes(value)
+            return value
+
+    def discard(self, filepath: str) -> None:
+        """Drop every entry for filepath, whatever its size."""
+        with self._lock:
+            for key in [k for k in self._cache if k[0] == filepath]:
+                self.nbytes -= imageBytes(self._cache.pop(key))
+
+
+def openImage(filepath: str) -> Image.Image:
+    """Image.open, which also works for images inside archives.
+    """
+    if archives.cache.archiveOf(filepath):
+        return archives.cache.openImage(filepath)
+    return Image.open(filepath)
+
+
+def isFile(filepath: str) -> bool:
+    return os.path.isfile(filepath) or archives.cache.exists(filepath)
+
+
+def compactImage(image: Image.Image) -> Image.Image:
+    """image in the smallest mode Tk can show without losing anything: L for
+    greyscale, RGBA only if some pixel isn't fully opaque, RGB otherwise.
+    Palette images are expanded, as they can't be resized smoothly.
+    """
+    if "transparency" in image.info or image.mode in ("LA", "La", "PA", "RGBa"):
+        image = image.convert("RGBA")
+    if image.mode == "RGBA":
+        if image.getchannel("A").getextrema()[0] == 255:  # noqa: PLR2004
+            return image.convert("RGB")
+        return image
+    if image.mode in ("L", "RGB"):
+        return image
+    if image.mode == "1":
+        return image.convert("L")
+    return image.convert("RGB")
+
+
+def readFirstFrame(filepath: str):
+    """The first frame of a video, as a BGR array.
+
+    Raises:
+        OSError: If no frame can be read
+    """
+    capture = cv2.VideoCapture(filepath)
+    try:
+        capture.grab()
+        flag, frame = capture.retrieve()
+    finally:
+        capture.release()
+    if not flag or frame is None:
+        raise OSError(f"Can't read a frame from '{filepath}'")
+    return frame
+
+
+def frameToImage(frame, box: tuple[int, int]) -> Image.Image:
+    """A BGR video frame as an RGB image that fits in box.
+
+    The frame is shrunk in cv2 first, then colour converted once at that
+    size and unpacked straight from the array's buffer. So a 4K frame
+    costs a couple of small copies rather than several full-size ones.
+    """
+    height, width = frame.shape[:2]
+    ratio = min(box[0] / width, box[1] / height)
+    if ratio < 1:
+        frame = cv2.resize(
+            frame, (max(1, int(width * ratio)), max(1, int(height * ratio))),
+            interpolation=cv2.INTER_AREA
+        )
+    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    return Image.frombuffer("RGB", (rgb.shape[1], rgb.shape[0]), rgb, "raw", "RGB", 0, 1)
+
+
+def scaleToFit(pilimg: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """Scale an image to fit in size. Big images are shrunk smoothly; small ones are
+    enlarged by whole quarter steps, keeping their pixels sharp. May return pilimg itself.
+
+    Raises:
+        OSError, ValueError: If the image can't be resized
+    """
+    maxwidth, maxheight = size
+    ratio = min(maxwidth / pilimg.width, maxheight / pilimg.height)
+    if pilimg.width > maxwidth or pilimg.height > maxheight:
+        method: Image.Resampling = Image.Resampling.BICUBIC
+    else:
+        ratio = math.floor(ratio * 4) / 4
+        method = Image.Resampling.NEAREST
+
+    if ratio == 1.0 or ratio <= 0:
+        return pilimg
+    return pilimg.resize((int(pilimg.width * ratio), int(pilimg.height * ratio)), method)
+
+
+def decodeMaster(filepath: str, cap: tuple[int, int]) -> Image.Image:
+    """Decode an image or a video's first frame, no bigger than cap, in its most compact mode.
+
+    Raises:
+        cv2.error, OSError, ValueError: If the file can't be decoded
+    """
+    (_filename, fileext) = os.path.splitext(filepath)
+    if fileext.lower() in _IMAGEEXTS:
+        with openImage(filepath) as pilimg:
+            pilimg.draft("RGB", cap)
+            master = compactImage(autoRotate(pilimg))
+            master.thumbnail(cap)
+            master.load()  # Before the file closes; thumbnail doesn't load images that are small enough
+            return master
+    elif fileext.lower() in _VIDEOEXTS:
+        return frameToImage(readFirstFrame(filepath), cap)
+    raise OSError(f"Can't decode '{filepath}' as an image")
+
+
+def infoLabel(records: filerecords.FileRecordStore, filepath: str, page: int = 0) -> str:
+    """Name, size, and dimensions for media. Reads only file headers, and
+    only when the file is new or has changed since it was last labelled.
+
+    Args:
+        records (FileRecordStore): Where file metadata comes from
+        filepath (str): File to describe
+        page (int, optional): Page being shown, for documents
+    """
+    prettyname: str = filepath  # Fallback 2
+    try:
+        record = records.fresh(filepath)
+    except FileNotFoundError:
+        return prettyname + " (Not Found)"
+    assert record.size is not None, "fresh() records always have a size"
+    try:
+        filename: str = os.path.split(filepath)[1]
+        filesize: str = bytes_to_string(record.size)
+
+        prettyname = f"{filename}\n{filesize}"  # Fallback 1
+
+        (_filename, fileext) = os.path.splitext(filename)
+
+        if fileext.lower() == ".pdf" and page:
+            prettyname = f"{filename}\n{filesize} [page {page + 1}]"
+
+        if fileext.lower() in _IMAGEEXTS or fileext.lower() in _VIDEOEXTS:
+            w, h = records.dimensions(filepath)
+            frames = records.frames(filepath)
+            if frames > 1 or fileext.lower() in _VIDEOEXTS:
+                prettyname = f"{filename} [{frames}f]\n{filesize} [{w}x{h}px]"
+            else:
+                prettyname = f"{filename}\n{filesize} [{w}x{h}px]"
+
+    except OSError:
+        logger.error("OS error while getting file info", exc_info=True)
+
+    return prettyname
+
+
+def placeholderImage() -> Image.Image:
+    pilimg = Image.new('RGB', (10, 10), color=(0, 0, 0))
+    ImageDraw.Draw(pilimg).text((2, 0), "?", fill="white")
+    return pilimg
+
+
+def makeThumbnail(filepath: str, size: int) -> Image.Image:
+    """Decode a file into an image that fits in a size x size box.
+    JPEGs are decoded at reduced scale; videos use their first frame. Files
+    that can't be decoded get a placeholder.
+    """
+    (_filename, fileext) = os.path.splitext(filepath)
+    try:
+        if fileext.lower() in _IMAGEEXTS:
+            with openImage(filepath) as pilimg:
+                pilimg.draft("RGB", (size, size))
+                pilimg = compactImage(autoRotate(pilimg))
+                pilimg.thumbnail((size, size))
+                pilimg.load()  # Before the file closes; thumbnail doesn't load images that are small enough
+                return pilimg
+        elif fileext.lower() == ".pdf" and pdfpages.availableRenderer():
+            return pdfpages.cache.render(filepath, 0, (size, size))
+        elif fileext.lower() in _VIDEOEXTS:
+            return frameToImage(readFirstFrame(filepath), (size, size))
+    except Exception:
+        # Anything a broken file can raise, decompression bombs and bad archives included
+        logger.debug(f"Can't make thumbnail for '{filepath}'", exc_info=True)
+    return placeholderImage()
+
+
+class PreviewService(object):
+    """What a view shows for each file, as PIL images and text: scaled previews,
+    thumbnails, rendered PDF pages, text previews and info labels. Needs no
+    display, so scripts and benchmarks can use it as well as the canvas.
+
+    Images are decoded once, at no more than screen_size, into masters that
+    every preview size is a cheap downscale of. Scaled previews are kept
+    only for the size the view last asked for. Only the view (`image` and
+    `preload`) changes that size; background workers scaling for a size
+    that's no longer current throw their work away.
+    """
+
+    def __init__(
+        self,
+        records: typing.Optional[filerecords.FileRecordStore] = None,
+        thumbnails: typing.Optional[ThumbnailCache] = None,
+        screen_size: tuple[int, int] = SCREEN_SIZE,
+        workers: int = PREVIEW_WORKERS
+    ) -> None:
+        """Args:
+            records (FileRecordStore, optional): Shared per-file metadata
+            thumbnails (ThumbnailCache, optional): Shared cache for thumbnails and rendered PDF pages
+            screen_size ((int, int), optional): The largest anything will be shown
+            workers (int, optional): Threads for background decoding
+        """
+        super().__init__()
+        self.records = records if records is not None else filerecords.FileRecordStore()
+        self.thumbnails = thumbnails if thumbnails is not None else ThumbnailCache()
+        self.screen_size: tuple[int, int] = screen_size
+
+        # Decoded images, capped at screen size, that every preview size is scaled from
+        self.masters = ThumbnailCache(max_bytes=MASTER_CACHE_BYTES)
+        # Scaled previews, only at the size last asked for
+        self.scaled: dict[str, Image.Image] = {}
+        self.scaled_size: tuple[int, int] = (0, 0)
+        self._scaled_lock = Lock()  # Guards scaled and scaled_size, shared with the workers
+        self.textCache = LRUCache(max_entries=TEXT_CACHE_SIZE)
+
+        # Pages being rendered, and who to tell when each is done
+        self.pages_pending: dict[tuple[str, int, tuple[int, int]], list[typing.Callable]] = {}
+        self._pages_lock = Lock()
+
+        self.spool = loom.Spool(workers, "Previews")
+
+    def close(self) -> None:
+        self.spool.cancel()
+
+    def forget(self, filepath: str) -> None:
+        """Drop everything cached for filepath, e.g. when it's moved or changed."""
+        with self._scaled_lock:
+            self.scaled.pop(filepath, None)
+        self.masters.discard(filepath)
+        self.textCache.pop(filepath, None)
+        self.thumbnails.discard(filepath)
+        self.records.discard(filepath)
+
+    def master(self, filepath: str) -> Image.Image:
+        """filepath decoded at no more than screen size, or a placeholder if it can't be decoded."""
+        cap = self.screen_size
+        master = self.masters.get((filepath, cap))
+        if master is not None:
+            return master
+
+        try:
+            with instrument.span("decode"):
+                master = decodeMaster(filepath, cap)
+        except (cv2.error, OSError, ValueError):
+            return placeholderImage()
+
+        self.masters.put((filepath, cap), master)
+        return master
+
+    def image(self, filepath: str, size: tuple[int, int]) -> Image.Image:
+        """filepath scaled to fit in size. Videos are badged with their extension
+        and animations with their frame count.
+        """
+        with self._scaled_lock:
+            self._useSize(size)
+            pilimg = self.scaled.get(filepath)
+        if pilimg is not None:
+            return pilimg
+        return self._scale(filepath, size)
+
+    def _useSize(self, size: tuple[int, int]) -> None:
+        """Make size the one scaled previews are kept for. Call with _scaled_lock held."""
+        if size != self.scaled_size:
+            # Resized: images scaled for the old size are stale, but the masters aren't
+            self.scaled = {}
+            self.scaled_size = size
+
+    def _scale(self, filepath: str, size: tuple[int, int]) -> Image.Image:
+        pilimg = master = self.master(filepath)
+        try:
+            with instrument.span("resize"):
+                pilimg = scaleToFit(master, size)
+        except (OSError, ValueError):
+            logger.error(f"OS error resizing file {filepath}", exc_info=True)
+
+        (_filename, fileext) = os.path.splitext(filepath)
+        try:
+            frames = self.records.frames(filepath) if fileext.lower() in _IMAGEEXTS else 1
+            if (frames > 1 or fileext.lower() in _VIDEOEXTS) and pilimg is master:
+                pilimg = pilimg.copy()  # Not scaled, so don't draw on the cached master
+
+            if fileext.lower() in _VIDEOEXTS:
+                ImageDraw.Draw(pilimg).rectangle([(0, 0), (30, 14)], fill="black")
+                ImageDraw.Draw(pilimg).text((2, 2), fileext.lower(), fill="white")
+
+            if frames > 1:
+                ImageDraw.Draw(pilimg).rectangle([(0, 0), (30, 14)], fill="black")
+                ImageDraw.Draw(pilimg).text((2, 2), str(frames), fill="white")
+        except ValueError:
+            traceback.print_exc()
+
+        with self._scaled_lock:
+            if size == self.scaled_size:
+                self.scaled[filepath] = pilimg
+                self._pruneScaled()
+        return pilimg
+
+    def _preloadImage(self, filepath: str, size: tuple[int, int]) -> None:
+        with self._scaled_lock:
+            if size != self.scaled_size or filepath in self.scaled:
+                return  # Resized since it was queued, or shown already
+        self._scale(filepath, size)
+
+    def _pruneScaled(self, max_entries: int = SCALED_CACHE_SIZE) -> None:
+        """Call with _scaled_lock held."""
+        if len(self.scaled) < max_entries:
+            return
+        while len(self.scaled) > max_entries // 2:
+            dirty_item = next(iter(self.scaled.keys()))
+            logger.info(f"Cache too big, removing entry {dirty_item}")
+            self.scaled.pop(dirty_item, None)
+
+    def thumbnail(self, filepath: str, size: int) -> Image.Image:
+        """filepath fitted in a size x size box. See makeThumbnail."""
+        thumb = self.thumbnails.get((filepath, size))
+        if thumb is None:
+            thumb = makeThumbnail(filepath, size)
+            self.thumbnails.put((filepath, size), thumb)
+        return thumb
+
+    def pages(self, filepath: str) -> int:
+        """Number of pages in a PDF.
+
+        Raises:
+            ImportError: If no PDF renderer is installed
+            OSError: If the file can't be read
+        """
+        return pdfpages.cache.pages(filepath)
+
+    def page(self, filepath: str, page_number: int, size: tuple[int, int]) -> typing.Optional[Image.Image]:
+        """A PDF page, if it's already been rendered at this size."""
+        return self.thumbnails.get((filepath, page_number, size))
+
+    def renderPage(self, filepath: str, page_number: int, size: tuple[int, int]) -> Image.Image:
+        """Render a PDF page to fit in size, and cache it.
+
+        Raises:
+            ImportError: If no PDF renderer is installed
+            OSError: If the file can't be read
+        """
+        pilimg = pdfpages.cache.render(filepath, page_number, size)
+        self.thumbnails.put((filepath, page_number, size), pilimg)
+        return pilimg
+
+    def requestPage(
+        self, filepath: str, page_number: int, size: tuple[int, int],
+        done: typing.Optional[typing.Callable[[tuple], None]] = None
+    ) -> None:
+        """Render a PDF page in the background, unless it's cached or already on the way.
+
+        Args:
+            done (callable, optional): Called with (filepath, page_number, size) on the
+                worker thread once the page is cached, or has failed to render
+        """
+        key = (filepath, page_number, size)
+        with self._pages_lock:
+            if key in self.pages_pending:
+                if done is not None:
+                    self.pages_pending[key].append(done)
+                return
+            cached = self.thumbnails.get(key) is not None
+            if not cached:
+                self.pages_pending[key] = [done] if done is not None else []
+        if cached:
+            if done is not None:
+                done(key)
+            return
+
+        def _do() -> None:
+            try:
+                self.renderPage(filepath, page_number, size)
+            except (OSError, ImportError):
+                logger.warning(f"Can't render page {page_number} of '{filepath}'", exc_info=True)
+            with self._pages_lock:
+                callbacks = self.pages_pending.pop(key, [])
+            for callback in callbacks:
+                callback(key)
+
+        self.spool.enqueue(target=_do)
+
+    def preload(self, filepaths: typing.Iterable[str], size: tuple[int, int]) -> None:
+        """Decode and scale files for size in the background, so showing them next is instant.
+        For PDFs, that's rendering their first page.
+        """
+        with self._scaled_lock:
+            self._useSize(size)
+        for filepath in filepaths:
+            if filepath.lower().endswith(".pdf"):
+                if pdfpages.availableRenderer() is not None:
+                    self.requestPage(os.path.normpath(filepath), 0, size)
+            else:
+                self.spool.enqueue(target=self._preloadImage, args=(filepath, size))
+
+    def text(self, filepath: str) -> str:
+        """Text shown for files that aren't images: file info, archive listings, document
+        metadata, and the start of the file if it's text. Bounded in size however big the file is.
+        """
+        text = self.textCache.get(filepath)
+        if text is not None:
+            return text
+
+        preview = TextPreview()
+        preview.add(f"Path:\t{filepath}")
+        preview.add(f"Size:\t{bytes_to_string(os.path.getsize(filepath))}")
+
+        _filename, fileext = os.path.splitext(filepath)
+        if fileext.lower() == ".pdf":
+            addTextFromPdf(preview, filepath)
+
+        if fileext.lower()[1:] in archives.ARCHIVEEXTS:
+            try:
+                names, total = zipMemberNames(filepath, preview.max_lines)
+                preview.addAll(names, total=total)
+            except (zipfile.BadZipFile, struct.error, OSError) as e:
+                preview.add(f"{type(e).__name__}: {e}")
+
+        if os.name == "nt":
+            try:
+                from win32_fileprops import property_sets  # noqa: PLC0415
+                for name, properties in property_sets(filepath):
+                    preview.add(f"Win32 {name}")
+                    for key, value in properties.items():
+                        if value:
+                            preview.add(f"\t{key}:\t{value}")
+            except ImportError as e:
+                preview.add(str(e))
+
+        try:
+            addTextFromFile(preview, filepath)
+        except OSError as e:
+            logger.warning(f"Can't read text from '{filepath}': {e}")
+
+        text = preview.getvalue()
+        self.textCache.put(filepath, text)
+        return text
+
+    def label(self, filepath: str, page: int = 0) -> str:
+        """See infoLabel."""
+        return infoLabel(self.records, filepath, page=page)
@@ -1,9 +1,137 @@
 import tkinter as tk
 from tkinter import ttk
+from tkinter import font as tkfont
 
 # from .sort import FileSorter
 
-from typing import Callable
+from typing import Callable, Iterable, Optional
+
+import logging
+logger = logging.getLogger(__name__)
+
+QUERY_DEBOUNCE_MS = 60
+QUERY_POLL_MS = 15
+
+
+class VirtualListbox(tk.Frame):
+
+    """Read-only listbox that only draws the rows currently in view.
+
+    Items and selections are plain python data; scrolling and highlighting
+    only reconfigure the handful of canvas items that are visible.
+    """
+
+    SELECT_BG = "#3399FF"
+    SELECT_FG = "#FFFFFF"
+    NORMAL_BG = "#FFFFFF"
+    NORMAL_FG = "#000000"
+    DISABLED_FG = "#808080"
+    # tk.Listbox's default size, so the sidebar lays out as it did with one
+    WIDTH_CHARS = 20
+    HEIGHT_ROWS = 10
+
+    def __init__(self, parent, *args, **kwargs) -> None:
+        """Args:
+            parent (tk): Tk parent widget
+            *args: Passthrough
+            **kwargs: Passthrough
+        """
+        tk.Frame.__init__(self, parent, *args, **kwargs)
+
+        self.items: list[str] = []
+        self.selected: set[int] = set()
+        self.disabled: bool = True
+        self.first: int = 0  # Index of the top visible row
+
+        self.font = tkfont.nametofont("TkDefaultFont")
+        self.row_height: int = self.font.metrics("linespace") + 2
+        self.rows: list[tuple[int, int]] = []  # Pool of (rectangle, text) canvas items
+
+        self.canvas = tk.Canvas(
+            self, highlightthickness=0, takefocus=False, bg=self.NORMAL_BG,
+            width=self.WIDTH_CHARS * self.font.measure("0"), height=self.HEIGHT_ROWS * self.row_height
+        )
+        self.canvas.grid(row=0, column=0, sticky="nsew")
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+
+        self.canvas.bind("<Configure>", lambda event: self.redraw())  # noqa: ARG005
+        # Windows sends multiples of 120, macOS small values of either sign
+        self.canvas.bind("<MouseWheel>", lambda event: self.scrollBy(-1 if event.delta > 0 else 1))
+        self.canvas.bind("<Button-4>", lambda event: self.scrollBy(-3))  # noqa: ARG005
+        self.canvas.bind("<Button-5>", lambda event: self.scrollBy(3))  # noqa: ARG005
+
+    @property
+    def visibleRows(self) -> int:
+        return max(1, self.canvas.winfo_height() // self.row_height)
+
+    def setItems(self, items: Iterable[str]) -> None:
+        """Replace the list contents. Clears the selection."""
+        self.items = list(items)
+        self.selected = set()
+        self.scrollTo(self.first)
+
+    def setSelection(self, indexes: Iterable[int], disabled=False) -> None:
+        """Replace the set of highlighted rows in one redraw."""
+        self.selected = set(indexes)
+        self.disabled = disabled
+        self.redraw()
+
+    def see(self, index: int) -> None:
+        """Scroll so that index is visible, centering it if it was not."""
+        visible = self.visibleRows
+        if not (self.first <= index < self.first + visible):
+            self.scrollTo(index - visible // 2)
+
+    def scrollBy(self, rows: int) -> None:
+        self.scrollTo(self.first + rows)
+
+    def scrollTo(self, first: int) -> None:
+        self.first = max(0, min(first, len(self.items) - self.visibleRows))
+        self.redraw()
+
+    def yview(self, *args) -> None:
+        """Scrollbar command handler"""
+        if args[0] == tk.MOVETO:
+            self.scrollTo(int(float(args[1]) * len(self.items)))
+        elif args[0] == tk.SCROLL:
+            step = self.visibleRows if args[2] == tk.PAGES else 1
+            self.scrollBy(int(args[1]) * step)
+
+    def redraw(self) -> None:
+        """Reconfigure the visible rows to match the current items and selection."""
+        visible = self.visibleRows
+        width = self.canvas.winfo_width()
+
+        while len(self.rows) < visible + 1:
+            y = len(self.rows) * self.row_height
+            self.rows.append((
+                self.canvas.create_rectangle(0, y, width, y + self.row_height, width=0),
+                self.canvas.create_text(2, y + 1, anchor="nw", font=self.font)
+            ))
+
+        for offset, (rect, text) in enumerate(self.rows):
+            index = self.first + offset
+            if index >= len(self.items) or offset > visible:
+                self.canvas.itemconfigure(rect, state="hidden")
+                self.canvas.itemconfigure(text, state="hidden")
+                continue
+
+            is_selected = index in self.selected
+            if self.disabled:
+                fg = self.DISABLED_FG
+            else:
+                fg = self.SELECT_FG if is_selected else self.NORMAL_FG
+            self.canvas.coords(rect, 0, offset * self.row_height, width, (offset + 1) * self.row_height)
+            self.canvas.itemconfigure(rect, state="normal", fill=(self.SELECT_BG if is_selected else self.NORMAL_BG))
+            self.canvas.itemconfigure(text, state="normal", text=self.items[index], fill=fg)
+
+        if self.items:
+            self.scrollbar.set(self.first / len(self.items), min(1.0, (self.first + visible) / len(self.items)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
 
 
 class SidebarFrame(tk.Frame):
@@ -11,6 +139,10 @@ class SidebarFrame(tk.Frame):
     """Frame that manages the sidebar and user input
     """
 
+    GOOD = "#AAFFAA"
+    BAD = "#FFAAAA"
+    NORMAL = "#FFFFFF"
+
     # Init and window management
 
     def __init__(self, parent, submit_callback: Callable[..., None], *args, **kwargs) -> None:
@@ -24,6 +156,9 @@ class SidebarFrame(tk.Frame):
         self.controller = parent
 
         self.submit: Callable[..., None] = submit_callback
+
+        self.query_generation: int = 0  # Bumped by every keystroke; stale results are dropped
+        self.query_after: Optional[str] = None
         # Initialize window
         self.initwindow()
 
@@ -48,7 +183,7 @@ class SidebarFrame(tk.Frame):
         btn_filter.grid(row=inOrderRow, sticky=tk.E)
 
         btn_ref = ttk.Button(self, text="Refresh", takefocus=False, command=(
-            lambda: (self.controller.reloadDirContext(), self.controller.imageUpdate()))
+            lambda: (self.controller.reloadDirContext(rescan=True), self.controller.imageUpdate()))
         )
         btn_ref.grid(row=rowInOrder(), sticky="WE")
 
@@ -99,8 +234,7 @@ class SidebarFrame(tk.Frame):
         lab_context_label.grid(row=rowInOrder())
 
         # self.str_context = tk.StringVar()
-        self.listbox_context = tk.Listbox(
-            self, state=tk.DISABLED, takefocus=False, relief=tk.GROOVE)
+        self.listbox_context = VirtualListbox(self, takefocus=False, relief=tk.GROOVE, bd=2)
         self.listbox_context.grid(row=rowInOrder(), sticky="nsew")
 
         self.grid_columnconfigure(0, weight=1)
@@ -114,8 +248,8 @@ class SidebarFrame(tk.Frame):
 
         settings_popup = tk.Menu(self, tearoff=0)
 
-        for _key, (var, label) in self.controller.settings.items():
-            settings_popup.add_checkbutton(label=label, variable=var)
+        for setting in self.controller.settings.values():
+            settings_popup.add_checkbutton(label=setting.label, variable=setting.var)
 
         settings_popup.add_separator()
         settings_popup.add_command(label="Add Unsorted to base", command=self.controller.addUnsortedToBase)
@@ -146,14 +280,10 @@ class SidebarFrame(tk.Frame):
         Args:
             matches (list): List of indexes to highlight
         """
-        self.listbox_context.configure(state=tk.NORMAL)
-        self.listbox_context.selection_clear(0, tk.END)
-        if len(matches) == 0:
-            self.listbox_context.configure(state=tk.DISABLED)
-            return
-        for index in matches:
-            self.listbox_context.selection_set(index)
-            self.listbox_context.see(index)
+        self.listbox_context.setSelection(matches, disabled=(len(matches) == 0))
+        if matches:
+            # Matches are ordered best-first
+            self.listbox_context.see(matches[0])
 
     def on_adjust_seek(self, event):
         self.controller.gotoImage(event)
@@ -168,40 +298,69 @@ class SidebarFrame(tk.Frame):
 
     def processEntryInput(self, event):
         """Process entry input, handling element styling and possible automatic submission.
+        Matching is debounced and runs on the controller's query worker.
 
         Args:
             event (TYPE): Tk entry event
         """
-        GOOD = "#AAFFAA"
-        BAD = "#FFAAAA"
-        NORMAL = "#FFFFFF"
-
         query = event.widget.get()
         if event.keycode == 32:
             query = query[:-1]  # Delete space character
 
+        self.query_generation += 1
+        if self.query_after:
+            self.after_cancel(self.query_after)
+            self.query_after = None
+
         if query == "":
-            event.widget.configure(bg=NORMAL)
+            event.widget.configure(bg=self.NORMAL)
             self.highlightListboxItems([])
             self.controller.updateLabelFileName()
             return
 
-        # Use controller folder to "predict" action and highlight
-        best_folder_list = self.controller.getBestFolders(query)
+        self.query_after = self.after(QUERY_DEBOUNCE_MS, self.startQuery, event.widget, query, self.query_generation)
 
+    def startQuery(self, widget, query, generation):
+        self.query_after = None
+        future = self.controller.evaluateQuery(query)
+        self.pollQuery(widget, query, generation, future)
+
+    def pollQuery(self, widget, query, generation, future):
+        if generation != self.query_generation or future.cancelled():
+            # Superseded by a newer keystroke
+            return
+        if not future.done():
+            self.after(QUERY_POLL_MS, self.pollQuery, widget, query, generation, future)
+            return
+        try:
+            best_folder_list = future.result()
+        except Exception:
+            logger.error(f"Matching {query!r} failed", exc_info=True)
+            widget.configure(bg=self.BAD)
+            return
+        self.applyQueryResult(widget, query, best_folder_list)
+
+    def applyQueryResult(self, widget, query, best_folder_list):
+        """Show the result of a query: highlight, preview target, maybe auto-submit.
+
+        Args:
+            widget (tk.Entry): Entry the query was typed into
+            query (str): The query text
+            best_folder_list (list<FolderOption>): Matching folders, best first
+        """
         self.highlightListboxItems([ir.index for ir in best_folder_list])
 
         # Preview target, state
         if len(best_folder_list) == 1:
             best_folder = best_folder_list[0]
             self.controller.str_curfile.set(best_folder.label)
-            event.widget.configure(bg=GOOD)
+            widget.configure(bg=self.GOOD)
 
-            # Automatically submit if aggressive
-            if self.controller.settings["aggressive"][0].get():
-                self.submit(entry=query)
+            # Automatically submit if aggressive, with the match we already have
+            if self.controller.settings["aggressive"].var.get():
+                self.submit(entry=query, match=best_folder)
         else:
             self.controller.str_curfile.set(
                 ", ".join([li.label for li in best_folder_list])
             )
-            event.widget.configure(bg=BAD)
+            widget.configure(bg=self.BAD)
@@ -1,216 +1,81 @@
 import os
-import glob
 import logging
 import argparse
-import random
-import functools
-import itertools
-import re
-import hashlib
-import imagehash
+import concurrent.futures
 from dataclasses import dataclass
 
-from PIL import Image
-
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import messagebox
 from tkinter.simpledialog import askstring
 
-import loom
-
-import pymaybe
-
 import filesystem
+import instrument
+import preview
+import sortengine
+from sortcore import FolderOption, MatchResults, imageSize, md5, fingerprintImage, getMatches, bestFolders  # noqa: F401
 import sbf
-import contentcanvas
 from contentcanvas import ContentCanvas
+from contactsheet import ContactSheet
 
-from typing import Callable, Any, Optional, Union
-import operator
+from typing import Any, Optional, Union
 
 # IMAGEEXTS = ["png", "jpg", "bmp", "jpeg", "tif", "jfif", "tga", "webp", "gif", "gifv"]
 # VIDEOEXTS = ["webm", "mp4", "mov", "flv"]
 # _IMAGEEXTS = ["*." + e for e in IMAGEEXTS]
 # _VIDEOEXTS = ["*." + e for e in VIDEOEXTS]
-MATCHEXTS = contentcanvas.SUPPORTED_EXTS
+MATCHEXTS = preview.SUPPORTED_EXTS
 _MATCHEXTS = ["*." + e for e in MATCHEXTS]
 
-MAX_TRASH_HISTORY = 32
+OPERATION_POLL_MS = 50
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-@dataclass
-class FolderOption:
-    path: str
-    label: str
-    index: int
-
-
 @dataclass
 class UserBoolSetting:
     var: tk.BooleanVar
     label: str
 
 
-@dataclass
-class MatchResults:
-    all: list[str]
-    resolved: Optional[str]
-    unique: bool
-
-# FolderOption = collections.namedtuple("FolderOption", ["path", "label", "index"])
-# UserBoolSetting = collections.namedtuple("UserBoolSetting", ["var", "label"])
-# MatchResults = collections.namedtuple("MatchResults", ["all", "resolved", "unique"])
-
-
-def imageSize(filepath) -> int:
-    """
-    Returns:
-        int: Number of pixels in image
-    """
-    try:
-        w, h = Image.open(filepath).size
-        return w * h
-    except FileNotFoundError:
-        logger.warning("WARNING! File not found: " + filepath)
-        return 0
-    except OSError:
-        logger.warning("WARNING! OS error with file: " + filepath)
-        return 0
-
-
-def md5(path) -> str:
-    """Gives the md5 hash of a file on disk.
-    Args:
-        path (str): Path to a file
-
-    Returns:
-        str: MD5 hex digest
-    """
-    with open(path, 'rb') as afile:
-        h = hashlib.md5()  # noqa: S324
-        h.update(afile.read())
-        return h.hexdigest()
-
-
-@functools.lru_cache()
-def fingerprintImage(image_path) -> str:
-    """
-    Returns:
-        str: imagehash perceptual hash
-    """
-    try:
-        image = Image.open(image_path)
-        proc_hash = str(imagehash.dhash(image, hash_size=10))
-    except Exception:
-        logger.error("Can't fingerprint %s", image_path, exc_info=True)
-        proc_hash = md5(image_path)
-    return proc_hash
-
-
-@functools.lru_cache()
-def getMatches(query, collection, split_regex=r'[\\ /_-]', fuzzy=False) -> MatchResults:
-    """
-    >>> getMatches("dav ja", collection)
-    MatchResults(all=[], resolved=None, unique=False)
-    >>> getMatches("ri j", collection, fuzzy=True)
-    MatchResults(all=['vris john'], resolved='vris john', unique=True)
-    >>> getMatches("jo", collection)
-    MatchResults(all=['john', 'john rose'], resolved='john', unique=False)
-
-    >>> getMatches("john", collection).resolved
-    'john'
-    >>> getMatches("john", collection).all
-    ['john', 'john rose']
-
-    >>> getMatches("-john", collection).resolved
-    'vris john'
-    >>> getMatches("-rose", collection).resolved
-    'john rose'
-
-    >>> getMatches("jo ro", collection).resolved
-    'john rose'
-    """
-    matches = []
-
-    @functools.lru_cache()
-    def segs(q) -> list[str]:
-        return re.split(split_regex, q)
-
-    query_segs: list[str] = segs(query)
-    offsetize = bool(re.match(split_regex, query))
-
-    # Construct list of (item, segs) tuples sorted by the length of segments
-    grouped_item_segs: list[tuple[Any, list[str]]] = [(item, segs(item)) for item in collection]
-
-    def lenSegmentsKey(is_):
-        _item, item_segs = is_
-        return len(item_segs)
-
-    grouped_item_segs.sort(key=lenSegmentsKey)
-
-    def addSegmentMatches(match_fn: Callable[[str, str], bool]):
-        """Adds matches based on match_fn(theirs, ours): segmentMatches[True, False]"""
-        for item, item_segs in grouped_item_segs:
-            if item in matches:
-                continue
-            for offset in range(1 + len(item_segs) - len(query_segs)) if offsetize else [0]:
-                # zipped = [*zip(item_segs, ['']*offset + query_segs)]
-                zipped = [*itertools.zip_longest(
-                    item_segs,
-                    ([''] * offset) + query_segs,
-                    fillvalue=''
-                )]
-                passes_test = all(match_fn(theirs, ours) for (theirs, ours) in zipped)
-                # print(item, list(zipped), offset, offsetize, passes_test)
-                if passes_test:
-                    matches.append(item)
-                    # break
-
-    addSegmentMatches(lambda theirs, ours: theirs.startswith(ours))
-
-    if len(matches) == 0 and fuzzy:
-        addSegmentMatches(lambda theirs, ours: (ours in theirs))
-
-    best = None
-    if len(matches) > 0:
-        best = matches[0]
-
-    return MatchResults(resolved=best, all=matches, unique=(len(matches) == 1))
+def _engineAttribute(name: str) -> property:
+    """A FileSorter attribute that's really the engine's."""
+    return property(
+        lambda self: getattr(self.engine, name),
+        lambda self, value: setattr(self.engine, name, value),
+        doc=f"See SortEngine.{name}"
+    )
 
 
 class FileSorter(tk.Tk):  # noqa: PLR0904
 
-    """Summary
+    """Tk view and controller over a SortEngine, which does the sorting.
 
     Attributes:
+        engine (sortengine.SortEngine): File list, matching, disk actions and previews
         canvas (TYPE): Large image canvas tkwidget
-        context_folders (list<FolderOptions>): Folders that are target options, shown in sidebar
-        contextglobs (list<str>): Globs that select context folders
-
-        filepaths (list<str>): List of filepaths being processed
+        contactsheet (ContactSheet): Thumbnail grid, shown in place of the canvas in grid mode
         frame_sidebar (TYPE): Sidebarframe tk widget
-        image_ext_globs (TYPE): File globs to filter what files we process
-        image_index (int): Current index
-
-        imageglobs (TYPE): Full glob w/ path to select files
-        newFolderRoot (TYPE): Folder that contains any new folders
-
-        rootpath (TYPE): The current root path of the program
         settings ({key: (tk.BooleanVar, Str)}): User-configurable runtime settings
-
-        sorter (callable): The current sorting function used to order the file list
-        sortkeys (TYPE): List of sorting options, passed to sidebarframe
-
-        spool (TYPE): Description
         str_curfile (tk.Stringvar): Stringvar for the pretty formatted current file
-        trash (TYPE): Description
-        undo (list): Stack of functions to process via ctrl+z
+
+        filepaths, image_index, marked, sorter, sortkeys, records, trash,
+        rootpath, image_ext_globs, context_folders, undo: The engine's, see SortEngine
     """
 
+    filepaths = _engineAttribute("filepaths")
+    image_index = _engineAttribute("image_index")
+    marked = _engineAttribute("marked")
+    sorter = _engineAttribute("sorter")
+    sortkeys = _engineAttribute("sortkeys")
+    records = _engineAttribute("records")
+    trash = _engineAttribute("trash")
+    rootpath = _engineAttribute("rootpath")
+    image_ext_globs = _engineAttribute("image_ext_globs")
+    context_folders = _engineAttribute("context_folders")
+    undo = _engineAttribute("undo")
+
     def __init__(self, rootpath, image_ext_globs, *args, **kwargs) -> None:
         """File sorter main window
         Passthrough to tk.Tk
@@ -222,20 +87,11 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         super(FileSorter, self).__init__(*args, **kwargs)
 
         try:
-            self.image_index: int = 0
-            self.undo: list[Callable] = []
-            self.filepaths: list[str] = []
-            self.image_ext_globs: list[str] = image_ext_globs
-
+            self.grid_mode: bool = False
             self.prev_query: Optional[str] = None
 
-            self.contextglobs: list[str] = []
-            self.context_folders: list[FolderOption]
-            self.working_root_path: str
-            self.rootpath: str
-
-            self.spool = loom.Spool(1, "Sort misc")
-            self.trash = filesystem.Trash(verbose=True, queue_size=MAX_TRASH_HISTORY)
+            self.query_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="Sort query")
+            self.pending_query: Optional[concurrent.futures.Future] = None
 
             def userBoolSettingFactory(label, **kwargs):
                 return UserBoolSetting(var=tk.BooleanVar(**kwargs), label=label)
@@ -247,36 +103,26 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
                 "parent_dirs": userBoolSettingFactory("Use parent directories"),
                 "confident": userBoolSettingFactory("Displace rename conflicts"),
                 "aggressive": userBoolSettingFactory("Automatically process on unambigious input"),
-                "auto_reload": userBoolSettingFactory("Reload on change", value=True)
+                "archives": userBoolSettingFactory("Browse images inside archives", value=True),
+                "timings": userBoolSettingFactory("Show timing overlay")
             }
-            self.settings["parent_dirs"].var.trace("w", lambda *a: self.reloadDirContext())  # noqa: ARG005
-            self.settings["recursive"].var.trace("w", lambda *a: self.reloadDirContext())  # noqa: ARG005
-
-            self.sortkeys: dict[str, Callable] = {
-                "{}, {}".format(name, order): (
-                    lambda items, keyfunc=keyfunc, orderb=orderb: sorted(items, key=keyfunc, reverse=orderb)
-                )
-                for (name, keyfunc) in [
-                    ("Alphabetical", str.lower),
-                    ("Integers", lambda f: next(map(int, re.findall(r'\d+', os.path.splitext(os.path.split(f)[1])[0])))),
-                    ("File size", os.path.getsize),
-                    ("Last modified", os.path.getmtime),
-                    ("File type", lambda f: os.path.splitext(f)[1]),
-                    ("Image Dimensions", imageSize),
-                    ("Image Height", lambda f: pymaybe.maybe(Image.open(f)).size[1].or_else(0)),  # type: ignore
-                    ("Image Width", lambda f: pymaybe.maybe(Image.open(f)).size[0].or_else(0)),  # type: ignore
-                    ("Procedural hash", fingerprintImage),
-                    ("Random", lambda f: random.random())  # noqa: ARG005
-                ]
-                for (order, orderb) in [
-                    ("asc", False), ("desc", True)
-                ]
-            }
-
-            self.sorter: Callable = sorted
+            for key, setting in self.settings.items():
+                setting.var.trace("w", lambda *a, key=key: self.settingChanged(key))  # noqa: ARG005
+
+            self.engine = sortengine.SortEngine(
+                image_ext_globs,
+                options=sortengine.SortOptions(**{
+                    key: self.settings[key].var.get() for key in sortengine.optionNames()
+                }),
+                previews=preview.PreviewService(screen_size=(self.winfo_screenwidth(), self.winfo_screenheight())),
+                verbose=True
+            )
+            self.engine.change_callback = self.imageUpdate
+            self.engine.error_callback = lambda message: self.str_curfile.set(message)
 
             self.initwindow()
             self.openDir(rootpath)
+            self.pollOperationResults()
 
             self.mainloop()
 
@@ -286,11 +132,26 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
 
     # Windowing and GUI
 
+    def pollOperationResults(self) -> None:
+        self.engine.drainOperationResults()
+        self.after(OPERATION_POLL_MS, self.pollOperationResults)
+
+    def settingChanged(self, key: str) -> None:
+        """Pass a changed setting on to the engine, and redo whatever it affects."""
+        if key in sortengine.optionNames():
+            setattr(self.engine.options, key, self.settings[key].var.get())
+        if key in ("parent_dirs", "recursive"):
+            self.reloadDirContext()
+        elif key == "archives":
+            self.resortImageList()
+        elif key == "timings":
+            self.toggleTimings()
+
     def destroy(self) -> None:
         """Summary
         """
-        self.spool.finish()
-        self.trash.finish()
+        self.engine.close()
+        self.query_pool.shutdown(wait=False, cancel_futures=True)
         super().destroy()
 
     def initwindow(self) -> None:
@@ -308,22 +169,29 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         self.str_keepdir = tk.StringVar(value="keep")
 
         # Canvas stuff
-        self.canvas = ContentCanvas(self, takefocus=True)
+        self.canvas = ContentCanvas(self, previews=self.engine.previews, takefocus=True)
         self.canvas.grid(column=1, row=1, sticky="nsew")
         self.columnconfigure(1, weight=1)
         self.rowconfigure(1, weight=1)
 
+        self.contactsheet = ContactSheet(self, self.engine.previews, takefocus=True)
+
         # self.canvas.bind("<Button-1>", lambda event: self.canvas.focus_set())
 
         self.bind("<Delete>", self.askDelete)
         self.bind("<Right>", self.nextImage)
         self.bind("<Left>", self.prevImage)
+        self.bind("<Shift-Right>", self.markNext)
+        self.bind("<Shift-Left>", self.markPrev)
+        self.bind("<Escape>", self.clearMarks)
 
         # self.bind("<Configure>", self.onResize)
 
         self.bind("<Control-w>", self.canvas.quicksave)
         self.bind("<Control-d>", self.fastDelete)
         self.bind("<Control-z>", self.doUndo)
+        self.bind("<Prior>", lambda event: self.turnPage(-1))  # noqa: ARG005
+        self.bind("<Next>", lambda event: self.turnPage(1))  # noqa: ARG005
 
         # self.bind("<Up>", self.keepImage)
         # self.bind("<Down>", self.fastDelete)
@@ -337,6 +205,20 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         self.canvas.bind("<w>", self.canvas.quicksave)
 
         self.canvas.bind("<a>", self.doUndo)
+        self.canvas.bind("<m>", self.toggleMark)
+        self.bind("<Control-g>", self.toggleGrid)
+
+        for widget in (self.canvas, self.contactsheet):
+            widget.bind("<g>", self.toggleGrid)
+
+        self.contactsheet.bind("<f>", self.nextImage)
+        self.contactsheet.bind("<s>", self.prevImage)
+        self.contactsheet.bind("<d>", self.fastDelete)
+        self.contactsheet.bind("<e>", self.keepImage)
+        self.contactsheet.bind("<a>", self.doUndo)
+        self.contactsheet.bind("<m>", self.toggleMark)
+        self.contactsheet.bind("<Up>", lambda event: self.gridStep(-self.contactsheet.columns))  # noqa: ARG005
+        self.contactsheet.bind("<Down>", lambda event: self.gridStep(self.contactsheet.columns))  # noqa: ARG005
 
         self.frame_sidebar = sbf.SidebarFrame(
             self,
@@ -355,6 +237,9 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
             return
 
         prettyname = self.canvas.getInfoLabel()
+        if self.marked:
+            is_marked = "*" if self.currentImagePath in self.marked else " "
+            prettyname = f"[{is_marked}{len(self.marked)} marked] {prettyname}"
 
         self.str_curfile.set(prettyname)
 
@@ -364,9 +249,7 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         if not (os.path.isdir(rootpath) and os.path.isdir(destpath)):
             raise ValueError("Cleanup paths are not directories")
 
-        imageglobs = [os.path.join(glob.escape(rootpath), ext) for ext in self.image_ext_globs]
-        all_globs: list[str] = functools.reduce(operator.iadd, [glob.glob(a) for a in imageglobs], [])
-        loose_files = list(filter(self.trash.isfile, all_globs))
+        loose_files = self.engine.looseFiles(rootpath)
 
         num_loose_files = len(loose_files)
         if num_loose_files == 0:
@@ -385,14 +268,10 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
                     pass
 
     def updateContextListFrame(self) -> None:
-        """Generate and refresh the sidebar listbox"""
-        # Reset and clear
-        self.frame_sidebar.listbox_context.configure(state=tk.NORMAL)
-        self.frame_sidebar.listbox_context.delete(0, self.frame_sidebar.listbox_context.size())
-        # Populate with new values from folder_names
-        for opt in self.context_folders:
-            self.frame_sidebar.listbox_context.insert(
-                tk.END, "{}".format(opt.label[0:32]))
+        """Refresh the sidebar listbox"""
+        self.frame_sidebar.listbox_context.setItems(
+            opt.label[0:32] for opt in self.context_folders
+        )
 
     # Context and context manipulation
 
@@ -417,10 +296,11 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
 
     @property
     def currentImagePath(self) -> Optional[str]:
-        if len(self.filepaths) == 0:
-            return None
-        self.image_index = self.image_index % len(self.filepaths)
-        return self.filepaths[self.image_index]
+        return self.engine.currentImagePath
+
+    @property
+    def currentFilePath(self) -> Optional[str]:
+        return self.engine.currentFilePath
 
     def openDir(self, newdir=None) -> None:
         """Open a new directory and prepare window
@@ -445,58 +325,42 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
                 # No shared base, ignore
                 pass
 
-        self.working_root_path = newdir
-        self.rootpath = newdir
-        # self.generatePaths(newdir)
-
-        self.undo.clear()
-
-        # Initialize images
-        self.image_index = 0
-        # self.deleted_images_count = 0
+        self.engine.rootpath = newdir
+        self.engine.working_root_path = newdir
+        self.engine.undo.clear()
+        self.engine.image_index = 0
 
         # Initialize data
-        self.reloadDirContext()
+        self.reloadDirContext(rescan=True)
 
         self.frame_sidebar.progbar_prog.configure(maximum=(len(self.filepaths) - 1))
         # Just reloaded, so current length is max
         self.frame_sidebar.progbar_seek.configure(to=len(self.filepaths))
 
-    def reloadDirContext(self) -> None:
-        """Reload globs, keys, and context for our directory.
+    def reloadDirContext(self, rescan=False) -> None:
+        """Reload globs, keys, and context for our directory. Like SortEngine.reload,
+        but offers to tidy loose files first, and updates the window.
+
+        Args:
+            rescan (bool, optional): Drop the cached folder tree and scan the disk again.
         """
+        if rescan:
+            self.engine.folder_index.invalidate()
+
         self.generatePaths(self.rootpath)
+        self.refreshContextFolders()
+        self.resortImageList()
 
-        dir_path_enum: enumerate[str] = enumerate(sorted(
-            functools.reduce(operator.iadd, [glob.glob(a, recursive=True) for a in self.contextglobs], [])
-        ))
-        self.context_folders = [
-            FolderOption(
-                index=i,
-                path=dir_path,
-                label=os.path.relpath(
-                    dir_path.lower(),
-                    self.working_root_path
-                ).replace('\\', '/')
-            )
-            for i, dir_path in
-            dir_path_enum
-        ]
+    def refreshContextFolders(self) -> None:
+        """Rebuild context_folders from the folder index and update the sidebar.
+        """
+        self.engine.refreshContextFolders()
         self.updateContextListFrame()
-        self.resortImageList()
 
     def resortImageList(self) -> None:
         """Reload filepaths, rescan for images.
         """
-        logger.info("Resorting image list")
-
-        self.filepaths = self.sorter(
-            filter(
-                self.trash.isfile,  # Only non-deleted paths, according to our trash
-                functools.reduce(operator.iadd, [glob.glob(a) for a in self.imageglobs], [])
-            )
-        )
-
+        self.engine.rescan()
         self.imageUpdate("Resorted image list")
 
     # Generators and logic
@@ -507,12 +371,14 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         else:
             raise ValueError("No prev_query defined!")
 
-    def submit(self, event: Optional[Any] = None, entry: Optional[str] = "") -> None:
-        """Processing when the user submits the "move" entry
+    def submit(self, event: Optional[Any] = None, entry: Optional[str] = "", match: Optional[FolderOption] = None) -> None:
+        """Processing when the user submits the "move" entry.
+        Moves the current file, or every marked file as one batch.
 
         Args:
             event (bool, optional): Tk triggerinv event.
             entry (str, optional): Text of entry, if no triggering event.
+            match (FolderOption, optional): The folder entry already matched, so it isn't matched again
 
         Returns:
             TYPE: Description
@@ -535,10 +401,14 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         if not isinstance(self.currentImagePath, str):
             raise ValueError("Not currently vising an image")
 
-        old_file_path: str = self.currentImagePath
+        old_file_paths: list[str] = self.engine.selectedPaths()
 
         try:
-            best_folder: FolderOption = self.getBestFolder(entry)
+            best_folder: FolderOption = self.engine.moveToMatch(entry, old_file_paths, match=match)
+        except NotADirectoryError:
+            logger.error("Can't move to a folder that's gone; rescanning", exc_info=True)
+            self.reloadDirContext(rescan=True)
+            return
         except EnvironmentError:
             if self.settings["makedirs"].var.get():
                 self.moveToFolder(new_folder_name=entry)
@@ -552,36 +422,9 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
                     "Invalid key: {}".format(entry))
             return
 
-        destination_dir: str = best_folder.path
         self.frame_sidebar.strv_prev_query.set(best_folder.label)
         self.prev_query = best_folder.label
 
-        # If the destination has an "unsorted" folder, move there instead.
-        usubdir = os.path.join(destination_dir, "unsorted")
-        if os.path.exists(usubdir):
-            destination_dir = usubdir
-
-        if not os.path.isdir(destination_dir):
-            logger.error(f"In an invalid state: {destination_dir} is not a directory")
-            self.reloadDirContext()
-            return
-        old_index = self.filepaths.index(old_file_path)
-
-        def doMove() -> None:
-            (_old_file_dir, old_file_name) = os.path.split(old_file_path)
-            new_file_path: str = os.path.join(destination_dir, old_file_name)
-
-            filesystem.moveFileToFile(old_file_path, destination_dir)
-
-            def _undo(self) -> None:
-                filesystem.moveFileToFile(new_file_path, old_file_path)
-                self.filepaths.insert(old_index, old_file_path)
-            self.undo.append(_undo)
-
-        self.spool.enqueue(doMove)
-
-        self.filepaths.remove(old_file_path)
-
         # Clear field
         self.frame_sidebar.reFocusEntry()
 
@@ -594,115 +437,36 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
 
         self.imageUpdate("Submit")
 
-    def getBestFolder(self, entry) -> FolderOption:
-        """Wrapper around getBestFolders to find a single best folder.
-
-        Args:
-            entry (str): Shortcode, search term
-            indexOnly (bool, optional): Description
-
-        Returns:
-            TYPE: Description
-
-        Raises:
-            EnvironmentError: If there is more than one acceptable folder
-        """
-        best_folder_list: list[FolderOption] = self.getBestFolders(entry)
-        if len(best_folder_list) == 1:
-            return best_folder_list[0]
-        else:
-            raise EnvironmentError(f"Ambiguous folder selected, could be any of: {best_folder_list}")
-
-    def getBestFolders(self, entry: str) -> list[FolderOption]:
-        """Finds folders that match the search term
+    def evaluateQuery(self, entry: str) -> concurrent.futures.Future:
+        """Start SortEngine.bestFolders on the query worker, superseding any query
+        that has not started yet.
 
         Args:
             entry (str): Shortcode, search term
-            indexOnly (bool, optional): Description
 
         Returns:
-            list<int>: List of valid match INDEXES. Indexes reference self.folder_names
+            Future: Resolves to a list<FolderOption>
         """
-        query: str = entry.lower()
-
-        folder_names = tuple(opt.label for opt in self.context_folders)
-
-        # Exact match
-        if query in folder_names:
-            return [self.context_folders[folder_names.index(query)]]
+        if self.pending_query is not None:
+            self.pending_query.cancel()
 
-        if query != "":  # noqa: PLC1901
-            # There is not a perfect mapping
-            return [
-                self.context_folders[folder_names.index(result)]
-                for result in
-                getMatches(query, folder_names, fuzzy=self.settings["fuzzy"].var.get()).all
-            ]
-
-        return []
+        # Snapshot the state here, on the main thread
+        self.pending_query = self.query_pool.submit(
+            bestFolders, entry.lower(), self.context_folders, self.engine.options.fuzzy
+        )
+        return self.pending_query
 
     def generatePaths(self, root_path) -> None:
-        """Generate imageglobs and contextglobs for a root path, setting
-            self.imageglobs
-            self.contextglobs
-            self.newFolderRoot
+        """Generate globs and context folders for a root path (see SortEngine.generatePaths),
+        and offer to tidy loose files into its unsorted folder.
 
         Args:
             root_path (str): Root path to search
         """
-        logger.info("Generating paths for: {}".format(root_path))
-        logger.info(f"Filtering to files with extensions {self.image_ext_globs}")
-
-        # Pull loose images
-        self.imageglobs = [
-            os.path.join(glob.escape(root_path), ext)
-            for ext in self.image_ext_globs
-        ]
-
-        # print("Image Globs:", self.imageglobs)
-
-        subdirectory_unsorted = os.path.join(root_path, "unsorted")
-        parent_path = os.path.join(root_path, "..")
-
-        if os.path.exists(subdirectory_unsorted):
-            self.promptLooseCleanup(root_path, subdirectory_unsorted)
-
-        # Put images in same-level directories
-        has_sub_dirs = glob.glob(os.path.join(root_path, "*", ""))
-        working_root_path = (root_path if has_sub_dirs else parent_path)
-        self.working_root_path = working_root_path
-
-        # Candidate folders: folders in root_path
-        self.contextglobs = [
-            os.path.join(glob.escape(root_path), "*", "")
-        ]
-
-        # Candidate folders: "up" folder (of root OR parent)
-        # self.contextglobs.append(
-        #     os.path.join(glob.escape(working_root_path), "..", "")
-        # )
-
-        if self.settings["parent_dirs"].var.get() or not has_sub_dirs:
-            self.contextglobs.append(os.path.join(glob.escape(parent_path), "*", ""))
-
-        # Pull images from unsorted too
-        self.imageglobs += [
-            os.path.join(subdirectory_unsorted, ext)
-            for ext in self.image_ext_globs
-        ]
-
-        # We don't want unsorted in here
-        if self.settings["recursive"].var.get():
-            self.contextglobs.append(
-                os.path.join(glob.escape(working_root_path), "*", "*", "")
-            )
-            if self.settings["parent_dirs"].var.get():
-                self.contextglobs.append(
-                    os.path.join(glob.escape(parent_path), "*", "*", "")
-                )
+        paths = self.engine.generatePaths(root_path)
 
-        logger.info("Context globs: %s", self.contextglobs)
-        self.newFolderRoot = working_root_path  # Where we make new folders
+        if os.path.exists(paths.unsorted_path):
+            self.promptLooseCleanup(root_path, paths.unsorted_path)
 
     def nextImage(self, event=None) -> None:  # noqa: ARG002
         """Show the next image
@@ -716,12 +480,81 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         self.image_index -= 1
         self.imageUpdate("Prev image")
 
+    def toggleMark(self, event=None) -> None:  # noqa: ARG002
+        """Add or remove the current file from the bulk selection
+        """
+        if self.currentImagePath is None:
+            return
+        if self.currentImagePath in self.marked:
+            self.marked.discard(self.currentImagePath)
+        else:
+            self.marked.add(self.currentImagePath)
+        self.updateLabelFileName()
+        if self.grid_mode:
+            self.contactsheet.redraw()
+
+    def markNext(self, event=None) -> None:  # noqa: ARG002
+        """Mark the current file and step forward, to select a range
+        """
+        if self.currentImagePath is not None:
+            self.marked.add(self.currentImagePath)
+        self.nextImage()
+
+    def markPrev(self, event=None) -> None:  # noqa: ARG002
+        """Mark the current file and step back, to select a range
+        """
+        if self.currentImagePath is not None:
+            self.marked.add(self.currentImagePath)
+        self.prevImage()
+
+    def clearMarks(self, event=None) -> None:  # noqa: ARG002
+        self.marked.clear()
+        self.updateLabelFileName()
+        if self.grid_mode:
+            self.contactsheet.redraw()
+
+    def turnPage(self, delta: int) -> None:
+        """Page through the current document, if it has pages."""
+        if not self.grid_mode and self.canvas.turnPage(delta):
+            self.updateLabelFileName()
+
+    def toggleTimings(self) -> None:
+        """Show or hide timings over the canvas. Showing them starts collecting them,
+        and hiding them stops it, unless --instrument is logging them."""
+        if self.settings["timings"].var.get():
+            instrument.recorder.enabled = True
+            self.canvas.setOverlay(instrument.recorder.format())
+        else:
+            instrument.recorder.enabled = instrument.recorder.dumping
+            self.canvas.setOverlay(None)
+
+    def toggleGrid(self, event=None) -> None:  # noqa: ARG002
+        """Switch between the single-file canvas and the contact sheet grid
+        """
+        self.grid_mode = not self.grid_mode
+        if self.grid_mode:
+            self.canvas.grid_remove()
+            self.contactsheet.grid(column=1, row=1, sticky="nsew")
+            self.contactsheet.focus_set()
+        else:
+            self.contactsheet.grid_remove()
+            self.canvas.grid(column=1, row=1, sticky="nsew")
+            self.canvas.focus_set()
+        self.imageUpdate("Toggle grid")
+
+    def gridStep(self, step: int) -> None:
+        """Move the selection by step cells, e.g. a row up or down
+        """
+        self.image_index += step
+        self.imageUpdate("Grid step")
+
     def gotoImage(self, index) -> None:
         """Go to an image (based on a seek event)
         """
         self.image_index = int(float(index))
         self.imageUpdate("Seek")
 
+    @instrument.timed("imageUpdate")
     def imageUpdate(self, event=None) -> None:  # noqa: ARG002
         """Update widgets to reflect a new selected image
         """
@@ -735,23 +568,32 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         # Wraparound image indicies
         self.image_index = self.image_index % len(self.filepaths)
 
-        while self.currentImagePath is not None and not self.canvas.setFile(self.currentImagePath):
-            self.filepaths.remove(self.currentImagePath)
+        if self.grid_mode:
+            while self.currentImagePath is not None and not self.canvas.trackFile(self.currentImagePath):
+                self.filepaths.remove(self.currentImagePath)
+            self.contactsheet.show(self.filepaths, self.image_index, self.marked)
+        else:
+            while self.currentImagePath is not None and not self.canvas.setFile(self.currentImagePath):
+                self.filepaths.remove(self.currentImagePath)
 
         self.updateLabelFileName()
         self.frame_sidebar.var_progbar_seek.set(self.image_index)
         self.frame_sidebar.var_progbar_prog.set(len(self.filepaths))
 
-        # Preloading
-        start = (self.image_index - 4) % len(self.filepaths)
-        end = (self.image_index + 8) % len(self.filepaths)
+        # Preloading, for the canvas only; the grid fetches its own thumbnails
+        if not self.grid_mode:
+            start = (self.image_index - 4) % len(self.filepaths)
+            end = (self.image_index + 8) % len(self.filepaths)
 
-        # Wraparound
-        if start > end:
-            self.canvas.preloadImage(self.filepaths[start:len(self.filepaths)])
-            self.canvas.preloadImage(self.filepaths[0:end])
-        else:
-            self.canvas.preloadImage(self.filepaths[start:end])
+            # Wraparound
+            if start > end:
+                self.canvas.preloadImage(self.filepaths[start:len(self.filepaths)])
+                self.canvas.preloadImage(self.filepaths[0:end])
+            else:
+                self.canvas.preloadImage(self.filepaths[start:end])
+
+        if self.settings["timings"].var.get():
+            self.canvas.setOverlay(instrument.recorder.format())
 
     # Disk action
 
@@ -762,8 +604,8 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
             event (None, optional): Description
         """
         keepdir = os.path.join(self.str_keepdir.get(), os.path.split(self.rootpath)[1])
-        print("keepimage", keepdir)
-        self.spool.enqueue(self.moveToFolder, (), {"new_folder_name": keepdir})
+        logger.info(f"keepimage {keepdir}")
+        self.moveToFolder(new_folder_name=keepdir)
 
     def addUnsortedToBase(self) -> None:
         os.makedirs(os.path.join(self.rootpath, "Unsorted"))
@@ -784,29 +626,12 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         if self.currentImagePath is None:
             raise ValueError("Cannot delete; no image selected!")
 
-        file_to_delete: str = self.currentImagePath
+        file_to_delete: str = self.currentFilePath  # type: ignore[assignment]
 
         confirmed = preconfirmed or messagebox.askyesno(
             "Confirm", "{}\nAre you sure you want to delete this file?\n(The file will be trashed, and semi-recoverable.)".format(file_to_delete))
         if confirmed:
-            old_index = self.filepaths.index(file_to_delete)
-            self.filepaths.remove(file_to_delete)
-
-            self.trash.delete(file_to_delete)
-            # self.deleted_images_count += 1
-
-            def _undo(self):
-                """Summary
-                """
-                self.trash.undo()
-                self.canvas.markCacheDirty(file_to_delete)
-                self.filepaths.insert(old_index, file_to_delete)
-                # self.deleted_images_count -= 1
-                # self.prevImage()
-            self.undo.append(_undo)
-
-            # spool.enqueue(trash, (file_to_delete,), dict(undos=self.undo))
-            self.canvas.markCacheDirty(file_to_delete)
+            self.engine.delete(file_to_delete)
             self.imageUpdate("File deleted")
 
     def doPrefixRename(self, event) -> None:
@@ -818,7 +643,7 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         if self.currentImagePath is None:
             raise ValueError("Cannot do prefix rename; no image selected!")
 
-        old_file_path: str = self.currentImagePath
+        old_file_path: str = self.currentFilePath  # type: ignore[assignment]
         _old_file_dir, old_file_name = os.path.split(old_file_path)
         old_plain, _old_ext = os.path.splitext(old_file_name)
 
@@ -836,51 +661,21 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         event.widget.delete(0, last=tk.END)
 
     def _dorename(self, new_file_name) -> None:
-        """Rename current file to new_file_name
+        """Rename current file to new_file_name. See SortEngine.rename.
         """
         if self.currentImagePath is None:
             raise ValueError("Cannot rename; no image selected!")
 
-        old_file_path: str = self.currentImagePath
-        _old_filename, old_ext = os.path.splitext(old_file_path)
-
-        (old_file_dir, old_file_name) = os.path.split(old_file_path)
-        output_file_path = os.path.join(old_file_dir, new_file_name + old_ext)
-        if os.path.isfile(output_file_path):
-            if self.settings["confident"].var.get():
-                logger.info("Renaming conflicting file '%s'", output_file_path)
-                filesystem.renameFileOnly(output_file_path, new_file_name + "_displaced")
-            else:
-                stem, _ext = os.path.splitext(new_file_name)
-                style = f"{stem} (<#>)"
-                i = 0
-                while os.path.isfile(output_file_path):
-                    i += 1
-                    new_file_name = style.replace('<#>', str(i))
-                    output_file_path = os.path.join(old_file_dir, new_file_name + old_ext)
-                    if i > 100:  # noqa: PLR2004
-                        raise EnvironmentError("Too many renames")
-                if os.path.isfile(output_file_path):
-                    raise FileExistsError(output_file_path)
-        try:
-            logger.info(f"{old_file_path} -> {new_file_name}")
-            filesystem.renameFileOnly(old_file_path, new_file_name)
-            self.undo.append(
-                lambda s: filesystem.renameFileOnly(  # noqa: ARG005
-                    output_file_path,
-                    old_file_name
-                ))
-
-            self.canvas.markCacheDirty(old_file_path)
-
-            if self.settings["auto_reload"].var.get():
-                self.resortImageList()
+        old_file_path: str = self.currentFilePath  # type: ignore[assignment]
+        if self.engine.rename(old_file_path, new_file_name) is None:
+            return
 
-        except FileExistsError:
-            logger.error("Can't rename file %s: file exists", old_file_path, exc_info=True)
+        self.contactsheet.markCacheDirty(old_file_path)
+        self.imageUpdate("Renamed")
 
     def moveToFolder(self, event=None, new_folder_name="") -> None:
-        """Move the current image to a folder, which can be new.
+        """Move the current image (or all marked files) to a folder, which can be new.
+        The move itself runs in the background; the files leave the list immediately.
         """
         if event:
             new_folder_name = event.widget.get()
@@ -888,40 +683,22 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
         if self.currentImagePath is None:
             raise ValueError("Cannot move; no image selected!")
 
-        old_file_path: str = self.currentImagePath
+        old_file_paths: list[str] = self.engine.selectedPaths()
         if new_folder_name == "":  # noqa: PLC1901
             self.nextImage()
             self.frame_sidebar.reFocusEntry()
             return
-        try:
-            newdir: str = os.path.join(self.newFolderRoot, new_folder_name)
-            if not os.path.isdir(newdir):
-                os.makedirs(newdir, exist_ok=True)
-                self.reloadDirContext()
-
-            _old_folder, old_filename = os.path.split(old_file_path)
-            filesystem.moveFileToDir(old_file_path, newdir)
-
-            # self.deleted_images_count += 1
-            # TODO: Technically, this undo should decrement the deleted images count? Requires a rewrite.
-            self.undo.append(
-                lambda self: filesystem.moveFileToFile(  # noqa: ARG005
-                    os.path.join(newdir, old_filename), old_file_path
-                )
-            )
 
-            self.frame_sidebar.strv_prev_query.set(new_folder_name)
-            self.prev_query = new_folder_name
-
-            self.canvas.markCacheDirty(old_file_path)
+        # self.deleted_images_count += 1
+        # TODO: Technically, this undo should decrement the deleted images count? Requires a rewrite.
+        self.engine.moveToNewFolder(new_folder_name, old_file_paths)
+        # The folder is created by the operation; just show it now
+        self.updateContextListFrame()
 
-            self.filepaths.remove(old_file_path)
-            self.image_index -= 1
-            self.nextImage()
+        self.frame_sidebar.strv_prev_query.set(new_folder_name)
+        self.prev_query = new_folder_name
 
-        except Exception:
-            logger.error("Can't move to folder", exc_info=True)
-            raise
+        self.imageUpdate("Moved to folder")
 
         # Clear field
         if event:
@@ -932,14 +709,8 @@ class FileSorter(tk.Tk):  # noqa: PLR0904
     def doUndo(self, event) -> None:  # noqa: ARG002
         """Process an undo operation, handling the stack.
         """
-        if len(self.undo) == 0:
-            return
-
-        self.spool.finish(resume=True)
-
-        op = self.undo.pop()
-        op(self)
-        self.imageUpdate("Undo operation")
+        if self.engine.undoLast():
+            self.imageUpdate("Undo operation")
 
 
 def main() -> None:
@@ -952,8 +723,15 @@ def main() -> None:
         ap.add_argument(
             "-e", "--extensions", nargs='+', default=_MATCHEXTS,
             help="Substrings in the path to penalize during file sorting.")
+        ap.add_argument(
+            "--instrument", action="store_true", default=instrument.recorder.enabled,
+            help=f"Time the hot paths and log percentiles every minute (or set {instrument.ENV_VAR}=1).")
         args = ap.parse_args()
 
+        if args.instrument:
+            instrument.recorder.enabled = True
+            instrument.recorder.startDumping()
+
         FileSorter(args.base, args.extensions)
     except (Exception, KeyboardInterrupt):
         # Postmortem on uncaught exceptions
@@ -0,0 +1,458 @@
+# Display-free sorting logic, shared by the GUI and batch tools
+
+import os
+import bisect
+import glob
+import collections.abc
+import functools
+import itertools
+import operator
+import random
+import re
+import hashlib
+import imagehash
+from dataclasses import dataclass, field
+
+from PIL import Image
+
+import archives
+import filesystem
+import instrument
+
+from typing import Callable, Any, Iterable, Iterator, Optional
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FolderOption:
+    path: str
+    label: str
+    index: int
+
+
+@dataclass
+class MatchResults:
+    all: list[str]
+    resolved: Optional[str]
+    unique: bool
+
+# FolderOption = collections.namedtuple("FolderOption", ["path", "label", "index"])
+# MatchResults = collections.namedtuple("MatchResults", ["all", "resolved", "unique"])
+
+
+def imageSize(filepath) -> int:
+    """
+    Returns:
+        int: Number of pixels in image
+    """
+    try:
+        w, h = Image.open(filepath).size
+        return w * h
+    except FileNotFoundError:
+        logger.warning("WARNING! File not found: " + filepath)
+        return 0
+    except OSError:
+        logger.warning("WARNING! OS error with file: " + filepath)
+        return 0
+
+
+def md5(path) -> str:
+    """Gives the md5 hash of a file on disk.
+    Args:
+        path (str): Path to a file
+
+    Returns:
+        str: MD5 hex digest
+    """
+    if archives.cache.archiveOf(path):
+        return hashlib.md5(archives.cache.read(path)).hexdigest()  # noqa: S324
+    with open(path, 'rb') as afile:
+        h = hashlib.md5()  # noqa: S324
+        h.update(afile.read())
+        return h.hexdigest()
+
+
+def fingerprintImage(image_path) -> str:
+    """Not cached; see filerecords.FileRecordStore.fingerprint.
+
+    Returns:
+        str: imagehash perceptual hash
+    """
+    try:
+        opener = archives.cache.openImage if archives.cache.archiveOf(image_path) else Image.open
+        with opener(image_path) as image:
+            proc_hash = str(imagehash.dhash(image, hash_size=10))
+    except Exception:
+        logger.error("Can't fingerprint %s", image_path, exc_info=True)
+        proc_hash = md5(image_path)
+    return proc_hash
+
+
+@functools.lru_cache()
+def getMatches(query, collection, split_regex=r'[\\ /_-]', fuzzy=False) -> MatchResults:
+    """
+    >>> getMatches("dav ja", collection)
+    MatchResults(all=[], resolved=None, unique=False)
+    >>> getMatches("ri j", collection, fuzzy=True)
+    MatchResults(all=['vris john'], resolved='vris john', unique=True)
+    >>> getMatches("jo", collection)
+    MatchResults(all=['john', 'john rose'], resolved='john', unique=False)
+
+    >>> getMatches("john", collection).resolved
+    'john'
+    >>> getMatches("john", collection).all
+    ['john', 'john rose']
+
+    >>> getMatches("-john", collection).resolved
+    'vris john'
+    >>> getMatches("-rose", collection).resolved
+    'john rose'
+
+    >>> getMatches("jo ro", collection).resolved
+    'john rose'
+    """
+    matches = []
+
+    @functools.lru_cache()
+    def segs(q) -> list[str]:
+        return re.split(split_regex, q)
+
+    query_segs: list[str] = segs(query)
+    offsetize = bool(re.match(split_regex, query))
+
+    # Construct list of (item, segs) tuples sorted by the length of segments
+    grouped_item_segs: list[tuple[Any, list[str]]] = [(item, segs(item)) for item in collection]
+
+    def lenSegmentsKey(is_):
+        _item, item_segs = is_
+        return len(item_segs)
+
+    grouped_item_segs.sort(key=lenSegmentsKey)
+
+    def addSegmentMatches(match_fn: Callable[[str, str], bool]):
+        """Adds matches based on match_fn(theirs, ours): segmentMatches[True, False]"""
+        for item, item_segs in grouped_item_segs:
+            if item in matches:
+                continue
+            for offset in range(1 + len(item_segs) - len(query_segs)) if offsetize else [0]:
+                # zipped = [*zip(item_segs, ['']*offset + query_segs)]
+                zipped = [*itertools.zip_longest(
+                    item_segs,
+                    ([''] * offset) + query_segs,
+                    fillvalue=''
+                )]
+                passes_test = all(match_fn(theirs, ours) for (theirs, ours) in zipped)
+                # print(item, list(zipped), offset, offsetize, passes_test)
+                if passes_test:
+                    matches.append(item)
+                    # break
+
+    addSegmentMatches(lambda theirs, ours: theirs.startswith(ours))
+
+    if len(matches) == 0 and fuzzy:
+        addSegmentMatches(lambda theirs, ours: (ours in theirs))
+
+    best = None
+    if len(matches) > 0:
+        best = matches[0]
+
+    return MatchResults(resolved=best, all=matches, unique=(len(matches) == 1))
+
+
+@instrument.timed("match")
+def bestFolders(query: str, context_folders: list[FolderOption], fuzzy=False) -> list[FolderOption]:
+    """Finds folders whose labels match the (lowercase) search term.
+    Safe to call off the Tk thread; it touches no widgets or tk variables.
+
+    Args:
+        query (str): Lowercase shortcode, search term
+        context_folders (list<FolderOption>): Candidate folders
+        fuzzy (bool, optional): Fall back to substring matches
+
+    Returns:
+        list<FolderOption>: Matching folders, best first
+    """
+    folder_names = tuple(opt.label for opt in context_folders)
+
+    # Exact match
+    if query in folder_names:
+        return [context_folders[folder_names.index(query)]]
+
+    if query != "":  # noqa: PLC1901
+        # There is not a perfect mapping
+        return [
+            context_folders[folder_names.index(result)]
+            for result in
+            getMatches(query, folder_names, fuzzy=fuzzy).all
+        ]
+
+    return []
+
+
+@dataclass
+class SortPaths:
+    """Where files come from and where they can go, for one root path.
+
+    Attributes:
+        root_path (str): The directory being sorted
+        imageglobs (list<str>): Full globs w/ path that select files to sort
+        source_dirs (list<str>): The directories imageglobs look in
+        contextroots (list<(str, int)>): Roots and depths that select context folders
+        working_root_path (str): Folder that context labels are relative to
+        newFolderRoot (str): Folder that contains any new folders
+        unsorted_path (str): root_path's "unsorted" subfolder, which may not exist
+    """
+    root_path: str
+    imageglobs: list[str] = field(default_factory=list)
+    source_dirs: list[str] = field(default_factory=list)
+    contextroots: list[tuple[str, int]] = field(default_factory=list)
+    working_root_path: str = ""
+    newFolderRoot: str = ""
+    unsorted_path: str = ""
+
+
+def generatePaths(root_path: str, image_ext_globs: list[str], folder_index: filesystem.FolderIndex,
+                  parent_dirs=False, recursive=False) -> SortPaths:
+    """Generate imageglobs and contextroots for a root path.
+
+    Args:
+        root_path (str): Root path to search
+        image_ext_globs (list<str>): File globs to filter what files we process
+        folder_index (filesystem.FolderIndex): Cached folder tree
+        parent_dirs (bool, optional): Use parent directories as candidates
+        recursive (bool, optional): Include subdirs as candidates
+
+    Returns:
+        SortPaths
+    """
+    logger.info("Generating paths for: {}".format(root_path))
+    logger.info(f"Filtering to files with extensions {image_ext_globs}")
+
+    paths = SortPaths(root_path=root_path)
+
+    # Pull loose images
+    paths.imageglobs = [
+        os.path.join(glob.escape(root_path), ext)
+        for ext in image_ext_globs
+    ]
+
+    paths.unsorted_path = os.path.join(root_path, "unsorted")
+    paths.source_dirs = [root_path, paths.unsorted_path]
+    parent_path = os.path.join(root_path, "..")
+
+    # Put images in same-level directories
+    has_sub_dirs = bool(folder_index.listdirs(root_path))
+    working_root_path = (root_path if has_sub_dirs else parent_path)
+    paths.working_root_path = working_root_path
+
+    # Candidate folders: folders in root_path
+    paths.contextroots = [(root_path, 1)]
+
+    if parent_dirs or not has_sub_dirs:
+        paths.contextroots.append((parent_path, 1))
+
+    # Pull images from unsorted too
+    paths.imageglobs += [
+        os.path.join(glob.escape(paths.unsorted_path), ext)
+        for ext in image_ext_globs
+    ]
+
+    # We don't want unsorted in here
+    if recursive:
+        paths.contextroots.append((working_root_path, 2))
+        if parent_dirs:
+            paths.contextroots.append((parent_path, 2))
+
+    logger.info("Context roots: %s", paths.contextroots)
+    paths.newFolderRoot = working_root_path  # Where we make new folders
+    return paths
+
+
+def contextFolders(paths: SortPaths, folder_index: filesystem.FolderIndex) -> list[FolderOption]:
+    """The candidate destination folders for paths, sorted and labelled."""
+    dir_paths: list[str] = sorted({
+        dir_path
+        for (root, depth) in paths.contextroots
+        for dir_path in folder_index.walk(root, depth)
+    })
+    return [
+        FolderOption(
+            index=i,
+            path=dir_path,
+            label=os.path.relpath(
+                dir_path,
+                paths.working_root_path
+            ).lower().replace('\\', '/')
+        )
+        for i, dir_path in
+        enumerate(dir_paths)
+    ]
+
+
+def globFiles(imageglobs: list[str]) -> list[str]:
+    """Expand file globs into a flat list of paths."""
+    return functools.reduce(operator.iadd, [glob.glob(a) for a in imageglobs], [])
+
+
+def destinationFor(folder_path: str) -> str:
+    """If the destination has an "unsorted" folder, files go there instead."""
+    usubdir = os.path.join(folder_path, "unsorted")
+    if os.path.exists(usubdir):
+        return usubdir
+    return folder_path
+
+
+@functools.total_ordering
+class _Descending(object):
+    """Wraps a sort key so it orders backwards, for bisecting a reverse-sorted list."""
+    __slots__ = ("key",)
+
+    def __init__(self, key) -> None:
+        self.key = key
+
+    def __lt__(self, other) -> bool:
+        return other.key < self.key
+
+    def __eq__(self, other) -> bool:
+        return self.key == other.key
+
+
+@dataclass(frozen=True)
+class SortKey:
+    """One of the file list orderings.
+    Calling it sorts a list, like the plain functions it replaces.
+
+    Attributes:
+        keyfunc (callable): Key for a path, or None to sort by the path itself
+        reverse (bool): Sort descending
+    """
+    keyfunc: Optional[Callable[[str], Any]] = None
+    reverse: bool = False
+
+    def __call__(self, items: Iterable[str]) -> list[str]:
+        return list(SortedFileList(items, self))
+
+    def entryFor(self, filepath: str) -> tuple:
+        """Comparable entry for filepath. Ties are broken by path."""
+        key = filepath if self.keyfunc is None else self.keyfunc(filepath)
+        return (_Descending(key) if self.reverse else key, filepath)
+
+
+def makeSortKeys(records) -> dict[str, SortKey]:
+    """Every file list ordering, ascending and descending, by display name.
+
+    Args:
+        records (filerecords.FileRecordStore): Where sizes, dates, dimensions and hashes come from
+    """
+    return {
+        "{}, {}".format(name, order): SortKey(keyfunc=keyfunc, reverse=orderb)
+        for (name, keyfunc) in [
+            ("Alphabetical", str.lower),
+            ("Integers", lambda f: next(map(int, re.findall(r'\d+', os.path.splitext(os.path.split(f)[1])[0])))),
+            ("File size", records.size),
+            ("Last modified", records.mtime),
+            ("File type", lambda f: os.path.splitext(f)[1]),
+            ("Image Dimensions", records.pixels),
+            ("Image Height", lambda f: records.dimensions(f)[1]),
+            ("Image Width", lambda f: records.dimensions(f)[0]),
+            ("Procedural hash", records.fingerprint),
+            ("Random", lambda f: random.random())  # noqa: ARG005
+        ]
+        for (order, orderb) in [
+            ("asc", False), ("desc", True)
+        ]
+    }
+
+
+class SortedFileList(collections.abc.Sequence):
+    """File paths kept in SortKey order, with each path's key computed once.
+
+    Adding, removing, finding and renaming a path bisect on the cached
+    keys instead of resorting, so a rename moves one entry rather than
+    rebuilding the list.
+    """
+
+    def __init__(self, filepaths: Iterable[str] = (), sortkey: SortKey = SortKey()) -> None:
+        super().__init__()
+        self.sortkey: SortKey = sortkey
+        self._entries: dict[str, tuple] = {}
+        for filepath in filepaths:
+            if filepath not in self._entries:
+                self._entries[filepath] = sortkey.entryFor(filepath)
+        self._keys: list[tuple] = sorted(self._entries.values())
+        self._paths: list[str] = [entry[1] for entry in self._keys]
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def __getitem__(self, index):
+        return self._paths[index]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._paths)
+
+    def __contains__(self, filepath) -> bool:
+        return filepath in self._entries
+
+    def __repr__(self) -> str:
+        return f"SortedFileList({self._paths!r}, {self.sortkey!r})"
+
+    def index(self, filepath, *args) -> int:
+        """Position of filepath. O(log n).
+
+        Raises:
+            ValueError: If filepath isn't in the list
+        """
+        entry = self._entries.get(filepath)
+        if entry is None:
+            raise ValueError(f"{filepath!r} is not in list")
+        return bisect.bisect_left(self._keys, entry)
+
+    def add(self, filepath: str) -> int:
+        """Insert filepath at its sorted position, and return that position."""
+        if filepath in self._entries:
+            return self.index(filepath)
+        entry = self._entries[filepath] = self.sortkey.entryFor(filepath)
+        index = bisect.bisect_left(self._keys, entry)
+        self._keys.insert(index, entry)
+        self._paths.insert(index, filepath)
+        return index
+
+    def remove(self, filepath: str) -> int:
+        """Remove filepath, and return the position it had.
+
+        Raises:
+            ValueError: If filepath isn't in the list
+        """
+        index = self.index(filepath)
+        del self._entries[filepath]
+        del self._keys[index]
+        del self._paths[index]
+        return index
+
+    def removeMany(self, filepaths: Iterable[str]) -> int:
+        """Remove several paths in one pass over the list, ignoring any that aren't in it.
+
+        Returns:
+            int: Lowest position any of them had, or len(self) if none were found
+        """
+        gone = {filepath for filepath in filepaths if filepath in self._entries}
+        if len(gone) == 1:
+            return self.remove(gone.pop())
+        first_index = min((self.index(filepath) for filepath in gone), default=len(self))
+        for filepath in gone:
+            del self._entries[filepath]
+        self._keys = [entry for entry in self._keys if entry[1] not in gone]
+        self._paths = [entry[1] for entry in self._keys]
+        return first_index
+
+    def rename(self, old_filepath: str, new_filepath: str) -> int:
+        """Replace old_filepath with new_filepath, moving it to where its new key sorts.
+
+        Returns:
+            int: New position
+        """
+        self.remove(old_filepath)
+        return self.add(new_filepath)
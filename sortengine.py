@@ -0,0 +1,582 @@
+# The sorting session: file list, matching, moves, renames, deletes and undo, without a display
+
+import os
+import glob
+import queue
+import dataclasses
+from dataclasses import dataclass
+
+import archives
+import filerecords
+import filesystem
+import instrument
+import oplog
+import pdfpages
+import preview
+import sortcore
+from sortcore import FolderOption, bestFolders
+
+from typing import Callable, Iterable, Iterator, Optional
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAX_TRASH_HISTORY = 32
+
+
+@dataclass
+class SortOptions:
+    fuzzy: bool = False  # Fuzzy folder matching
+    recursive: bool = False  # Include subdirs as candidates
+    parent_dirs: bool = False  # Use parent directories
+    confident: bool = False  # Displace rename conflicts instead of renaming around them
+    archives: bool = True  # Browse images inside archives
+
+
+def optionNames() -> list[str]:
+    return [field.name for field in dataclasses.fields(SortOptions)]
+
+
+class SortEngine(object):
+
+    """A sorting session over one root folder, with no UI.
+
+    Views (the Tk FileSorter, scripts, benchmarks) drive it by setting
+    image_index and marked and calling its actions, then show filepaths
+    and previews however they like.
+
+    Disk operations run in the background on `operations`. Their results
+    are queued, and handled wherever drainOperationResults is called, so
+    the file list is only ever changed from the caller's thread.
+
+    Attributes:
+        options (SortOptions): Matching and scanning settings
+        image_ext_globs (list<str>): File globs to filter what files we process
+
+        filepaths (sortcore.SortedFileList): Filepaths being processed, in sorter order
+        image_index (int): Current index
+        marked (set<str>): Filepaths selected for bulk operations
+        sorter (sortcore.SortKey): The current ordering of the file list
+        sortkeys (dict<str, SortKey>): Sorting options, by name
+
+        rootpath (str): The root path being sorted
+        paths (sortcore.SortPaths): Globs and folders generated for rootpath
+        context_folders (list<FolderOption>): Folders that are target options
+        folder_index (filesystem.FolderIndex): Cached scan of the folder tree
+        name_index (filesystem.NameIndex): Cached file names, for resolving rename conflicts
+
+        records (filerecords.FileRecordStore): Per-file metadata
+        previews (preview.PreviewService): Images and text for showing files
+        journal (oplog.Journal): Crash-safe record of disk operations
+        trash (oplog.JournaledTrash): Deleted files, until they're committed
+        operations (oplog.OperationExecutor): Runs journaled moves and renames
+        undo (list): Stack of functions that undo actions, each taking the engine
+
+        change_callback (callable): Called with a reason when the file list changes in the background
+        error_callback (callable): Called with a message when a background operation fails
+    """
+
+    def __init__(
+        self, image_ext_globs: list[str], options: Optional[SortOptions] = None,
+        journal_dir: str = oplog.DEFAULT_JOURNAL_DIR, previews: Optional[preview.PreviewService] = None,
+        verbose: bool = False
+    ) -> None:
+        """Args:
+            image_ext_globs (list<str>): File globs to filter what files we process
+            options (SortOptions, optional): Settings; defaults if not given
+            journal_dir (str, optional): Folder for the operation journals
+            previews (PreviewService, optional): Preview source to share. Gets its own otherwise.
+            verbose (bool, optional): Log each trashed file
+        """
+        super().__init__()
+        self.image_ext_globs: list[str] = image_ext_globs
+        self.options: SortOptions = options if options is not None else SortOptions()
+
+        self.image_index: int = 0
+        self.filepaths = sortcore.SortedFileList()
+        self.marked: set[str] = set()
+
+        self.previews = previews if previews is not None else preview.PreviewService()
+        self.records: filerecords.FileRecordStore = self.previews.records
+        self.sortkeys: dict[str, sortcore.SortKey] = sortcore.makeSortKeys(self.records)
+        self.sorter = sortcore.SortKey()
+
+        self.rootpath: str = ""
+        self.working_root_path: str = ""
+        self.paths: Optional[sortcore.SortPaths] = None
+        self.context_folders: list[FolderOption] = []
+        self.folder_index = filesystem.FolderIndex()
+        self.name_index = filesystem.NameIndex()
+
+        self.journal = oplog.Journal(journal_dir)
+        self.trash = oplog.JournaledTrash(self.journal, verbose=verbose, queue_size=MAX_TRASH_HISTORY)
+        self.trash.recover()
+        self.operations = oplog.OperationExecutor(self.journal)
+        self.operation_results: queue.Queue = queue.Queue()
+        self.undo: list[Callable] = []
+
+        self.change_callback: Callable[[str], None] = lambda reason: None  # noqa: ARG005
+        self.error_callback: Callable[[str], None] = lambda message: None  # noqa: ARG005
+
+    def close(self) -> None:
+        """Finish queued operations, commit the trash, and stop background work."""
+        self.operations.finish()
+        self.trash.finish()
+        self.journal.close()
+        self.previews.close()
+
+    # Operation results
+
+    def deferred(self, fn: Callable[[oplog.Operation, Optional[BaseException]], None]) -> Callable:
+        """Wrap an operation callback so it runs in drainOperationResults instead of on the worker."""
+        return lambda op, error: self.operation_results.put((fn, op, error))
+
+    def drainOperationResults(self) -> None:
+        """Run callbacks for every operation that has finished so far."""
+        while True:
+            try:
+                fn, op, error = self.operation_results.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fn(op, error)
+            except Exception:
+                logger.error(f"Error handling result of {op}", exc_info=True)
+
+    # Folders and scanning
+
+    @property
+    def newFolderRoot(self) -> str:
+        return self.paths.newFolderRoot  # type: ignore[union-attr]
+
+    def open(self, rootpath: str) -> None:
+        """Start sorting a new root folder."""
+        self.rootpath = rootpath
+        self.working_root_path = rootpath
+        self.undo.clear()
+        self.image_index = 0
+        self.reload(rescan=True)
+
+    def reload(self, rescan: bool = False) -> None:
+        """Reload globs, context folders and the file list for rootpath.
+
+        Args:
+            rescan (bool, optional): Drop the cached folder tree and scan the disk again.
+        """
+        if rescan:
+            self.folder_index.invalidate()
+
+        self.generatePaths(self.rootpath)
+        self.refreshContextFolders()
+        self.rescan()
+
+    def generatePaths(self, root_path: str) -> sortcore.SortPaths:
+        """Generate and keep the globs and folders to use for root_path. See sortcore.generatePaths."""
+        self.paths = sortcore.generatePaths(
+            root_path, self.image_ext_globs, self.folder_index,
+            parent_dirs=self.options.parent_dirs,
+            recursive=self.options.recursive
+        )
+        self.working_root_path = self.paths.working_root_path
+        return self.paths
+
+    def refreshContextFolders(self) -> list[FolderOption]:
+        """Rebuild context_folders from the folder index."""
+        self.context_folders = sortcore.contextFolders(self.paths, self.folder_index)  # type: ignore[arg-type]
+        return self.context_folders
+
+    def looseFiles(self, rootpath: str) -> list[str]:
+        """Files directly in rootpath that match the globs, rather than in a folder."""
+        imageglobs = [os.path.join(glob.escape(rootpath), ext) for ext in self.image_ext_globs]
+        return list(filter(self.trash.isfile, sortcore.globFiles(imageglobs)))
+
+    def rescan(self) -> None:
+        """Reload filepaths, rescan for images.
+        """
+        logger.info("Resorting image list")
+        self.name_index.invalidate()
+
+        scanned: Iterable[str] = (
+            path
+            for path in self.records.scan(self.paths.source_dirs, self.image_ext_globs)  # type: ignore[union-attr]
+            if path not in self.trash  # Only non-deleted paths, according to our trash
+        )
+        if self.options.archives:
+            scanned = self.expandArchives(scanned)
+        with instrument.span("scan"):
+            scanned = list(scanned)
+        with instrument.span("sort"):
+            self.filepaths = sortcore.SortedFileList(scanned, self.sorter)
+        self.marked.intersection_update(self.filepaths)
+
+    # File list
+
+    @property
+    def currentImagePath(self) -> Optional[str]:
+        if len(self.filepaths) == 0:
+            return None
+        self.image_index = self.image_index % len(self.filepaths)
+        return self.filepaths[self.image_index]
+
+    @property
+    def currentFilePath(self) -> Optional[str]:
+        """The file on disk behind the current entry: itself, or the archive it's inside."""
+        current = self.currentImagePath
+        if current is None:
+            return None
+        return archives.cache.archiveOf(current) or current
+
+    def expandArchives(self, filepaths: Iterable[str]) -> Iterator[str]:
+        """Replace archives that contain images with virtual paths to those images."""
+        for path in filepaths:
+            if archives.isArchive(path):
+                yield from (archives.cache.members(path) or [path])
+            else:
+                yield path
+
+    def entriesFor(self, path: str) -> list[str]:
+        """The filepaths entries for a file on disk: just it, or the images inside it if it's an archive."""
+        if path in self.filepaths:
+            return [path]
+        if archives.isArchive(path):
+            # Not archives.cache.members: by now the archive may have moved
+            prefix = os.path.join(path, "")
+            return [entry for entry in self.filepaths if entry.startswith(prefix)]
+        return []
+
+    def indexOf(self, path: str) -> int:
+        """Position of a file on disk in filepaths, or of its first image if it's an archive."""
+        entries = self.entriesFor(path)
+        if not entries:
+            raise ValueError(f"{path!r} is not in list")
+        return self.filepaths.index(entries[0])
+
+    def addFilepath(self, path: str) -> None:
+        """Put a file on disk (back) into filepaths, expanding it if it's an archive."""
+        if archives.isArchive(path) and self.options.archives:
+            for member in archives.cache.members(path) or [path]:
+                self.filepaths.add(member)
+        else:
+            self.filepaths.add(path)
+
+    def selectedPaths(self) -> list[str]:
+        """Files an action applies to: the marked files in list order, or just the current file.
+        Images inside an archive stand for the whole archive.
+        """
+        if self.marked:
+            entries = sorted((path for path in self.marked if path in self.filepaths), key=self.filepaths.index)
+        elif self.currentImagePath is None:
+            return []
+        else:
+            entries = [self.currentImagePath]
+        return list(dict.fromkeys(archives.cache.archiveOf(path) or path for path in entries))
+
+    def removeFilepaths(self, paths: list[str]) -> None:
+        """Take files out of filepaths in one pass, keeping the view on the file after the first one.
+        Archives are closed, and all their images leave the list.
+        """
+        entries = [entry for path in paths for entry in self.entriesFor(path)]
+        for path in paths:
+            if archives.isArchive(path):
+                archives.cache.forget(path)
+            elif path.lower().endswith(".pdf"):
+                pdfpages.cache.forget(path)
+        first_index = self.filepaths.removeMany(entries)
+        if len(entries) > 1:
+            self.image_index = first_index
+        self.marked.difference_update(entries)
+
+    def insertFilepaths(self, entries: list[tuple[int, str]]) -> None:
+        """Put files back, e.g. after an undo. The list order puts them back at their old indexes.
+        """
+        for _index, path in entries:
+            self.addFilepath(path)
+
+    def renameFilepath(self, old_file_path: str, new_file_path: str) -> None:
+        """Move a file's entries in filepaths to their new name's sorted position, without a rescan.
+        An archive's images are all renamed with it. The view stays on whichever file it was on.
+        """
+        entries = self.entriesFor(old_file_path)
+        if not entries:
+            return
+        current = self.currentImagePath
+        for entry in entries:
+            new_entry = new_file_path + entry[len(old_file_path):]
+            self.filepaths.rename(entry, new_entry)
+            if entry == current:
+                current = new_entry
+            if entry in self.marked:
+                self.marked.discard(entry)
+                self.marked.add(new_entry)
+        if current is not None:
+            self.image_index = self.filepaths.index(current)
+
+    def restoreFilepath(self, index: int, filepath: str, message: str) -> None:  # noqa: ARG002
+        """Put back a file whose background operation failed, and report it."""
+        logger.error(message)
+        self.name_index.add(filepath)
+        self.addFilepath(filepath)
+        self.change_callback("Operation failed")
+        self.error_callback(message)
+
+    # Matching
+
+    def bestFolders(self, entry: str) -> list[FolderOption]:
+        """Finds folders that match the search term
+
+        Args:
+            entry (str): Shortcode, search term
+
+        Returns:
+            list<FolderOption>: Matching folders, best first
+        """
+        return bestFolders(entry.lower(), self.context_folders, fuzzy=self.options.fuzzy)
+
+    def bestFolder(self, entry: str) -> FolderOption:
+        """Wrapper around bestFolders to find a single best folder.
+
+        Raises:
+            EnvironmentError: If there is more than one acceptable folder
+        """
+        best_folder_list: list[FolderOption] = self.bestFolders(entry)
+        if len(best_folder_list) == 1:
+            return best_folder_list[0]
+        else:
+            raise EnvironmentError(f"Ambiguous folder selected, could be any of: {best_folder_list}")
+
+    # Disk actions
+
+    def queueMoves(self, moves: list[tuple[int, str, str]], makedirs=False) -> list[int]:
+        """Move files in the background as one group, and push a single undo entry for them.
+        The caller is responsible for taking the files out of filepaths.
+
+        Undoing moves that haven't started cancels them. Undoing finished
+        moves queues the reverse moves ahead of everything else, and the
+        files come back into the list when those land. A move that's still
+        running is reversed once it finishes, without waiting for it.
+
+        Args:
+            moves (list<(int, str, str)>): (old index, old path, new path) for each file
+            makedirs (bool, optional): Create destination folders as needed
+
+        Returns:
+            list<int>: Operation ids of the moves
+        """
+        ops: list[oplog.Operation] = []
+        for old_index, old_file_path, new_file_path in moves:
+            def onMoved(op, error, old_index=old_index, old_file_path=old_file_path) -> None:
+                if error:
+                    self.restoreFilepath(old_index, old_file_path, f"Can't move {old_file_path}: {error}")
+
+            ops.append(oplog.Operation(
+                kind=oplog.OP_MOVE, source=old_file_path, destination=new_file_path, makedirs=makedirs,
+                callback=self.deferred(onMoved)
+            ))
+        op_ids = self.operations.enqueueMany(ops)
+        for _old_index, old_file_path, new_file_path in moves:
+            self.name_index.discard(old_file_path)
+            self.name_index.add(new_file_path)
+
+        def _undo(self) -> None:
+            restored: list[tuple[int, str]] = []
+            inverses: list[oplog.Operation] = []
+            landed: list[tuple[int, str]] = []
+            remaining = 0  # Moves still to be reversed, or found to have failed
+
+            def settle() -> None:
+                nonlocal remaining
+                remaining -= 1
+                if remaining == 0 and landed:
+                    self.insertFilepaths(landed)
+                    self.change_callback("Undo move")
+
+            for (old_index, old_file_path, new_file_path), op in zip(moves, ops):
+                if self.operations.cancel(op.id):
+                    # Never touched the disk
+                    restored.append((old_index, old_file_path))
+                    self.name_index.discard(new_file_path)
+                    self.name_index.add(old_file_path)
+                    continue
+                if op.state == oplog.STATE_FAILED:
+                    # onMoved already put the file back
+                    continue
+
+                def onMovedBack(op, error, entry=(old_index, old_file_path)) -> None:
+                    if error:
+                        logger.error(f"Can't undo move of {entry[1]}: {error}")
+                        self.error_callback(f"Can't undo move of {entry[1]}: {error}")
+                    else:
+                        landed.append(entry)
+                        self.name_index.discard(op.source)
+                        self.name_index.add(op.destination)
+                    settle()
+
+                inverse = oplog.Operation(
+                    kind=oplog.OP_MOVE, source=new_file_path, destination=old_file_path,
+                    callback=self.deferred(onMovedBack)
+                )
+                remaining += 1
+                if op.state == oplog.STATE_DONE:
+                    inverses.append(inverse)
+                    continue
+
+                def afterMove(op, _error, inverse=inverse) -> None:
+                    # Still running when undone; reverse it once it lands
+                    if op.state == oplog.STATE_DONE:
+                        self.operations.enqueue(inverse, urgent=True)
+                    else:
+                        settle()
+
+                self.operations.whenFinished(op, self.deferred(afterMove))
+
+            self.insertFilepaths(restored)
+            if inverses:
+                self.operations.enqueueMany(inverses, urgent=True)
+
+        self.undo.append(_undo)
+        return op_ids
+
+    def moveTo(self, destination_dir: str, paths: list[str], makedirs=False) -> list[int]:
+        """Move files into a folder in the background, and take them out of filepaths now.
+
+        Args:
+            destination_dir (str): Folder to move into
+            paths (list<str>): Files on disk, e.g. from selectedPaths
+            makedirs (bool, optional): Create destination_dir if it doesn't exist
+
+        Returns:
+            list<int>: Operation ids of the moves
+        """
+        op_ids = self.queueMoves([
+            (self.indexOf(path), path, os.path.join(destination_dir, os.path.split(path)[1]))
+            for path in paths
+        ], makedirs=makedirs)
+        for path in paths:
+            self.previews.forget(path)
+        self.removeFilepaths(paths)
+        return op_ids
+
+    def moveToMatch(self, entry: str, paths: list[str], match: Optional[FolderOption] = None) -> FolderOption:
+        """Move files to the one folder that matches entry, or to its "unsorted" folder if it has one.
+
+        Args:
+            entry (str): Shortcode, search term
+            paths (list<str>): Files to move
+            match (FolderOption, optional): The folder entry already matched, e.g. on the query worker
+
+        Returns:
+            FolderOption: The folder matched
+
+        Raises:
+            EnvironmentError: If no single folder matches
+            NotADirectoryError: If the matched folder has gone, so the folders need rescanning
+        """
+        best_folder: FolderOption = match if match is not None else self.bestFolder(entry)
+
+        # If the destination has an "unsorted" folder, move there instead.
+        destination_dir = sortcore.destinationFor(best_folder.path)
+
+        if not os.path.isdir(destination_dir):
+            raise NotADirectoryError(f"In an invalid state: {destination_dir} is not a directory")
+
+        self.moveTo(destination_dir, paths)
+        return best_folder
+
+    def moveToNewFolder(self, new_folder_name: str, paths: list[str]) -> str:
+        """Move files to a folder under newFolderRoot, which is created if it doesn't exist.
+
+        Returns:
+            str: The folder's path
+        """
+        newdir: str = os.path.join(self.newFolderRoot, new_folder_name)
+        # The folder is created by the operation; list it now
+        if self.folder_index.add(newdir):
+            self.refreshContextFolders()
+        self.moveTo(newdir, paths, makedirs=True)
+        return newdir
+
+    def delete(self, file_to_delete: str) -> None:
+        """Send a file to the trash and take it out of filepaths. Undoable."""
+        self.removeFilepaths([file_to_delete])
+        self.trash.delete(file_to_delete)
+
+        def _undo(self):
+            self.trash.undo()
+            self.previews.forget(file_to_delete)
+            self.addFilepath(file_to_delete)
+        self.undo.append(_undo)
+
+        self.previews.forget(file_to_delete)
+
+    def rename(self, old_file_path: str, new_file_name: str) -> Optional[str]:
+        """Rename a file in its folder, keeping its extension. Undoable.
+
+        Name conflicts are resolved against name_index rather than by probing
+        the disk, and the rename itself never replaces an existing file. If
+        something appeared on disk since the folder was indexed, the folder
+        is rescanned and the conflict resolved again.
+
+        Returns:
+            str: The new path, or None if the file couldn't be renamed
+        """
+        archives.cache.forget(old_file_path)
+        pdfpages.cache.forget(old_file_path)
+        _old_filename, old_ext = os.path.splitext(old_file_path)
+
+        (old_file_dir, old_file_name) = os.path.split(old_file_path)
+        requested_file_path = os.path.join(old_file_dir, new_file_name + old_ext)
+        for _attempt in range(2):
+            output_file_path = requested_file_path
+            try:
+                if self.name_index.exists(output_file_path):
+                    if self.options.confident:
+                        displaced_file_path = self.name_index.freeName(
+                            os.path.join(old_file_dir, new_file_name + "_displaced" + old_ext))
+                        logger.info("Renaming conflicting file '%s'", output_file_path)
+                        self.operations.run(oplog.Operation(
+                            kind=oplog.OP_RENAME, source=output_file_path, destination=displaced_file_path))
+                        self.name_index.discard(output_file_path)
+                        self.name_index.add(displaced_file_path)
+                        self.previews.forget(output_file_path)
+                        self.renameFilepath(output_file_path, displaced_file_path)
+                    else:
+                        output_file_path = self.name_index.freeName(output_file_path)
+
+                logger.info(f"{old_file_path} -> {output_file_path}")
+                self.operations.run(oplog.Operation(kind=oplog.OP_RENAME, source=old_file_path, destination=output_file_path))
+                break
+            except FileExistsError:
+                logger.warning("Name index for %s was stale; rescanning", old_file_dir)
+                self.name_index.invalidate(old_file_dir)
+        else:
+            logger.error("Can't rename file %s: file exists", old_file_path)
+            return None
+
+        self.name_index.discard(old_file_path)
+        self.name_index.add(output_file_path)
+
+        def _undo(s) -> None:
+            s.operations.run(oplog.Operation(
+                kind=oplog.OP_RENAME, source=output_file_path, destination=old_file_path
+            ))
+            s.name_index.discard(output_file_path)
+            s.name_index.add(old_file_path)
+            s.renameFilepath(output_file_path, old_file_path)
+        self.undo.append(_undo)
+
+        self.previews.forget(old_file_path)
+        self.renameFilepath(old_file_path, output_file_path)
+        return output_file_path
+
+    def undoLast(self) -> bool:
+        """Undo the most recent action, if there is one.
+
+        Returns:
+            bool: Whether there was anything to undo
+        """
+        if len(self.undo) == 0:
+            return False
+
+        op = self.undo.pop()
+        op(self)
+        return True